@@ -0,0 +1,65 @@
+"""Encode time versus output bytes for every encode profile, on a bucket sample.
+
+    python -m benchmarks.encoders --bucket taiwo-images --bucket-folder "" --sample 20
+    python -m benchmarks.encoders --bucket taiwo-images --formats PNG,JPEG --output encoders.json
+
+Downloads a random sample of ``{bucket_folder}images/`` and encodes each
+image, decoded once, with every profile in ``common.encoding.PROFILES``. Use
+the table to pick ``ENCODE_PROFILE``; the Streamlit sidebar's "Measure encode
+profiles" button runs the same measurement.
+"""
+import argparse
+import json
+import random
+
+from common.encoding import MEASURE_FORMATS, PROFILES, measure
+from common.s3 import get_client, iter_objects
+
+IMAGE_EXTENSIONS = (".heic", ".heif", ".png", ".jpg", ".jpeg", ".webp")
+# downloads running ahead of the encoder
+DOWNLOAD_WORKERS = 4
+
+
+def sample_keys(s3, bucket, prefix, n_samples, rng):
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [
+        item["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if item["Key"].lower().endswith(IMAGE_EXTENSIONS)
+    ]
+    return rng.sample(keys, min(n_samples, len(keys)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--bucket-folder", default="")
+    parser.add_argument("--sample", type=int, default=10, help="images to download and encode")
+    parser.add_argument("--formats", default=",".join(MEASURE_FORMATS), help="comma separated output formats")
+    parser.add_argument("--profiles", default=",".join(PROFILES), help="comma separated encode profiles")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    args = parser.parse_args()
+
+    s3 = get_client()
+    keys = sample_keys(s3, args.bucket, f"{args.bucket_folder}images/", args.sample, random.Random(args.seed))
+    if not keys:
+        parser.error(f"no images under s3://{args.bucket}/{args.bucket_folder}images/")
+    print(f"encoding {len(keys)} images from s3://{args.bucket}/{args.bucket_folder}images/")
+    # decoded one at a time, so only a few downloads are held in memory
+    sources = (body for _, body in iter_objects(s3, args.bucket, keys, max_workers=DOWNLOAD_WORKERS))
+    results = measure(sources, formats=[f.strip().upper() for f in args.formats.split(",")],
+                      profiles=[p.strip() for p in args.profiles.split(",")])
+
+    print(f"{'profile':<10} {'format':<6} {'ms/image':>10} {'KiB/image':>10} {'total s':>9} {'total MiB':>10}")
+    for row in results:
+        print(f"{row['profile']:<10} {row['format']:<6} {row['ms_per_image']:>10.1f} "
+              f"{row['bytes_per_image'] / 1024:>10.1f} {row['seconds']:>9.2f} {row['bytes'] / 2 ** 20:>10.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"bucket": args.bucket, "keys": keys, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
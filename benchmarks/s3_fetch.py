@@ -0,0 +1,79 @@
+"""Serial vs. concurrent metadata fetch against a local moto S3 server.
+
+    python -m benchmarks.s3_fetch --objects 2000 --latency-ms 20
+
+moto answers from localhost, so ``--latency-ms`` adds a per-request delay to
+approximate the round trip to a real S3 region.
+"""
+import argparse
+import json
+import time
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+from common.s3 import S3_MAX_WORKERS, get_objects, make_client
+
+BUCKET = "benchmark-images"
+CREDENTIALS = {
+    "region_name": "us-east-1",
+    "aws_access_key_id": "testing",
+    "aws_secret_access_key": "testing",
+}
+
+
+def add_latency(client, latency_ms):
+    if latency_ms:
+        client.meta.events.register("before-send.s3.*", lambda **kwargs: time.sleep(latency_ms / 1000))
+
+
+def seed(s3, n_objects):
+    s3.create_bucket(Bucket=BUCKET)
+    keys = [f"metadata/image_{i:06d}.json" for i in range(n_objects)]
+    for key in keys:
+        metadata = {"filename": key.split("/")[-1], "tags": ["beach", "sunset"], "uploaded_at": "2025-01-01T00:00:00"}
+        s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(metadata))
+    return keys
+
+
+def fetch_serial(s3, keys):
+    return {key: s3.get_object(Bucket=BUCKET, Key=key)["Body"].read() for key in keys}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--objects", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=S3_MAX_WORKERS)
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    try:
+        endpoint = f"http://127.0.0.1:{args.port}"
+        keys = seed(boto3.client("s3", endpoint_url=endpoint, **CREDENTIALS), args.objects)
+
+        default_client = boto3.client("s3", endpoint_url=endpoint, **CREDENTIALS)
+        tuned_client = make_client(endpoint_url=endpoint, **CREDENTIALS)
+        add_latency(default_client, args.latency_ms)
+        add_latency(tuned_client, args.latency_ms)
+
+        start = time.perf_counter()
+        fetch_serial(default_client, keys)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        get_objects(tuned_client, BUCKET, keys, max_workers=args.workers)
+        concurrent = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    print(f"objects={args.objects} latency={args.latency_ms}ms workers={args.workers}")
+    print(f"serial (default client):     {serial:8.3f}s  {args.objects / serial:8.1f} obj/s")
+    print(f"concurrent (tuned client):   {concurrent:8.3f}s  {args.objects / concurrent:8.1f} obj/s")
+    print(f"speedup: {serial / concurrent:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
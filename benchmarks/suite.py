@@ -0,0 +1,321 @@
+"""Reproducible end-to-end benchmarks against an in-process moto S3.
+
+Seeds a synthetic bucket per size (images with metadata records in a
+HEIC/PNG/JPEG mix), drives every Flask app through its test client and the
+``gallery_edit/utils.py`` conversion helpers, and reports latency
+percentiles, throughput, S3 requests per operation and memory::
+
+    python -m benchmarks.suite --sizes 1000,10000 --output results.json
+    python -m benchmarks.suite --compare before.json after.json
+
+Only ``--samples`` images get real pixel data (used by the conversion
+scenarios); the rest have placeholder bodies, since the gallery routes
+never download image bytes.
+
+All scenarios share one process, so ``max_rss_mb`` is the process's
+high-water mark so far (cumulative over the earlier scenarios, not the
+scenario's own peak). ``rss_delta_mb`` is the change in resident memory
+across the scenario.
+"""
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "taiwo-images"  # gallery/app.py hard-codes its bucket
+SERVICES = ("uploader", "gallery", "gallery_view_only", "gallery_edit")
+TAGS = ["beach", "sunset", "family", "dog", "city", "mountain", "food", "party", "snow", "lake"]
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        extension, weight = part.split("=")
+        mix[extension.strip().lower()] = float(weight)
+    return mix
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def max_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    """Resident memory right now, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class RequestCounter:
+    """Counts S3 API calls per operation, optionally adding simulated latency."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.counts = Counter()
+
+    def attach(self, client):
+        client.meta.events.register("before-call.s3", self._before_call)
+
+    def _before_call(self, model, **kwargs):
+        self.counts[model.name] += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def reset(self):
+        self.counts = Counter()
+
+
+def sample_image(extension, size):
+    from PIL import Image
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+
+    image = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 60).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format={"heic": "HEIF", "png": "PNG", "jpeg": "JPEG", "jpg": "JPEG"}[extension])
+    return buffer.getvalue()
+
+
+def seed(s3, n_images, mix, n_samples, sample_size, rng):
+    extensions = list(mix)
+    weights = [mix[extension] for extension in extensions]
+    samples = {extension: sample_image(extension, sample_size) for extension in set(extensions)}
+    sample_keys = []
+    for i in range(n_images):
+        extension = rng.choices(extensions, weights)[0]
+        filename = f"img_{i:06d}.{extension}"
+        is_sample = i < n_samples
+        body = samples[extension] if is_sample else b"placeholder"
+        s3.put_object(Bucket=BUCKET, Key=f"images/{filename}", Body=body)
+        metadata = {
+            "filename": filename,
+            "tags": rng.sample(TAGS, rng.randint(1, 3)),
+            "uploaded_at": "2025-01-01T00:00:00",
+        }
+        s3.put_object(Bucket=BUCKET, Key=f"metadata/img_{i:06d}.json", Body=json.dumps(metadata))
+        if is_sample:
+            sample_keys.append(f"images/{filename}")
+    return sample_keys
+
+
+def load_service(service):
+    """Import ``<service>/app.py`` under a unique module name."""
+    service_dir = os.path.join(ROOT, service)
+    sys.path.insert(0, service_dir)
+    for name in ("utils", "batch", "planner", "jobs"):
+        sys.modules.pop(name, None)
+    try:
+        spec = importlib.util.spec_from_file_location(f"bench_{service}", os.path.join(service_dir, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(service_dir)
+    return module
+
+
+def measure(name, size, fn, iterations, counter):
+    counter.reset()
+    latencies = []
+    rss_before = current_rss_mb()
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+    result = {
+        "size": size,
+        "scenario": name,
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "throughput_per_s": round(iterations / elapsed, 3) if elapsed else None,
+        "s3_requests": dict(counter.counts),
+        "s3_requests_per_op": round(sum(counter.counts.values()) / iterations, 2),
+        "rss_delta_mb": round(current_rss_mb() - rss_before, 1) if rss_before is not None else None,
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+    print(f"{size:>7} {name:<34} p50={result['p50_ms']:>9.2f}ms p95={result['p95_ms']:>9.2f}ms "
+          f"{result['throughput_per_s'] or 0:>8.1f}/s s3/op={result['s3_requests_per_op']:>7} "
+          f"rss+={result['rss_delta_mb']}MB max_rss(cumulative)={result['max_rss_mb']}MB")
+    return result
+
+
+def run_size(size, args, rng):
+    import boto3
+    from moto import mock_aws
+
+    results = []
+    with mock_aws():
+        from common.s3 import get_client
+        get_client.cache_clear()
+
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        print(f"seeding {size} images...")
+        sample_keys = seed(s3, size, args.mix, min(args.samples, size), args.sample_size, rng)
+
+        counter = RequestCounter(args.latency_ms)
+        counter.attach(get_client())
+        apps = {service: load_service(service) for service in SERVICES}
+        clients = {service: module.app.test_client() for service, module in apps.items()}
+        utils = sys.modules["utils"]
+
+        def get(service, path):
+            def request(_):
+                response = clients[service].get(path)
+                assert response.status_code == 200, (service, path, response.status_code)
+            return request
+
+        # the very first render has to build the metadata index
+        results.append(measure("gallery_view_only GET / (cold index)", size,
+                               get("gallery_view_only", "/"), 1, counter))
+        view_only = apps["gallery_view_only"]
+
+        def uncached(path):
+            def request(i):
+                view_only.cache.clear()
+                get("gallery_view_only", path)(i)
+            return request
+
+        results.append(measure("gallery_view_only GET / (miss)", size, uncached("/"), args.iterations, counter))
+        results.append(measure("gallery_view_only GET / (hit)", size,
+                               get("gallery_view_only", "/"), args.iterations, counter))
+        results.append(measure("gallery_view_only search beach sun*", size,
+                               uncached("/api/images?search=beach+sun*"), args.iterations, counter))
+        results.append(measure("gallery GET /", size, get("gallery", "/"), args.iterations, counter))
+        results.append(measure("gallery_edit GET /", size, get("gallery_edit", "/"), args.iterations, counter))
+
+        def update_tags(i):
+            response = clients["gallery_edit"].post(
+                "/update", data={"filename": f"img_{i % size:06d}.jpeg", "tags": "beach, bench"})
+            assert response.status_code == 200
+        results.append(measure("gallery_edit POST /update", size, update_tags, args.iterations, counter))
+
+        def upload(i):
+            response = clients["uploader"].post("/", data={
+                "image": (io.BytesIO(b"placeholder"), f"upload_{i:06d}.jpeg"), "tags": "beach"})
+            assert response.status_code == 302
+        results.append(measure("uploader POST /", size, upload, args.iterations, counter))
+
+        heic_keys = [key for key in sample_keys if key.endswith(".heic")]
+        if heic_keys:
+            def convert(output_format):
+                def run(i):
+                    key = heic_keys[i % len(heic_keys)]
+                    utils.convert_heic_from_s3(BUCKET, key, output_format=output_format, save_to_s3=True,
+                                               output_bucket=BUCKET, output_key=f"bench/{i}.{output_format.lower()}")
+                return run
+            results.append(measure("convert_heic_from_s3 PNG", size, convert("PNG"), args.conversions, counter))
+            results.append(measure("convert_heic_from_s3 JPEG", size, convert("JPEG"), args.conversions, counter))
+        if sample_keys:
+            def thumbnail(i):
+                utils.generate_thumbnail(BUCKET, sample_keys[i % len(sample_keys)],
+                                         target_key=f"bench/thumb_{i}", size=(300, 300))
+            results.append(measure("generate_thumbnail 300px", size, thumbnail, args.conversions, counter))
+    return results
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {(r["size"], r["scenario"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    print(f"{'size':>7} {'scenario':<34} {'p50 before':>11} {'p50 after':>10} {'change':>8} {'s3/op':>14}")
+    for result in after:
+        old = before.get((result["size"], result["scenario"]))
+        if old is None:
+            continue
+        change = (result["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100 if old["p50_ms"] else 0
+        print(f"{result['size']:>7} {result['scenario']:<34} {old['p50_ms']:>10.2f}ms {result['p50_ms']:>9.2f}ms "
+              f"{change:>+7.1f}% {old['s3_requests_per_op']:>6}->{result['s3_requests_per_op']:<6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000", help="comma separated bucket sizes, e.g. 1000,10000,100000")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("heic=0.4,png=0.3,jpeg=0.3"))
+    parser.add_argument("--iterations", type=int, default=20, help="requests per gallery scenario")
+    parser.add_argument("--conversions", type=int, default=5, help="runs per conversion scenario")
+    parser.add_argument("--samples", type=int, default=10, help="images seeded with real pixel data")
+    parser.add_argument("--sample-size", default="2016x1512", help="WxH of the real sample images")
+    parser.add_argument("--latency-ms", type=float, default=0, help="simulated S3 round trip per request")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.sample_size = tuple(int(part) for part in args.sample_size.lower().split("x"))
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "S3_BUCKET": BUCKET,
+        "BUCKET_FOLDER": "",
+        "CACHE_DIR": os.path.join("/tmp", f"gallery-bench-cache-{os.getpid()}"),
+        "SNAPSHOT_DIR": os.path.join("/tmp", f"gallery-bench-snapshots-{os.getpid()}"),
+        "INDEX_POLL_INTERVAL": "0",
+    })
+    sys.path.insert(0, ROOT)
+
+    rng = random.Random(args.seed)
+    results = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        results.extend(run_size(size, args, rng))
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "params": {
+                "sizes": args.sizes,
+                "mix": args.mix,
+                "iterations": args.iterations,
+                "conversions": args.conversions,
+                "samples": args.samples,
+                "sample_size": "x".join(map(str, args.sample_size)),
+                "latency_ms": args.latency_ms,
+                "seed": args.seed,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
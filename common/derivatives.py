@@ -0,0 +1,93 @@
+"""Single-decode, multi-size web derivatives.
+
+Each original is decoded once, at the smallest resolution the codec can
+produce that still covers the largest requested size (JPEG draft mode,
+``Image.reduce`` for everything else). Every configured size is then
+resampled from that one decoded image and encoded as WebP, so galleries
+never have to ship the multi-megabyte originals.
+
+Derivatives live at ``{bucket_folder}derivatives/{size}/{stem}.webp``.
+"""
+from io import BytesIO
+import math
+import os
+
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+from common.encoding import encode
+from common.metrics import timed
+from common.s3 import object_args
+
+register_heif_opener()
+
+DERIVATIVES_FOLDER = "derivatives/"
+DERIVATIVE_SIZES = {
+    "thumbnail": int(os.getenv("DERIVATIVE_THUMBNAIL_SIZE", 300)),
+    "medium": int(os.getenv("DERIVATIVE_MEDIUM_SIZE", 800)),
+    "large": int(os.getenv("DERIVATIVE_LARGE_SIZE", 1600)),
+}
+DERIVATIVE_FORMAT = os.getenv("DERIVATIVE_FORMAT", "WEBP")
+# 0 uses the quality of the encode profile
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", 0)) or None
+
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png", "AVIF": "avif"}
+
+
+def derivative_key(bucket_folder, filename, size, output_format=DERIVATIVE_FORMAT):
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return f"{bucket_folder or ''}{DERIVATIVES_FOLDER}{size}/{stem}.{EXTENSIONS[output_format.upper()]}"
+
+
+def derivative_keys(bucket_folder, filename, sizes=DERIVATIVE_SIZES, output_format=DERIVATIVE_FORMAT):
+    return {size: derivative_key(bucket_folder, filename, size, output_format) for size in sizes}
+
+
+def open_reduced(fp, max_edge):
+    """Open an image decoding as few pixels as possible for a ``max_edge`` box."""
+    image = Image.open(fp)
+    scale = max_edge / max(image.size)
+    if scale < 1:
+        # JPEG only: let libjpeg scale by 1/2, 1/4 or 1/8 while decoding
+        image.draft(None, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    # reduce() can't handle palette, bilevel or 16-bit images; convert() keeps the EXIF orientation
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    if scale < 1:
+        factor = max(image.size) // max_edge
+        if factor >= 2:
+            image = image.reduce(factor)
+    return ImageOps.exif_transpose(image)
+
+
+@timed("render_derivatives")
+def render_derivatives(image_bytes, sizes=DERIVATIVE_SIZES, output_format=DERIVATIVE_FORMAT,
+                       quality=DERIVATIVE_QUALITY, profile=None):
+    """Return ``{size name: encoded bytes}`` from a single decode of ``image_bytes``.
+
+    ``profile`` names an encode profile (``common.encoding.PROFILES``).
+    """
+    image = open_reduced(BytesIO(image_bytes), max(sizes.values()))
+    if output_format.upper() == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    outputs = {}
+    # largest first, so every size is resampled from the previous, smaller image
+    for name, edge in sorted(sizes.items(), key=lambda item: -item[1]):
+        image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        encode(image, buffer, output_format, profile, quality)
+        outputs[name] = buffer.getvalue()
+    image.close()
+    return outputs
+
+
+def generate_derivatives(s3, bucket, source_key, bucket_folder, sizes=DERIVATIVE_SIZES,
+                         output_format=DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY, profile=None):
+    """Download ``source_key`` once and upload every derivative; returns ``{size: key}``."""
+    image_bytes = s3.get_object(Bucket=bucket, Key=source_key)["Body"].read()
+    outputs = render_derivatives(image_bytes, sizes, output_format, quality, profile)
+    del image_bytes
+    keys = derivative_keys(bucket_folder, source_key, sizes, output_format)
+    for name, data in outputs.items():
+        s3.put_object(Bucket=bucket, Key=keys[name], Body=data, **object_args(keys[name]))
+    return keys
@@ -0,0 +1,175 @@
+"""Perceptual-hash duplicate detection.
+
+The same photo often lands in the bucket several times: the HEIC from the
+phone, the PNG and JPEG converted from it, or a re-upload under another name.
+Every image gets a 64-bit difference hash (dHash) from a tiny decode (JPEG
+draft mode / ``Image.reduce``), stored as hex on its metadata record under
+``phash``. Two hashes at most ``DUPLICATE_DISTANCE`` bits apart are taken to
+be the same picture. Flat or low-detail images (a blank frame, a clear sky)
+hash to almost all zero or all one bits whatever they show, so hashes with
+fewer than ``DUPLICATE_MIN_BITS`` bits set or clear never match anything.
+
+Hashes are packed into one ``uint64`` array. A lookup XORs the query against
+the whole array and counts bits with a byte lookup table, a single vectorized
+pass even over 100k images. Grouping an entire index uses multi-index hashing:
+each hash is split into ``DUPLICATE_DISTANCE + 1`` bands, and near-duplicates
+always agree exactly on at least one band. Only images sharing a band value
+are compared.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+from common.derivatives import open_reduced
+from common.metadata_index import metadata_stem
+from common.metrics import timed
+
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", 4))
+DUPLICATE_MIN_BITS = int(os.getenv("DUPLICATE_MIN_BITS", 8))
+HASH_BITS = 64
+# the decode only has to cover the 9x8 hash grid
+HASH_DECODE_EDGE = 64
+
+# extensions that are the same target format
+SAME_FORMAT = {".jpeg": ".jpg", ".heif": ".heic"}
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image):
+    """Hex dHash of a PIL image: whether each pixel of a 9x8 grayscale grid is brighter than its left neighbour."""
+    small = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+    bits = small[:, 1:] > small[:, :-1]
+    return np.packbits(bits).tobytes().hex()
+
+
+@timed("image_hash")
+def image_hash(fp):
+    """dHash of an image file, decoding as few pixels as the codec allows."""
+    image = open_reduced(fp, HASH_DECODE_EDGE)
+    try:
+        return dhash(image)
+    finally:
+        image.close()
+
+
+def informative(phash, min_bits=DUPLICATE_MIN_BITS):
+    """Whether ``phash`` has enough set and clear bits to tell pictures apart."""
+    if not phash:
+        return False
+    bits = bin(int(phash, 16)).count("1")
+    return min_bits <= bits <= HASH_BITS - min_bits
+
+
+def _popcount(values):
+    return _POPCOUNT[np.ascontiguousarray(values).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def hamming(packed, value):
+    """Bit distances between every hash in ``packed`` and ``value``."""
+    return _popcount(np.bitwise_xor(packed, np.uint64(value)))
+
+
+class HashIndex:
+    """Near-duplicate search over a list of hex hashes (None where an image has none).
+
+    Hashes that aren't ``informative`` are left out, like missing ones.
+    """
+
+    def __init__(self, hashes):
+        hashes = [value if informative(value) else None for value in hashes]
+        self.ids = np.array([i for i, value in enumerate(hashes) if value], dtype=np.int64)
+        self.packed = np.array([int(value, 16) for value in hashes if value], dtype=np.uint64)
+        self.size = len(hashes)
+
+    def near(self, phash, max_distance=DUPLICATE_DISTANCE):
+        """Ids of the images within ``max_distance`` bits of ``phash``, closest first."""
+        if not informative(phash) or not len(self.packed):
+            return []
+        distances = hamming(self.packed, int(phash, 16))
+        matches = np.flatnonzero(distances <= max_distance)
+        return self.ids[matches[np.argsort(distances[matches], kind="stable")]].tolist()
+
+    def groups(self, max_distance=DUPLICATE_DISTANCE):
+        """The representative (lowest id) of every image's duplicate group; unhashed images stand alone."""
+        parent = list(range(self.size))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(a, b):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+        # identical hashes first, so images hashing alike (blank frames) don't make band runs quadratic
+        unique, inverse = np.unique(self.packed, return_inverse=True)
+        first = {}
+        for image_id, slot in zip(self.ids.tolist(), inverse.tolist()):
+            union(first.setdefault(slot, image_id), image_id)
+        members = [first[slot] for slot in range(len(unique))]
+
+        bands = max_distance + 1
+        width = -(-HASH_BITS // bands)
+        for band in range(bands):
+            shift = band * width
+            if shift >= HASH_BITS:
+                break
+            values = (unique >> np.uint64(shift)) & np.uint64((1 << min(width, HASH_BITS - shift)) - 1)
+            order = np.argsort(values, kind="stable")
+            values = values[order]
+            # sorted, so hashes sharing the band value are adjacent: compare every
+            # hash with the one ``offset`` places on, for all hashes at once
+            for offset in range(1, len(order)):
+                same = values[offset:] == values[:-offset]
+                if not same.any():
+                    break
+                a, b = order[:-offset][same], order[offset:][same]
+                close = _popcount(unique[a] ^ unique[b]) <= max_distance
+                for i, j in zip(a[close].tolist(), b[close].tolist()):
+                    union(members[i], members[j])
+        return [find(i) for i in range(self.size)]
+
+
+def representatives(images, max_distance=DUPLICATE_DISTANCE):
+    """``{stem: representative stem}`` for the index ``images`` (``{stem: metadata}``) that duplicate another.
+
+    Images are numbered in stem order, like TagIndex and Snapshot ids, so every
+    service agrees on which image represents a group.
+    """
+    stems = sorted(images)
+    groups = HashIndex(images[stem].get("phash") for stem in stems).groups(max_distance)
+    return {stems[i]: stems[group] for i, group in enumerate(groups) if group != i}
+
+
+def _format(key):
+    extension = os.path.splitext(key)[1].lower()
+    return SAME_FORMAT.get(extension, extension)
+
+
+def redundant_work(work, images, existing_keys, max_distance=DUPLICATE_DISTANCE):
+    """Planned conversions whose picture already exists as a near-duplicate with the target's extension.
+
+    ``work`` comes from the planner, ``images`` is the index's
+    ``{stem: metadata}`` and ``existing_keys`` the keys the target may
+    already exist under. A task's own (stale) target is not counted.
+    """
+    by_extension = {}
+    for key in existing_keys:
+        phash = images.get(metadata_stem(key), {}).get("phash")
+        if phash:
+            by_extension.setdefault(_format(key), []).append((key, phash))
+    indexes = {extension: ([key for key, _ in keyed], HashIndex(phash for _, phash in keyed))
+               for extension, keyed in by_extension.items()}
+
+    redundant = []
+    for task in work:
+        phash = images.get(metadata_stem(task.source_key), {}).get("phash")
+        keys, index = indexes.get(_format(task.target_key), ([], None))
+        if index is not None and any(keys[i] != task.target_key for i in index.near(phash, max_distance)):
+            redundant.append(task)
+    return redundant
@@ -0,0 +1,106 @@
+"""Named encoder effort profiles.
+
+Encoding, not decoding, is where bulk conversions spend most of their CPU
+time: ``optimize=True`` PNG tries every zlib strategy at level 9, and JPEG's
+``optimize`` and ``progressive`` each add a pass over the coefficients.
+Profiles bundle the settings for every output format:
+
+- ``fast``: low zlib effort, baseline JPEG and the quickest WebP method, for
+  bulk backfills.
+- ``balanced``: the default (``ENCODE_PROFILE``). Typical sizes, but without
+  PNG's exhaustive search.
+- ``archival``: the smallest files, with full JPEG chroma and the slowest
+  WebP method.
+
+libwebp's lossy mode is always 4:2:0. The archival profile uses sharp
+RGB->YUV conversion for WebP, which is the closest it gets to 4:4:4.
+
+``measure`` encodes sample images with every profile, so the choice can be
+made from encode time versus bytes on the real bucket (see
+``benchmarks/encoders.py`` and the Streamlit sidebar).
+"""
+from io import BytesIO
+import os
+import time
+
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+register_heif_opener()
+
+PROFILES = {
+    "fast": {
+        "PNG": {"compress_level": 1},
+        "JPEG": {"quality": 85, "optimize": False, "progressive": False, "subsampling": "4:2:0"},
+        "WEBP": {"quality": 75, "method": 1},
+    },
+    "balanced": {
+        "PNG": {"compress_level": 6},
+        "JPEG": {"quality": 90, "optimize": True, "progressive": True, "subsampling": "4:2:0"},
+        "WEBP": {"quality": 80, "method": 4},
+    },
+    "archival": {
+        "PNG": {"optimize": True},
+        "JPEG": {"quality": 95, "optimize": True, "progressive": True, "subsampling": "4:4:4"},
+        "WEBP": {"quality": 90, "method": 6, "use_sharp_yuv": True},
+    },
+}
+ENCODE_PROFILE = os.getenv("ENCODE_PROFILE", "balanced")
+MEASURE_FORMATS = ("PNG", "JPEG", "WEBP")
+
+
+def save_options(output_format, profile=None, quality=None):
+    """``Image.save`` keyword arguments for ``output_format`` under ``profile``.
+
+    ``quality`` overrides the profile's quality. Formats a profile does not
+    cover (such as HEIF thumbnails of HEIC sources) use the Pillow defaults.
+    """
+    profile = profile or ENCODE_PROFILE
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown encode profile {profile!r}. Use one of: {', '.join(PROFILES)}.")
+    options = dict(PROFILES[profile].get(output_format.upper(), {}))
+    if quality is not None:
+        options["quality"] = quality
+    return options
+
+
+def encode(image, fp, output_format, profile=None, quality=None):
+    """Save ``image`` to ``fp`` with the settings of ``profile``."""
+    image.save(fp, format=output_format, **save_options(output_format, profile, quality))
+
+
+def measure(sources, formats=MEASURE_FORMATS, profiles=tuple(PROFILES)):
+    """Encode every source (bytes or file objects) with each profile and format.
+
+    Each source is decoded once. Returns one row per ``(profile, format)``:
+    ``{"profile", "format", "images", "seconds", "bytes", "ms_per_image", "bytes_per_image"}``.
+    """
+    totals = {(profile, output_format): [0, 0.0, 0] for profile in profiles for output_format in formats}
+    for source in sources:
+        with Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as opened:
+            image = ImageOps.exif_transpose(opened)
+            image.load()
+        rgb = image if image.mode == "RGB" else image.convert("RGB")
+        for (profile, output_format), total in totals.items():
+            buffer = BytesIO()
+            # JPEG has no alpha channel
+            target = rgb if output_format == "JPEG" else image
+            started = time.perf_counter()
+            encode(target, buffer, output_format, profile)
+            total[0] += 1
+            total[1] += time.perf_counter() - started
+            total[2] += buffer.tell()
+        image.close()
+        rgb.close()
+    return [
+        {
+            "profile": profile,
+            "format": output_format,
+            "images": count,
+            "seconds": round(seconds, 4),
+            "bytes": size,
+            "ms_per_image": round(seconds / count * 1000, 1) if count else None,
+            "bytes_per_image": size // count if count else None,
+        }
+        for (profile, output_format), (count, seconds, size) in totals.items()
+    ]
@@ -0,0 +1,55 @@
+"""HTTP validators for gallery pages.
+
+Gallery responses are a pure function of the request URL and the metadata
+index generation, so the ETag is derived from both and ``Last-Modified`` is
+the time of the last index write. A request whose validators still match
+gets a 304 before the view runs at all.
+
+A view may answer from an older version (a stale cache entry, see
+``common.response_cache``); its response then says so in ``cache_version``
+and gets the ETag of that version and no ``Last-Modified``, so revalidating
+it can't turn the stale body into a 304 for the current version.
+"""
+from functools import wraps
+import hashlib
+
+from flask import make_response, request
+from werkzeug.http import is_resource_modified
+
+from common.metrics import count_cache
+
+# browsers may keep the page but must revalidate it on every visit
+GALLERY_CACHE_CONTROL = "no-cache"
+
+
+def version_etag(version):
+    return hashlib.sha1(f"{version}:{request.full_path}".encode()).hexdigest()
+
+
+def conditional(state, cache_control=GALLERY_CACHE_CONTROL):
+    """Decorate a view with ETag/Last-Modified handling.
+
+    ``state()`` returns ``(version, last_modified)`` describing everything the
+    response depends on besides the URL; ``last_modified`` may be None.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            version, last_modified = state()
+            etag = version_etag(version)
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                count_cache("http", "not_modified")
+                response = make_response("", 304)
+            else:
+                count_cache("http", "modified")
+                response = make_response(f(*args, **kwargs))
+                served = getattr(response, "cache_version", version)
+                if served != version:
+                    etag, last_modified = version_etag(served), None
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.headers["Cache-Control"] = cache_control
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,387 @@
+"""Header-only image facts: capture time, dimensions, orientation and camera.
+
+Only the first ``IMAGE_HEADER_BYTES`` of an object are fetched, with a ranged
+GET, and Pillow opens them lazily, so no pixels are ever decoded. The range
+grows (up to ``MAX_HEADER_BYTES``) only for files whose headers don't fit.
+HEIC/HEIF keep their metadata in ISOBMFF boxes, which Pillow can't open
+truncated, so those boxes are walked directly. The size comes from the
+primary item's ``ispe``/``irot`` properties, and the EXIF item is fetched
+with one more ranged GET of its ``iloc`` extent.
+
+The facts are stored on the image's metadata record, so galleries can sort
+and filter by them (``arrange``) without touching the images.
+"""
+from datetime import datetime
+from io import BytesIO
+import os
+import struct
+
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, UnidentifiedImageError
+from PIL.ExifTags import IFD, Base
+
+from common.s3 import is_missing
+
+IMAGE_HEADER_BYTES = int(os.getenv("IMAGE_HEADER_BYTES", 64 * 1024))
+MAX_HEADER_BYTES = 4 * 1024 * 1024
+INFO_FIELDS = ("taken_at", "width", "height", "orientation", "camera")
+
+HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"mif1", b"msf1", b"avif"}
+# EXIF orientations that turn the stored image by 90 degrees
+TRANSPOSED = (5, 6, 7, 8)
+
+SORTS = {
+    # newest first; images without the field go last
+    "taken": ("taken_at", True),
+    "uploaded": ("uploaded_at", True),
+    "name": (None, False),
+}
+SHAPES = ("landscape", "portrait", "square")
+
+
+class _FileReader:
+    def __init__(self, fp):
+        self.fp = fp
+
+    def read_at(self, offset, length):
+        self.fp.seek(offset)
+        return self.fp.read(length)
+
+
+class _ObjectReader:
+    """Ranged reads of an S3 object; the leading bytes are kept and extended as needed."""
+
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = None
+        self._head = b""
+
+    def _get(self, start, end):
+        if self.size is not None and start >= self.size:
+            return b""
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}")
+        except ClientError as e:
+            # a range starting at or past the end, e.g. any range of an empty object
+            if e.response.get("Error", {}).get("Code") not in ("InvalidRange", "416"):
+                raise
+            self.size = min(start, self.size) if self.size is not None else start
+            return b""
+        body = obj["Body"].read()
+        content_range = obj.get("ContentRange")
+        self.size = int(content_range.rsplit("/", 1)[1]) if content_range else start + len(body)
+        return body
+
+    def read_at(self, offset, length):
+        end = offset + length
+        complete = self.size is not None and len(self._head) >= self.size
+        if end <= len(self._head) or complete:
+            return self._head[offset:end]
+        if offset <= len(self._head) and end <= MAX_HEADER_BYTES:
+            self._head += self._get(len(self._head), max(end, IMAGE_HEADER_BYTES))
+            return self._head[offset:end]
+        return self._get(offset, end)
+
+
+def _taken_at(value, offset=None):
+    try:
+        taken = datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S").isoformat()
+    except ValueError:
+        # cameras without a clock write "0000:00:00 00:00:00"
+        return None
+    return taken + str(offset).strip("\x00 ") if offset else taken
+
+
+def _exif_info(exif_bytes):
+    exif = Image.Exif()
+    exif.load(exif_bytes)
+    exif_ifd = exif.get_ifd(IFD.Exif)
+    info = {}
+    for tag, offset_tag in ((Base.DateTimeOriginal, Base.OffsetTimeOriginal),
+                            (Base.DateTimeDigitized, Base.OffsetTimeDigitized)):
+        if tag in exif_ifd:
+            info["taken_at"] = _taken_at(exif_ifd[tag], exif_ifd.get(offset_tag))
+            break
+    else:
+        if Base.DateTime in exif:
+            info["taken_at"] = _taken_at(exif[Base.DateTime], exif_ifd.get(Base.OffsetTime))
+    make = str(exif.get(Base.Make) or "").strip("\x00 ")
+    model = str(exif.get(Base.Model) or "").strip("\x00 ")
+    if make or model:
+        info["camera"] = model if model.startswith(make) else f"{make} {model}".strip()
+    if Base.Orientation in exif:
+        info["orientation"] = int(exif[Base.Orientation])
+    return info
+
+
+def _pillow_info(reader):
+    length = IMAGE_HEADER_BYTES
+    while True:
+        head = reader.read_at(0, length)
+        try:
+            with Image.open(BytesIO(head)) as image:
+                # Image.open reads the headers only; nothing here decodes pixels
+                width, height = image.size
+                exif = image.info.get("exif")
+            break
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            if len(head) < length or length >= MAX_HEADER_BYTES:
+                raise
+            length *= 4
+    info = _exif_info(exif) if exif else {}
+    if info.get("orientation") in TRANSPOSED:
+        width, height = height, width
+    info.update(width=width, height=height)
+    return info
+
+
+def _boxes(data, start=0, end=None):
+    """Yield ``(type, payload start, payload end)`` for the ISOBMFF boxes in ``data[start:end]``."""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            size, header = struct.unpack_from(">Q", data, start + 8)[0], 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, min(start + size, end)
+        start += size
+
+
+def _uint(data, offset, size):
+    return int.from_bytes(data[offset:offset + size], "big") if size else 0
+
+
+def _parse_iloc(data):
+    """``{item id: (construction method, base offset, [(offset, length), ...])}``"""
+    version = data[0]
+    offset_size, length_size = data[4] >> 4, data[4] & 15
+    base_offset_size, index_size = data[5] >> 4, (data[5] & 15 if version in (1, 2) else 0)
+    position = 6
+    count_size = 2 if version < 2 else 4
+    item_count = _uint(data, position, count_size)
+    position += count_size
+    items = {}
+    for _ in range(item_count):
+        item_id = _uint(data, position, count_size)
+        position += count_size
+        method = 0
+        if version in (1, 2):
+            method = _uint(data, position, 2) & 15
+            position += 2
+        position += 2  # data reference index
+        base_offset = _uint(data, position, base_offset_size)
+        position += base_offset_size
+        extent_count = _uint(data, position, 2)
+        position += 2
+        extents = []
+        for _ in range(extent_count):
+            position += index_size
+            extent_offset = _uint(data, position, offset_size)
+            position += offset_size
+            extents.append((extent_offset, _uint(data, position, length_size)))
+            position += length_size
+        items[item_id] = (method, base_offset, extents)
+    return items
+
+
+def _parse_iinf(data):
+    """``{item id: item type}``"""
+    version = data[0]
+    position = 4 + (2 if version == 0 else 4)
+    items = {}
+    for kind, start, end in _boxes(data, position):
+        if kind != b"infe" or data[start] < 2:
+            continue
+        id_size = 2 if data[start] == 2 else 4
+        item_id = _uint(data, start + 4, id_size)
+        items[item_id] = data[start + 4 + id_size + 2:start + 4 + id_size + 6]
+    return items
+
+
+def _parse_ipma(data):
+    """``{item id: [1-based property index, ...]}``"""
+    version, flags = data[0], _uint(data, 1, 3)
+    position = 4
+    entry_count = _uint(data, position, 4)
+    position += 4
+    associations = {}
+    for _ in range(entry_count):
+        id_size = 2 if version < 1 else 4
+        item_id = _uint(data, position, id_size)
+        position += id_size
+        count = data[position]
+        position += 1
+        indices = []
+        for _ in range(count):
+            if flags & 1:
+                indices.append(_uint(data, position, 2) & 0x7FFF)
+                position += 2
+            else:
+                indices.append(data[position] & 0x7F)
+                position += 1
+        associations[item_id] = indices
+    return associations
+
+
+def _heif_info(reader):
+    offset = 0
+    while True:
+        header = reader.read_at(offset, 16)
+        if len(header) < 8:
+            raise ValueError("no meta box")
+        size, kind = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size, header_size = struct.unpack_from(">Q", header, 8)[0], 16
+        if kind == b"meta":
+            if size > MAX_HEADER_BYTES:
+                raise ValueError("meta box too large")
+            meta = reader.read_at(offset + header_size, size - header_size)
+            break
+        if size < header_size:
+            raise ValueError("malformed box")
+        offset += size
+
+    # meta is a full box: skip its version and flags
+    boxes = {kind: meta[start:end] for kind, start, end in _boxes(meta, 4)}
+    pitm = boxes.get(b"pitm", b"")
+    primary = _uint(pitm, 4, 2 if pitm[:1] == b"\x00" else 4)
+    items = _parse_iinf(boxes.get(b"iinf", b"\x00" * 6))
+    locations = _parse_iloc(boxes[b"iloc"]) if b"iloc" in boxes else {}
+
+    properties, associations = [], {}
+    iprp = boxes.get(b"iprp", b"")
+    for kind, start, end in _boxes(iprp):
+        if kind == b"ipco":
+            properties = [(child, iprp[child_start:child_end]) for child, child_start, child_end in _boxes(iprp, start, end)]
+        elif kind == b"ipma":
+            associations.update(_parse_ipma(iprp[start:end]))
+
+    info = {}
+    rotation = 0
+    for index in associations.get(primary, []):
+        if not 0 < index <= len(properties):
+            continue
+        kind, payload = properties[index - 1]
+        if kind == b"ispe":
+            info["width"], info["height"] = struct.unpack_from(">II", payload, 4)
+        elif kind == b"irot":
+            rotation = payload[0] & 3
+
+    exif_items = [item_id for item_id, item_type in items.items() if item_type == b"Exif"]
+    if exif_items and exif_items[0] in locations:
+        method, base_offset, extents = locations[exif_items[0]]
+        if method == 0:
+            payload = b"".join(reader.read_at(base_offset + start, length) for start, length in extents)
+        else:
+            idat = boxes.get(b"idat", b"")
+            payload = b"".join(idat[base_offset + start:base_offset + start + length] for start, length in extents)
+        if len(payload) > 4:
+            # the payload starts with the offset of the TIFF header
+            info.update(_exif_info(payload[4 + _uint(payload, 0, 4):]))
+
+    # HEIF viewers apply irot; the EXIF orientation is informational only
+    if rotation % 2 and "width" in info:
+        info["width"], info["height"] = info["height"], info["width"]
+    return info
+
+
+def _read_info(reader):
+    head = reader.read_at(0, 16)
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        info = _heif_info(reader)
+    else:
+        info = _pillow_info(reader)
+    return {field: info[field] for field in INFO_FIELDS if info.get(field) is not None}
+
+
+def image_info(fp):
+    """Header facts of an image in a seekable file; ``{}`` if it can't be read."""
+    try:
+        return _read_info(_FileReader(fp))
+    except Exception as e:
+        # whatever the parsers trip over in a malformed header, the image just has no facts
+        print(f"could not read image header: {e!r}")
+        return {}
+
+
+def fetch_image_info(s3, bucket, key):
+    """Header facts of an S3 image, read with ranged GETs; ``{}`` if it can't be read."""
+    try:
+        return _read_info(_ObjectReader(s3, bucket, key))
+    except ClientError as e:
+        # S3 and connection failures other than a missing key are worth retrying, so they propagate
+        if is_missing(e):
+            return {}
+        raise
+    except BotoCoreError:
+        raise
+    except Exception as e:
+        print(f"could not read image header of {key}: {e!r}")
+        return {}
+
+
+def image_shape(width, height):
+    if not width or not height:
+        return None
+    return "square" if width == height else ("landscape" if width > height else "portrait")
+
+
+def view_options(args):
+    """Sort and filter options of a gallery request's query string, for ``arrange``."""
+    sort = args.get("sort", "")
+    return {
+        # near-duplicates are shown once unless ?duplicates=show
+        "collapse": args.get("duplicates") != "show",
+        "sort": sort if sort in SORTS else None,
+        "shape": args.get("shape") if args.get("shape") in SHAPES else None,
+        "camera": args.get("camera", "").strip().lower() or None,
+        "taken_after": args.get("taken_after") or None,
+        "taken_before": args.get("taken_before") or None,
+    }
+
+
+def arrange(index, image_ids, sort=None, shape=None, camera=None, taken_after=None, taken_before=None,
+            collapse=False):
+    """Filter and order ``image_ids`` of ``index`` by the header facts stored in the index.
+
+    ``taken_after``/``taken_before`` are ISO dates (or datetimes) compared
+    with ``taken_at``; ``camera`` matches a substring, case-insensitively.
+    ``collapse`` keeps only the first image of each group of near-duplicates.
+    """
+    field = index.field
+    if shape:
+        image_ids = [image_id for image_id in image_ids
+                     if image_shape(field(image_id, "width"), field(image_id, "height")) == shape]
+    if camera:
+        image_ids = [image_id for image_id in image_ids if camera in (field(image_id, "camera") or "").lower()]
+    if taken_after or taken_before:
+        def in_range(image_id):
+            taken = field(image_id, "taken_at")
+            if not taken:
+                return False
+            # compare at the precision the bound was given in
+            return ((not taken_after or taken[:len(taken_after)] >= taken_after)
+                    and (not taken_before or taken[:len(taken_before)] <= taken_before))
+        image_ids = [image_id for image_id in image_ids if in_range(image_id)]
+    name, descending = SORTS.get(sort, (None, False))
+    if name:
+        known = [image_id for image_id in image_ids if field(image_id, name)]
+        missing = [image_id for image_id in image_ids if not field(image_id, name)]
+        image_ids = sorted(known, key=lambda image_id: field(image_id, name), reverse=descending) + missing
+    if collapse:
+        seen = set()
+        kept = []
+        for image_id in image_ids:
+            group = index.representative(image_id)
+            if group not in seen:
+                seen.add(group)
+                kept.append(image_id)
+        image_ids = kept
+    return list(image_ids)
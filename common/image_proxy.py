@@ -0,0 +1,229 @@
+"""On-demand resized variants of bucket images, cached on local disk.
+
+``/img/<key>?w=400&fmt=webp`` renders the variant with Pillow on first
+request and keeps it in a directory capped at ``IMG_CACHE_MAX_MB``; the
+least recently served files are evicted first. Hits are served with
+``send_file``, which handles Range and conditional requests. Concurrent
+requests for one variant, from any thread or gunicorn worker on the host,
+take the same file lock, so it is only rendered once.
+
+Widths snap up to one of ``IMG_WIDTHS`` so arbitrary ``w`` values can't fill
+the cache with near-duplicates. Variants are cached under the source's ETag
+(checked at most every ``IMG_SOURCE_TTL`` seconds), so replacing an original
+renders new ones instead of serving the old picture until eviction.
+"""
+import fcntl
+import hashlib
+from io import BytesIO
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from flask import abort, request, send_file
+from PIL import Image, UnidentifiedImageError
+
+from common.derivatives import EXTENSIONS, open_reduced
+from common.memory import conversion_budget, image_footprint
+from common.metrics import count_cache, timed
+from common.s3 import is_missing
+
+IMG_CACHE_DIR = os.getenv("IMG_CACHE_DIR", "/tmp/gallery-img-cache")
+IMG_CACHE_MAX_BYTES = int(os.getenv("IMG_CACHE_MAX_MB", 1024)) * 1024 * 1024
+IMG_WIDTHS = sorted(int(w) for w in os.getenv("IMG_WIDTHS", "100,200,300,400,600,800,1200,1600,2400").split(","))
+IMG_FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG", "png": "PNG"}
+IMG_QUALITY = int(os.getenv("IMG_QUALITY", 80))
+# variants of one key may change when the original is replaced, so browsers only cache them briefly
+IMG_MAX_AGE = int(os.getenv("IMG_MAX_AGE", 300))
+# how long (seconds) a source's ETag is trusted before it is checked with a HEAD again
+IMG_SOURCE_TTL = int(os.getenv("IMG_SOURCE_TTL", 60))
+LOCK_STRIPES = 256
+
+
+def snap_width(width):
+    for allowed in IMG_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return IMG_WIDTHS[-1]
+
+
+@timed("render_variant")
+def render_variant(image_bytes, width, output_format, quality=IMG_QUALITY):
+    image = open_reduced(BytesIO(image_bytes), width)
+    image.thumbnail((width, width), Image.Resampling.LANCZOS)
+    if output_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    if output_format == "PNG":
+        image.save(buffer, format="PNG")
+    else:
+        image.save(buffer, format=output_format, quality=quality)
+    image.close()
+    return buffer.getvalue()
+
+
+class DiskLRUCache:
+    """Files in ``directory`` with a total size cap; a file's atime is its last use.
+
+    The mtime is left alone because ``send_file`` derives ETag and
+    Last-Modified from it.
+    """
+
+    def __init__(self, directory=IMG_CACHE_DIR, max_bytes=IMG_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # lock files live apart from the entries so eviction never touches them
+        self.lock_directory = os.path.join(directory, "locks")
+        os.makedirs(self.lock_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = self._scan_size()
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """Path of a cached file, marking it as recently used; None on a miss."""
+        path = self.path(name)
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, name, data):
+        # write then rename, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(name))
+        with self._lock:
+            self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+        return self.path(name)
+
+    def evict(self):
+        """Delete least recently used files until the cache is 10% under its cap."""
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+            # other workers write here too, so start from what's actually on disk
+            size = sum(entry_size for _, entry_size, _ in entries)
+            target = self.max_bytes * 0.9
+            for _, entry_size, path in sorted(entries):
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+            self._size = size
+
+    def lock(self, name):
+        """An exclusive, cross-process lock for producing ``name``.
+
+        Names share LOCK_STRIPES lock files, so the lock files don't pile up.
+        """
+        stripe = int(hashlib.sha1(name.encode()).hexdigest(), 16) % LOCK_STRIPES
+        return _FileLock(os.path.join(self.lock_directory, f"{stripe}.lock"))
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, "w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def init_app(app, s3, bucket, bucket_folder="", cache=None):
+    """Serve ``/img/<key>`` variants of the ``{bucket_folder}images/`` objects on ``app``."""
+    cache = cache or DiskLRUCache()
+    images_prefix = f"{bucket_folder or ''}images/"
+    # {key: (etag, checked at)}; variants are cached per source ETag, so a replaced original gets new ones
+    source_etags = {}
+
+    def source_etag(key):
+        etag, checked_at = source_etags.get(key, (None, 0))
+        if time.monotonic() - checked_at >= IMG_SOURCE_TTL:
+            try:
+                etag = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+            except ClientError as e:
+                if is_missing(e):
+                    source_etags.pop(key, None)
+                    abort(404)
+                raise
+            source_etags[key] = (etag, time.monotonic())
+        return etag
+
+    def variant_path(name, key, width, output_format):
+        path = cache.get(name)
+        if path is not None:
+            count_cache("image_variant", "hit")
+            return path
+        with cache.lock(name):
+            # whoever held the lock may have just rendered it
+            path = cache.get(name)
+            if path is not None:
+                count_cache("image_variant", "hit")
+                return path
+            count_cache("image_variant", "miss")
+            try:
+                source = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+            except ClientError as e:
+                if is_missing(e):
+                    abort(404)
+                raise
+            try:
+                with conversion_budget.reserve(image_footprint(BytesIO(source))):
+                    data = render_variant(source, width, output_format)
+            except UnidentifiedImageError:
+                abort(415)
+            del source
+            return cache.put(name, data)
+
+    @app.route("/img/<path:key>", methods=["GET"])
+    def image_variant(key):
+        if not key.startswith(images_prefix):
+            abort(404)
+        width = snap_width(request.args.get("w", IMG_WIDTHS[-1], type=int))
+        extension = request.args.get("fmt", "webp").lower()
+        if extension not in IMG_FORMATS:
+            abort(400)
+        output_format = IMG_FORMATS[extension]
+        source = f"{bucket}/{key}/{source_etag(key)}"
+        name = f"{hashlib.sha1(source.encode()).hexdigest()}-{width}.{EXTENSIONS[output_format]}"
+
+        def send():
+            return send_file(variant_path(name, key, width, output_format), mimetype=mimetypes.guess_type(name)[0],
+                             conditional=True, etag=True, max_age=IMG_MAX_AGE)
+
+        try:
+            response = send()
+        except FileNotFoundError:
+            # evicted by another worker between the lookup and the open; render it again
+            response = send()
+        response.cache_control.public = True
+        return response
@@ -0,0 +1,102 @@
+"""Process-wide memory budget for image decoding.
+
+Decoding dominates a conversion's footprint: a 48 MP HEIC is ~140 MB of RGB
+pixels however small the file is. Callers estimate a job's peak from the
+image header (``image_footprint``) and hold that much of the budget while
+they work, so concurrent requests queue up instead of pushing the host's
+memory past what it can afford.
+
+The budget is shared by every process on the host (gunicorn workers, the
+batch process pool) through a ledger file in ``MEMORY_BUDGET_DIR``, updated
+under ``flock``. Reservations of processes that died are dropped the next
+time the ledger is read.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import uuid
+
+from PIL import Image
+
+CONVERSION_MEMORY_BUDGET = int(os.getenv("CONVERSION_MEMORY_BUDGET_MB", 1024)) * 1024 * 1024
+MEMORY_BUDGET_DIR = os.getenv("MEMORY_BUDGET_DIR", "/tmp/gallery-memory-budget")
+# how often (seconds) a waiting job checks whether another process released its share
+POLL_INTERVAL = 0.05
+
+
+def image_footprint(fp):
+    """Estimated peak bytes to decode and re-encode the image in ``fp`` (header read only)."""
+    position = fp.tell()
+    with Image.open(fp) as image:
+        width, height = image.size
+        bands = len(image.getbands())
+    fp.seek(position)
+    # decoded pixels plus one converted copy alive during the encode
+    return width * height * max(bands, 3) * 2
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MemoryBudget:
+    """A weighted semaphore over bytes, shared by the processes using the same ledger directory."""
+
+    def __init__(self, limit=CONVERSION_MEMORY_BUDGET, directory=MEMORY_BUDGET_DIR):
+        self.limit = limit
+        self.path = os.path.join(directory, "ledger.json")
+        os.makedirs(directory, exist_ok=True)
+        # wakes waiters in this process at once; other processes' releases are found by polling
+        self._condition = threading.Condition()
+
+    def _update(self, change):
+        """Apply ``change(ledger)`` to the ledger ``{token: [pid, bytes]}`` under the file lock."""
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            text = f.read()
+            ledger = {token: held for token, held in (json.loads(text) if text else {}).items() if _alive(held[0])}
+            result = change(ledger)
+            f.seek(0)
+            f.truncate()
+            json.dump(ledger, f)
+        return result
+
+    @property
+    def in_use(self):
+        return self._update(lambda ledger: sum(nbytes for _, nbytes in ledger.values()))
+
+    def _try_reserve(self, token, nbytes):
+        def take(ledger):
+            if ledger and sum(held for _, held in ledger.values()) + nbytes > self.limit:
+                return False
+            ledger[token] = [os.getpid(), nbytes]
+            return True
+
+        return self._update(take)
+
+    @contextmanager
+    def reserve(self, nbytes):
+        # a job larger than the whole budget still runs, just on its own
+        nbytes = min(nbytes, self.limit)
+        token = uuid.uuid4().hex
+        with self._condition:
+            while not self._try_reserve(token, nbytes):
+                self._condition.wait(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self._update(lambda ledger: ledger.pop(token, None))
+            with self._condition:
+                self._condition.notify_all()
+
+
+conversion_budget = MemoryBudget()
@@ -0,0 +1,262 @@
+"""Consolidated metadata index.
+
+All per-image ``metadata/<name>.json`` records of a bucket folder are mirrored
+into a single ``index/metadata.json`` object so a gallery render costs one
+(conditional) GET instead of one GET per image. Writers update the per-image
+record first and then the index, using ETag-conditional puts so concurrent
+writers from different services never lose each other's updates.
+
+Every change rewrites the whole index object, so one write costs a few
+hundred bytes per image in the folder (tens of MB at 100k images). Callers
+with many changes (``/update/batch``, reconciler passes) apply them with a
+single ``update``. When the index write keeps losing to other writers,
+IndexBusy is raised; the per-image records are already saved and the
+reconciler's ``index_handler`` brings the index up to date on its next pass.
+
+One MetadataIndex is shared by a service's request and background threads.
+Its loads and writes are serialized by a lock, and a write builds a new copy
+of the index that replaces the cached one only once S3 has accepted it, so
+readers never see a half-applied or rejected change.
+"""
+from datetime import datetime, timezone
+import json
+import os
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from common.metrics import count_cache
+from common.s3 import REVALIDATE_CACHE_CONTROL, iter_objects, object_args
+
+INDEX_KEY = "index/metadata.json"
+METADATA_FOLDER = "metadata/"
+MAX_WRITE_ATTEMPTS = 8
+# a conditional write lost against a concurrent writer
+CONFLICT_CODES = ("412", "PreconditionFailed", "ConditionalRequestConflict")
+
+
+class WriteConflict(Exception):
+    pass
+
+
+class IndexBusy(RuntimeError):
+    """The index write lost to concurrent writers ``MAX_WRITE_ATTEMPTS`` times."""
+
+
+def normalize_tag(tag):
+    """Lower-case ``tag`` and join its words with "-", since searches split on whitespace."""
+    return re.sub(r"\s+", "-", tag.strip().lower())
+
+
+def metadata_stem(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code")
+
+
+def record_key(bucket_folder, filename):
+    return f"{bucket_folder or ''}{METADATA_FOLDER}{metadata_stem(filename)}.json"
+
+
+def update_record(s3, bucket, bucket_folder, filename, tags=None, add=(), remove=(), etag=None, fields=None):
+    """Replace (``tags``) or edit (``add``/``remove``) one image's tags with an ETag-conditional write.
+
+    ``etag`` is the version of the record the edit was based on; if the record
+    has changed since, WriteConflict is raised. Otherwise ``add``/``remove``
+    edits are re-applied on top of concurrent writes, while replacing the tags
+    raises WriteConflict rather than overwrite someone else's edit. A missing
+    record is created. Tags are stored normalized (``normalize_tag``). Other
+    ``fields`` (such as image header facts) are merged into the record. Returns ``(metadata, etag, created)``; the caller
+    updates the metadata index.
+    """
+    key = record_key(bucket_folder, filename)
+    tags = None if tags is None else [normalize_tag(tag) for tag in tags if tag.strip()]
+    add = [normalize_tag(tag) for tag in add if tag.strip()]
+    remove = [normalize_tag(tag) for tag in remove]
+    for _ in range(MAX_WRITE_ATTEMPTS):
+        try:
+            obj = s3.get_object(Bucket=bucket, Key=key)
+            metadata, current = json.loads(obj["Body"].read()), obj["ETag"]
+        except ClientError as e:
+            if _error_code(e) not in ("404", "NoSuchKey"):
+                raise
+            metadata = {"filename": os.path.basename(filename), "tags": [],
+                        "uploaded_at": datetime.utcnow().isoformat()}
+            current = None
+        if etag is not None and current != etag:
+            raise WriteConflict(f"{filename} was changed by someone else")
+
+        new_tags = list(metadata.get("tags", [])) if tags is None else list(tags)
+        new_tags += [tag for tag in add if tag not in new_tags]
+        metadata = {**metadata, **(fields or {}), "tags": [tag for tag in new_tags if tag not in remove]}
+        conditions = {"IfMatch": current} if current else {"IfNoneMatch": "*"}
+        try:
+            response = s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(metadata),
+                                     **object_args(key, REVALIDATE_CACHE_CONTROL), **conditions)
+            return metadata, response["ETag"], current is None
+        except ClientError as e:
+            if _error_code(e) not in CONFLICT_CODES:
+                raise
+            if etag is not None or tags is not None:
+                raise WriteConflict(f"{filename} was changed by someone else") from e
+    raise WriteConflict(f"Could not update {filename}: too many concurrent writers")
+
+
+class MetadataIndex:
+    def __init__(self, s3, bucket, bucket_folder=""):
+        self.s3 = s3
+        self.bucket = bucket
+        self.bucket_folder = bucket_folder or ""
+        self.key = f"{self.bucket_folder}{INDEX_KEY}"
+        self._data = None
+        self._etag = None
+        self._checked_at = 0
+        # reentrant: a load may publish a rebuilt index
+        self._lock = threading.RLock()
+
+    def load(self, max_age=0, rebuild_missing=True):
+        """Return the index; ``max_age`` seconds skips re-checking a recent copy.
+
+        A missing index is rebuilt from the metadata records, or reported as
+        None when ``rebuild_missing`` is False. The returned data must not be
+        modified.
+        """
+        with self._lock:
+            return self._load(max_age, rebuild_missing)
+
+    def _load(self, max_age, rebuild_missing):
+        if self._etag and max_age and time.monotonic() - self._checked_at < max_age:
+            count_cache("metadata_index", "fresh")
+            return self._data
+        # A conditional GET keeps repeated renders at one cheap 304 round trip.
+        kwargs = {"IfNoneMatch": self._etag} if self._etag else {}
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self.key, **kwargs)
+        except ClientError as e:
+            code = _error_code(e)
+            if code in ("304", "NotModified"):
+                count_cache("metadata_index", "not_modified")
+                self._checked_at = time.monotonic()
+                return self._data
+            if code in ("404", "NoSuchKey"):
+                return self.rebuild() if rebuild_missing else None
+            raise
+        count_cache("metadata_index", "fetched")
+        self._data = json.loads(obj["Body"].read())
+        self._etag = obj["ETag"]
+        self._checked_at = time.monotonic()
+        return self._data
+
+    @property
+    def generation(self):
+        return self.load()["generation"]
+
+    def last_modified(self, max_age=0):
+        """``(generation, datetime of the last write)`` for HTTP validators."""
+        data = self.load(max_age=max_age)
+        updated_at = data.get("updated_at")
+        return data["generation"], (datetime.fromtimestamp(updated_at, timezone.utc) if updated_at else None)
+
+    def images(self):
+        images = self.load()["images"]
+        return [images[stem] for stem in sorted(images)]
+
+    def get(self, filename):
+        return self.load()["images"].get(metadata_stem(filename))
+
+    def rebuild(self):
+        """Scan every per-image metadata record and publish a fresh index."""
+        return self._publish(dict(self._scan()))
+
+    def stream(self):
+        """Yield metadata records as soon as they are available.
+
+        With a published index this costs a single GET. Otherwise the records
+        are yielded while the bucket is being scanned and the new index is
+        published once the scan completes.
+        """
+        data = self.load(rebuild_missing=False)
+        if data is not None:
+            images = data["images"]
+            for stem in sorted(images):
+                yield images[stem]
+            return
+        images = {}
+        for stem, metadata in self._scan():
+            images[stem] = metadata
+            yield metadata
+        self._publish(images)
+
+    def _scan(self):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        prefix = f"{self.bucket_folder}{METADATA_FOLDER}"
+        keys = [
+            item["Key"]
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+            for item in page.get("Contents", [])
+            if item["Key"].endswith(".json")
+        ]
+        for key, body in iter_objects(self.s3, self.bucket, keys):
+            try:
+                yield metadata_stem(key), json.loads(body)
+            except ValueError:
+                # left out until it is fixed; the reconciler keeps retrying it
+                print(f"skipping unreadable metadata record {key}")
+
+    def _publish(self, images):
+        data = {"generation": 1, "updated_at": time.time(), "images": images}
+        with self._lock:
+            try:
+                self._write(data, IfNoneMatch="*")
+            except ClientError as e:
+                # someone else published an index while we were scanning
+                if _error_code(e) not in CONFLICT_CODES:
+                    raise
+                self._etag = None
+                return self._load(0, True)
+            return data
+
+    def put(self, metadata):
+        self.update({metadata_stem(metadata["filename"]): metadata})
+
+    def remove(self, filename):
+        self.update({metadata_stem(filename): None})
+
+    def update(self, changes):
+        """Apply ``{stem: metadata}`` changes (``None`` deletes) to the index."""
+        with self._lock:
+            for _ in range(MAX_WRITE_ATTEMPTS):
+                current = self._load(0, True)
+                images = dict(current["images"])
+                for stem, metadata in changes.items():
+                    if metadata is None:
+                        images.pop(stem, None)
+                    else:
+                        images[stem] = metadata
+                data = {**current, "generation": current["generation"] + 1, "updated_at": time.time(),
+                        "images": images}
+                try:
+                    self._write(data, IfMatch=self._etag)
+                    return data
+                except ClientError as e:
+                    if _error_code(e) not in CONFLICT_CODES:
+                        raise
+                    # another process wrote first; fetch its version and re-apply
+                    self._etag = None
+        raise IndexBusy(f"Could not update s3://{self.bucket}/{self.key}: too many concurrent writers")
+
+    def _write(self, data, **conditions):
+        response = self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=json.dumps(data, separators=(",", ":")),
+            **object_args(self.key, REVALIDATE_CACHE_CONTROL),
+            **conditions,
+        )
+        self._data = data
+        self._etag = response["ETag"]
+        self._checked_at = time.monotonic()
@@ -0,0 +1,236 @@
+"""Hot-path instrumentation with a Prometheus text ``/metrics`` endpoint.
+
+Records, per process:
+
+* S3 calls, errors, bytes moved and call latency per operation (boto3 event
+  hooks installed by ``instrument_client``),
+* per-operation timing histograms for conversions and template rendering
+  (``timed``),
+* cache hits/misses (``count_cache``),
+* HTTP request latency per endpoint, plus an optional one-line timing log per
+  request with its S3 call count (``REQUEST_TIMING_LOG=1``).
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import os
+import threading
+import time
+
+from flask import Response, g, request, template_rendered, before_render_template
+
+REQUEST_TIMING_LOG = os.getenv("REQUEST_TIMING_LOG", "").lower() in ("1", "true", "yes")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    "s3_requests_total": ("counter", "S3 API calls by operation."),
+    "s3_errors_total": ("counter", "S3 API calls that raised an error, by operation and code."),
+    "s3_bytes_total": ("counter", "Bytes of object bodies sent to or received from S3."),
+    "s3_request_duration_seconds": ("histogram", "S3 API call latency by operation."),
+    "operation_duration_seconds": ("histogram", "Duration of instrumented operations."),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result."),
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by endpoint."),
+    "reconciler_changes_total": ("counter", "Bucket changes found by the reconciler, by kind and action."),
+}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            counts, total = self.histograms.get(key, ([0] * len(BUCKETS), 0.0))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            self.histograms[key] = (counts, total + value)
+            self.counters[(f"{name}_count", key[1])] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(counts), total) for key, (counts, total) in self.histograms.items()}
+        lines = []
+        for name, (kind, text) in HELP.items():
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value:g}")
+                continue
+            for (metric, labels), (counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(BUCKETS, counts):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                n = counters[(f"{name}_count", labels)]
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {n:g}")
+                lines.append(f"{name}_sum{_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{_labels(labels)} {n:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+registry = Registry()
+
+# S3 calls/bytes of the HTTP request being served, for the timing log
+_request_stats = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.s3_calls = 0
+        self.s3_bytes = 0
+
+    def add(self, calls=0, nbytes=0):
+        with self._lock:
+            self.s3_calls += calls
+            self.s3_bytes += nbytes
+
+
+@contextmanager
+def timed_block(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("operation_duration_seconds", time.perf_counter() - start, {"operation": operation})
+
+
+def timed(operation):
+    """Decorator recording the wrapped function's duration under ``operation``."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timed_block(operation):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_cache(cache, result):
+    registry.inc("cache_requests_total", {"cache": cache, "result": result})
+
+
+def _body_size(body):
+    if isinstance(body, str):
+        return len(body.encode())
+    if hasattr(body, "__len__"):
+        # bytes, and s3transfer's upload chunks
+        return len(body)
+    if hasattr(body, "seekable") and body.seekable():
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    return 0
+
+
+def _before_parameter_build(params, context, **kwargs):
+    context["metrics_bytes_sent"] = params.get("ContentLength") or _body_size(params.get("Body"))
+
+
+def _before_call(context, **kwargs):
+    context["metrics_start"] = time.perf_counter()
+
+
+def _after_call(model, http_response, parsed, context, **kwargs):
+    operation = model.name
+    start = context.get("metrics_start")
+    if start is not None:
+        registry.observe("s3_request_duration_seconds", time.perf_counter() - start, {"operation": operation})
+    registry.inc("s3_requests_total", {"operation": operation})
+    if http_response.status_code >= 300:
+        # botocore raises the ClientError after this hook; 304s and 404s land here too
+        code = parsed.get("Error", {}).get("Code", str(http_response.status_code))
+        registry.inc("s3_errors_total", {"operation": operation, "code": code})
+        nbytes = 0
+    elif operation == "GetObject":
+        nbytes = parsed.get("ContentLength") or 0
+    else:
+        nbytes = context.get("metrics_bytes_sent", 0)
+    if nbytes:
+        registry.inc("s3_bytes_total", {"operation": operation}, nbytes)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.add(1, nbytes)
+
+
+def _after_call_error(event_name, exception, **kwargs):
+    # the request never got a response, e.g. a connection error; botocore
+    # passes no model here, so the operation comes from "after-call-error.s3.<Operation>"
+    operation = event_name.rsplit(".", 1)[-1]
+    registry.inc("s3_requests_total", {"operation": operation})
+    registry.inc("s3_errors_total", {"operation": operation, "code": type(exception).__name__})
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.add(1)
+
+
+def instrument_client(client):
+    events = client.meta.events
+    events.register("before-parameter-build.s3", _before_parameter_build)
+    events.register("before-call.s3", _before_call)
+    events.register("after-call.s3", _after_call)
+    events.register("after-call-error.s3", _after_call_error)
+    return client
+
+
+def init_app(app, service):
+    """Time every request, template render and expose ``/metrics`` on ``app``."""
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_stats = RequestStats()
+        g.metrics_token = _request_stats.set(g.metrics_stats)
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or "unknown"
+        registry.observe("http_request_duration_seconds", elapsed,
+                         {"service": service, "endpoint": endpoint, "method": request.method})
+        stats = g.pop("metrics_stats")
+        if REQUEST_TIMING_LOG:
+            app.logger.warning(
+                "%s %s %s %.1fms s3_calls=%d s3_bytes=%d", request.method, request.full_path.rstrip("?"),
+                response.status_code, elapsed * 1000, stats.s3_calls, stats.s3_bytes,
+            )
+        _request_stats.reset(g.pop("metrics_token"))
+        return response
+
+    def start_render(sender, template, context, **extra):
+        g.metrics_render_start = time.perf_counter()
+
+    def finish_render(sender, template, context, **extra):
+        start = g.pop("metrics_render_start", None)
+        if start is not None:
+            registry.observe("operation_duration_seconds", time.perf_counter() - start,
+                             {"operation": f"render:{template.name}"})
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
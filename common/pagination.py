@@ -0,0 +1,52 @@
+"""Cursor pagination helpers shared by the gallery APIs.
+
+Index-backed galleries use offsets into the (already in-memory) search
+results as cursors. Listing-backed galleries use the last returned S3 key, so
+the listing resumes natively with ``StartAfter``.
+"""
+
+DEFAULT_LIMIT = 60
+MAX_LIMIT = 500
+
+
+def parse_limit(value, default=DEFAULT_LIMIT):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def paginate(items, cursor=None, limit=DEFAULT_LIMIT):
+    """Return ``(page, next_cursor)``; ``next_cursor`` is None on the last page."""
+    try:
+        start = max(0, int(cursor)) if cursor else 0
+    except ValueError:
+        start = 0
+    end = start + limit
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+def list_page(s3, bucket, prefix, cursor=None, limit=DEFAULT_LIMIT, predicate=None):
+    """Return up to ``limit`` listing entries under ``prefix`` after ``cursor``.
+
+    Follows continuation tokens until the page is full, so filtered listings
+    and buckets with more than 1,000 keys are handled transparently.
+    """
+    page = []
+    kwargs = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": min(1000, max(limit, 100))}
+    if cursor:
+        kwargs["StartAfter"] = cursor
+    while True:
+        result = s3.list_objects_v2(**kwargs)
+        for item in result.get("Contents", []):
+            if predicate is not None and not predicate(item):
+                continue
+            page.append(item)
+            if len(page) == limit:
+                # there may be more even if this listing response was the last one
+                return page, item["Key"]
+        if not result.get("IsTruncated"):
+            return page, None
+        kwargs.pop("StartAfter", None)
+        kwargs["ContinuationToken"] = result["NextContinuationToken"]
@@ -0,0 +1,396 @@
+"""Incremental reconciliation of changes made to the bucket outside the apps.
+
+Objects written straight to the bucket (for example an ``aws s3 sync`` of a
+phone backup) never pass through the uploader, so nothing indexes them or
+renders their derivatives. The reconciler remembers the ETag and LastModified
+it last saw for every key under ``images/`` and ``metadata/``. Each pass lists
+both prefixes and diffs the listings against that state, so unchanged objects
+cost nothing beyond the listing. Every difference becomes a Change, and the
+Changes of a pass are handed to each handler. A key's new state is saved only
+once every handler has dealt with it, so a failed change is retried on the
+next pass. Handlers catch what fails for one key and report the key, so one
+unreadable object holds back only itself.
+
+    python -m common.reconciler --interval 300
+
+runs it periodically; a service can run it on a background thread with
+``Reconciler.start(interval)`` instead.
+"""
+import argparse
+from collections import namedtuple
+import fcntl
+import hashlib
+from io import BytesIO
+import json
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from common.derivatives import DERIVATIVES_FOLDER, derivative_keys, generate_derivatives
+from common.duplicates import image_hash
+from common.image_info import INFO_FIELDS, fetch_image_info
+from common.memory import conversion_budget, image_footprint
+from common.metadata_index import METADATA_FOLDER, MetadataIndex, metadata_stem, record_key, update_record
+from common.metrics import registry
+from common.s3 import fetch_many, get_object_or_none
+
+RECONCILER_STATE_DIR = os.getenv("RECONCILER_STATE_DIR", "/tmp/gallery-reconciler")
+IMAGES_FOLDER = "images/"
+
+IMAGE, METADATA = "image", "metadata"
+ADDED, CHANGED, DELETED = "added", "changed", "deleted"
+
+# ``etag`` and ``last_modified`` are None for deleted keys
+Change = namedtuple("Change", ["kind", "action", "key", "etag", "last_modified"])
+
+
+def list_objects(s3, bucket, prefix):
+    """Return ``{key: (etag, last modified)}`` for every object under ``prefix``."""
+    paginator = s3.get_paginator("list_objects_v2")
+    return {
+        item["Key"]: (item["ETag"], item["LastModified"].isoformat())
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if not item["Key"].endswith("/")
+    }
+
+
+def diff(kind, seen, listing):
+    """Changes between the ``seen`` state and a fresh ``listing`` of the same prefix."""
+    changes = []
+    for key, (etag, last_modified) in listing.items():
+        if key not in seen:
+            changes.append(Change(kind, ADDED, key, etag, last_modified))
+        elif tuple(seen[key]) != (etag, last_modified):
+            changes.append(Change(kind, CHANGED, key, etag, last_modified))
+    changes.extend(Change(kind, DELETED, key, None, None) for key in seen if key not in listing)
+    return changes
+
+
+class Reconciler:
+    def __init__(self, s3, bucket, bucket_folder="", handlers=(), state_dir=RECONCILER_STATE_DIR):
+        """``handlers`` are ``fn(changes, listing)`` callables.
+
+        ``listing`` maps every key listed in the pass to ``(etag, last
+        modified)``. A handler returns the keys of the changes it failed to
+        handle (or None); raising fails every change of the pass, so handlers
+        catch per-key failures (``try_each``) instead.
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.bucket_folder = bucket_folder or ""
+        self.handlers = list(handlers)
+        self.prefixes = {IMAGE: f"{self.bucket_folder}{IMAGES_FOLDER}",
+                         METADATA: f"{self.bucket_folder}{METADATA_FOLDER}"}
+        name = hashlib.sha1(f"{bucket}/{self.bucket_folder}".encode()).hexdigest()[:12]
+        self.state_path = os.path.join(state_dir, f"{name}.json")
+        self.lock_path = os.path.join(state_dir, f"{name}.lock")
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {IMAGE: {}, METADATA: {}}
+
+    def _save_state(self, state):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.state_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp_path, self.state_path)
+
+    def run_once(self):
+        """Run one delta pass and return its changes.
+
+        Returns None without doing anything if another thread or process on
+        the host is already running a pass.
+        """
+        with open(self.lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            state = self._load_state()
+            listings = {kind: list_objects(self.s3, self.bucket, prefix) for kind, prefix in self.prefixes.items()}
+            changes = [change for kind in (METADATA, IMAGE) for change in diff(kind, state[kind], listings[kind])]
+            if not changes:
+                # the state file's mtime tells the other workers a pass just ran
+                self._save_state(state)
+                return changes
+
+            listing = {**listings[METADATA], **listings[IMAGE]}
+            failed = set()
+            for handler in self.handlers:
+                try:
+                    failed.update(handler(changes, listing) or ())
+                except Exception as e:
+                    print(f"reconciler handler {getattr(handler, '__name__', handler)} failed: {e}")
+                    failed.update(change.key for change in changes)
+
+            for change in changes:
+                registry.inc("reconciler_changes_total", {"kind": change.kind, "action": change.action})
+                if change.key in failed:
+                    continue
+                if change.action == DELETED:
+                    state[change.kind].pop(change.key, None)
+                else:
+                    state[change.kind][change.key] = [change.etag, change.last_modified]
+            self._save_state(state)
+            print(f"reconciled {len(changes) - len(failed)} of {len(changes)} changes")
+            return changes
+
+    def _loop(self, interval):
+        while True:
+            try:
+                # with a thread in every gunicorn worker, only the first one due runs the pass
+                if not os.path.exists(self.state_path) or time.time() - os.path.getmtime(self.state_path) >= interval:
+                    self.run_once()
+            except Exception as e:
+                print(f"reconciler pass failed: {e}")
+            time.sleep(interval)
+
+    def start(self, interval):
+        threading.Thread(target=self._loop, args=(interval,), name="reconciler", daemon=True).start()
+
+
+def try_each(fn, keys, action, **kwargs):
+    """``fetch_many`` that logs the keys ``fn`` raises for: returns ``({key: result}, [failed keys])``."""
+    def attempt(key):
+        try:
+            return True, fn(key)
+        except Exception as e:
+            print(f"could not {action} {key}: {e!r}")
+            return False, None
+
+    keys = list(keys)
+    results, failed = {}, []
+    for key, (ok, result) in zip(keys, fetch_many(attempt, keys, **kwargs)):
+        if ok:
+            results[key] = result
+        else:
+            failed.append(key)
+    return results, failed
+
+
+def update_index(index, updates, keys):
+    """Write ``updates`` to ``index``; returns ``keys`` as failed if the write does."""
+    if not updates:
+        return []
+    try:
+        index.update(updates)
+    except Exception as e:
+        print(f"could not update the metadata index: {e!r}")
+        return list(keys)
+    return []
+
+
+def index_handler(index):
+    """Keep ``index`` (a MetadataIndex) in step with the records and images.
+
+    New or changed records are fetched, deleted ones dropped. An image whose
+    stem isn't indexed gets its record indexed, or a new one created from its
+    header facts, and the index entry of the last image of a stem is dropped
+    with it (the record is kept, so re-adding the image brings its tags back).
+    Records already indexed as they are, such as the ones the apps write, cost
+    a GET but no index write. On the first pass the index is trusted for the
+    records it already has.
+    """
+    def handle(changes, listing):
+        indexed = index.load()["images"]
+        bucket_folder = index.bucket_folder
+        images_prefix = f"{bucket_folder}{IMAGES_FOLDER}"
+        image_stems = {metadata_stem(key) for key in listing if key.startswith(images_prefix)}
+
+        # the change keys each fetched record and created filename stands for
+        fetch, create, updates = {}, {}, {}
+        for change in changes:
+            stem = metadata_stem(change.key)
+            if change.kind == METADATA:
+                if change.action == DELETED:
+                    updates[stem] = None
+                elif change.action == CHANGED or stem not in indexed:
+                    fetch.setdefault(change.key, []).append(change.key)
+            elif change.action == DELETED:
+                if stem not in image_stems:
+                    updates[stem] = None
+            elif stem not in indexed:
+                key = record_key(bucket_folder, change.key)
+                if key in listing:
+                    fetch.setdefault(key, []).append(change.key)
+                else:
+                    create.setdefault(change.key[len(images_prefix):], []).append(change.key)
+
+        def read_record(key):
+            body = get_object_or_none(index.s3, index.bucket, key)
+            # None when deleted since the listing; the next pass sees it
+            return body and json.loads(body)
+
+        records, failed_records = try_each(read_record, fetch, "read metadata record")
+        failed = [change_key for key in failed_records for change_key in fetch[key]]
+        for key, metadata in records.items():
+            if metadata and indexed.get(metadata_stem(key)) != metadata:
+                updates[metadata_stem(key)] = metadata
+
+        def create_record(filename):
+            info = fetch_image_info(index.s3, index.bucket, f"{images_prefix}{filename}")
+            return update_record(index.s3, index.bucket, bucket_folder, filename, fields=info)[0]
+
+        created, failed_creates = try_each(create_record, sorted(create), "create the record of")
+        failed.extend(change_key for filename in failed_creates for change_key in create[filename])
+        for metadata in created.values():
+            updates[metadata_stem(metadata["filename"])] = metadata
+
+        written = [change.key for change in changes if change.key not in failed]
+        return failed + update_index(index, updates, written)
+
+    return handle
+
+
+def image_info_handler(index):
+    """Store the header facts (``common.image_info``) of new or changed images on their records.
+
+    Records that already have the facts of an unchanged image are left alone,
+    so the first pass backfills existing images and later passes only read
+    the headers of what changed. Run it after ``index_handler``.
+    """
+    def handle(changes, listing):
+        indexed = index.load()["images"]
+        due = [
+            change.key for change in changes
+            if change.kind == IMAGE and change.action != DELETED
+            and (change.action == CHANGED or "width" not in indexed.get(metadata_stem(change.key), {}))
+        ]
+
+        def describe(key):
+            info = fetch_image_info(index.s3, index.bucket, key)
+            current = indexed.get(metadata_stem(key), {})
+            if not info or all(current.get(field) == info.get(field) for field in INFO_FIELDS if field in info):
+                return None
+            filename = key[len(f"{index.bucket_folder}{IMAGES_FOLDER}"):]
+            return update_record(index.s3, index.bucket, index.bucket_folder, filename, fields=info)[0]
+
+        described, failed = try_each(describe, due, "read the header of")
+        updates = {metadata_stem(metadata["filename"]): metadata for metadata in described.values() if metadata}
+        return failed + update_index(index, updates, [key for key, metadata in described.items() if metadata])
+
+    return handle
+
+
+def phash_handler(index, max_workers=4):
+    """Store the perceptual hash (``common.duplicates``) of new or changed images on their records.
+
+    Hashing needs the whole object, so only one image per stem is hashed (a
+    JPEG or PNG sibling decodes faster than the HEIC), and images whose
+    record already has a hash are skipped unless they changed.
+    """
+    def handle(changes, listing):
+        indexed = index.load()["images"]
+        due = {}
+        for change in changes:
+            stem = metadata_stem(change.key)
+            if change.kind != IMAGE or change.action == DELETED:
+                continue
+            if change.action == ADDED and indexed.get(stem, {}).get("phash"):
+                continue
+            if stem not in due or due[stem].lower().endswith((".heic", ".heif")):
+                due[stem] = change.key
+
+        def describe(key):
+            body = index.s3.get_object(Bucket=index.bucket, Key=key)["Body"].read()
+            try:
+                with conversion_budget.reserve(image_footprint(BytesIO(body))):
+                    phash = image_hash(BytesIO(body))
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                # not an image, truncated, or too large to decode: skipped until it changes
+                print(f"not hashing {key}: {e!r}")
+                return None
+            if indexed.get(metadata_stem(key), {}).get("phash") == phash:
+                return None
+            filename = key[len(f"{index.bucket_folder}{IMAGES_FOLDER}"):]
+            return update_record(index.s3, index.bucket, index.bucket_folder, filename, fields={"phash": phash})[0]
+
+        hashed, failed = try_each(describe, due.values(), "hash", max_workers=max_workers)
+        updates = {metadata_stem(metadata["filename"]): metadata for metadata in hashed.values() if metadata}
+        return failed + update_index(index, updates, [key for key, metadata in hashed.items() if metadata])
+
+    return handle
+
+
+def derivatives_handler(s3, bucket, bucket_folder, submit, max_workers=4):
+    """Call ``submit(image key)`` for new or changed images whose derivatives are missing or stale.
+
+    ``submit`` may render the derivatives itself or queue them; keys it raises
+    for are retried on the next pass. The derivatives of the last image of a
+    stem are deleted with it. Near-duplicates get derivatives of their own,
+    like every other image.
+    """
+    bucket_folder = bucket_folder or ""
+
+    def handle(changes, listing):
+        images = [change for change in changes if change.kind == IMAGE]
+        if not images:
+            return []
+        existing = list_objects(s3, bucket, f"{bucket_folder}{DERIVATIVES_FOLDER}")
+
+        # images sharing a stem (a HEIC and its PNG) share derivatives; render from the newest
+        sources, orphaned = {}, set()
+        image_stems = {metadata_stem(key) for key in listing if key.startswith(f"{bucket_folder}{IMAGES_FOLDER}")}
+        for change in images:
+            if change.action == DELETED:
+                if metadata_stem(change.key) not in image_stems:
+                    orphaned.add(change.key)
+                continue
+            stem = metadata_stem(change.key)
+            if stem not in sources or change.last_modified > sources[stem].last_modified:
+                sources[stem] = change
+
+        due = [
+            change.key for change in sources.values()
+            if not all(key in existing and existing[key][1] >= change.last_modified
+                       for key in derivative_keys(bucket_folder, change.key).values())
+        ]
+
+        _, failed = try_each(submit, due, "generate derivatives of", max_workers=max_workers)
+
+        stale = [key for image_key in orphaned for key in derivative_keys(bucket_folder, image_key).values()
+                 if key in existing]
+        for start in range(0, len(stale), 1000):
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in stale[start:start + 1000]]})
+        return failed
+
+    return handle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=os.getenv("S3_BUCKET"))
+    parser.add_argument("--bucket-folder", default=os.getenv("BUCKET_FOLDER", ""))
+    parser.add_argument("--interval", type=float, default=0, help="seconds between passes; 0 runs a single pass")
+    args = parser.parse_args()
+
+    from common.s3 import get_client
+
+    s3 = get_client()
+    index = MetadataIndex(s3, args.bucket, args.bucket_folder)
+    reconciler = Reconciler(s3, args.bucket, args.bucket_folder, handlers=[
+        index_handler(index),
+        image_info_handler(index),
+        phash_handler(index),
+        # render in this process; the pass only completes once they are uploaded
+        derivatives_handler(s3, args.bucket, args.bucket_folder,
+                            lambda key: generate_derivatives(s3, args.bucket, key, args.bucket_folder)),
+    ])
+    if not args.interval:
+        reconciler.run_once()
+        return
+    while True:
+        reconciler.run_once()
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Version-aware, stale-while-revalidate caching of rendered responses.
+
+Entries are stored in a Flask-Caching backend shared by every worker (e.g.
+``FileSystemCache``) together with the metadata generation they were rendered
+from. A request for an entry from an older generation is still answered from
+the cache right away, while a single background thread, across all workers,
+re-renders it for the current generation. The refresh is claimed with a
+non-blocking ``flock`` on a lock file in ``RESPONSE_LOCK_DIR``, which is atomic
+across processes and released by the kernel if the worker dies mid-refresh.
+
+Responses carry the version they were rendered from as ``cache_version``, so
+HTTP validators (``common.http_cache.conditional``) describe the body that
+was actually sent rather than the current generation.
+"""
+import fcntl
+from functools import wraps
+import hashlib
+import os
+import threading
+
+from flask import Response, current_app, make_response, request
+
+from common.metrics import count_cache
+
+RESPONSE_LOCK_DIR = os.getenv("RESPONSE_LOCK_DIR", "/tmp/gallery-response-locks")
+LOCK_STRIPES = 256
+
+
+class VersionedResponseCache:
+    def __init__(self, cache, current_version, lock_directory=RESPONSE_LOCK_DIR):
+        self.cache = cache
+        self.current_version = current_version
+        self.lock_directory = lock_directory
+        os.makedirs(lock_directory, exist_ok=True)
+
+    def cached(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = f"view/{request.full_path}"
+            version = self.current_version()
+            entry = self.cache.get(key)
+            if entry is None:
+                return self._render(key, version, f, args, kwargs, "MISS")
+
+            entry_version, body, mimetype = entry
+            status = "HIT"
+            if entry_version != version:
+                status = "STALE"
+                self._refresh_in_background(key, version, f, args, kwargs)
+            count_cache("response", status.lower())
+            response = Response(body, mimetype=mimetype)
+            response.headers["X-Cache"] = status
+            response.cache_version = entry_version
+            return response
+        return wrapper
+
+    def _render(self, key, version, f, args, kwargs, status):
+        count_cache("response", status.lower())
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            self.cache.set(key, (version, response.get_data(), response.mimetype), timeout=0)
+        response.headers["X-Cache"] = status
+        response.cache_version = version
+        return response
+
+    def _refresh_in_background(self, key, version, f, args, kwargs):
+        # keys share LOCK_STRIPES lock files; a collision only defers a refresh to the next request
+        stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+        lock = open(os.path.join(self.lock_directory, f"{stripe}.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another thread or worker is already refreshing this entry
+            lock.close()
+            return
+        app = current_app._get_current_object()
+        path = request.full_path
+
+        def refresh():
+            try:
+                with app.test_request_context(path):
+                    self._render(key, version, f, args, kwargs, "REFRESH")
+            except Exception as e:
+                app.logger.exception("background refresh of %s failed: %s", path, e)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+
+        threading.Thread(target=refresh, daemon=True).start()
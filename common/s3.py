@@ -0,0 +1,130 @@
+"""Shared S3 client and concurrent fetch helpers.
+
+boto3's default client keeps at most 10 pooled connections and retries with
+the legacy policy, which throttles any attempt at parallelism. Every service
+builds its client through ``make_client`` instead, and fans per-key requests
+out with ``fetch_many`` using bounded parallelism.
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from functools import lru_cache
+import mimetypes
+import os
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from common.metrics import instrument_client
+
+S3_MAX_WORKERS = int(os.getenv("S3_MAX_WORKERS", 32))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 64))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 10))
+
+MISSING_CODES = ("404", "NoSuchKey", "NotFound")
+
+# images and derivatives are rewritten under the same key (re-uploads, stale derivatives,
+# reconversions), so caches may only keep them briefly before revalidating the ETag
+OBJECT_MAX_AGE = int(os.getenv("OBJECT_MAX_AGE", 300))
+OBJECT_CACHE_CONTROL = f"public, max-age={OBJECT_MAX_AGE}, must-revalidate"
+# metadata changes on every edit
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+for _type, _extension in (("image/heic", ".heic"), ("image/heif", ".heif"), ("image/webp", ".webp"),
+                          ("image/avif", ".avif")):
+    mimetypes.add_type(_type, _extension)
+
+
+def make_client(**kwargs):
+    config = Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "adaptive"},
+        tcp_keepalive=True,
+    )
+    return instrument_client(boto3.client("s3", config=config, **kwargs))
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """Process-wide client so every module shares one connection pool."""
+    return make_client()
+
+
+def object_args(key, cache_control=OBJECT_CACHE_CONTROL):
+    """ContentType/CacheControl arguments for a put_object (or upload ExtraArgs) of ``key``."""
+    content_type = mimetypes.guess_type(key.lower())[0] or "application/octet-stream"
+    return {"ContentType": content_type, "CacheControl": cache_control}
+
+
+def fetch_many(fn, items, max_workers=S3_MAX_WORKERS):
+    """Run ``fn(item)`` for every item concurrently, returning results in order."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    # run in the caller's context so per-request S3 stats include these calls
+    contexts = [copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda context, item: context.run(fn, item), contexts, items))
+
+
+def is_missing(error):
+    return error.response.get("Error", {}).get("Code") in MISSING_CODES
+
+
+def get_object_or_none(s3, bucket, key):
+    """The body of ``key``, or None if it doesn't exist."""
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        if is_missing(e):
+            return None
+        raise
+
+
+def get_objects(s3, bucket, keys, max_workers=S3_MAX_WORKERS):
+    """Download ``keys`` concurrently into ``{key: bytes}``; missing keys map to None."""
+    keys = list(keys)
+    return dict(zip(keys, fetch_many(lambda key: get_object_or_none(s3, bucket, key), keys, max_workers)))
+
+
+def iter_objects(s3, bucket, keys, max_workers=S3_MAX_WORKERS):
+    """Download ``keys`` concurrently, yielding ``(key, bytes)`` in completion order.
+
+    Missing keys are skipped. Besides the body being consumed, at most
+    ``max_workers`` are downloading or waiting at once, so a slow consumer
+    bounds the memory held.
+    """
+    keys = iter(keys)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit_next():
+            for key in keys:
+                pending[executor.submit(copy_context().run, get_object_or_none, s3, bucket, key)] = key
+                return
+
+        for _ in range(max_workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                body = future.result()
+                submit_next()
+                if body is not None:
+                    yield key, body
+                del body
+
+
+def head_objects(s3, bucket, keys, max_workers=S3_MAX_WORKERS):
+    """HEAD ``keys`` concurrently into ``{key: response}``; missing keys map to None."""
+    def head(key):
+        try:
+            return s3.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if is_missing(e):
+                return None
+            raise
+
+    keys = list(keys)
+    return dict(zip(keys, fetch_many(head, keys, max_workers)))
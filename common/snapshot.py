@@ -0,0 +1,338 @@
+"""Memory-mapped binary snapshots of the metadata index.
+
+Every worker used to download and parse ``index/metadata.json`` and keep its
+own dicts plus its own TagIndex. Instead, the first worker to see a new index
+version writes a compact binary snapshot of it to local disk, and every worker
+``mmap``s that file read-only, so the pages are shared through the OS page
+cache and a restarted worker is warm as soon as it maps the file. Checking for
+a newer version is a HEAD of the index; a new ETag maps (or, for the first
+worker to notice, builds) a new file, swapped in with a single assignment.
+
+Layout, native byte order (snapshots never leave the host that wrote them)::
+
+    header            HEADER struct
+    string offsets    (n_strings + 1) x u32 into the string data
+    tags              n_tags x (string id, postings start, postings count),
+                      sorted by normalized tag
+    postings          u32 image ids, ascending within each tag
+    images            n_images x (stem, filename, tags start, tags count,
+                      extra, *COLUMNS, representative), sorted by stem;
+                      extra is the JSON of every other metadata field and
+                      representative the id of the image standing for its
+                      group of near-duplicates
+    image tags        u32 string ids of each image's tags as written
+    string data       UTF-8
+"""
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+from datetime import datetime, timezone
+import fcntl
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+
+from common.duplicates import HashIndex
+from common.metadata_index import MetadataIndex
+from common.metrics import count_cache
+from common.s3 import is_missing
+from common.tag_index import TagIndex, normalize_tag
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/tmp/gallery-snapshots")
+# snapshots kept per bucket folder, so workers still on an older one can finish with it
+SNAPSHOTS_KEPT = 3
+
+MAGIC = b"GSNP"
+VERSION = 5
+# magic, version, generation, updated_at, etag string id, n_strings, n_tags, n_postings, n_images, n_image_tags
+HEADER = struct.Struct("=4sIQdIIIIII")
+# fields galleries sort and filter by, copied out of extra so they never need a JSON parse
+STRING_COLUMNS = ("uploaded_at", "taken_at", "camera", "phash")
+NUMBER_COLUMNS = ("width", "height")
+COLUMNS = {name: 5 + i for i, name in enumerate(STRING_COLUMNS + NUMBER_COLUMNS)}
+REPRESENTATIVE = 5 + len(COLUMNS)
+IMAGE_FIELDS = REPRESENTATIVE + 1
+TAG_FIELDS = 3
+
+
+def write_snapshot(path, data, etag):
+    """Write the metadata index ``data`` (as stored in S3) to ``path`` atomically."""
+    strings, string_ids = [], {}
+
+    def sid(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value.encode())
+        return string_ids[value]
+
+    images = data["images"]
+    stems = sorted(images)
+    postings_by_tag = {}
+    records, image_tags = array("I"), array("I")
+    # grouped once per index version, instead of in every worker
+    groups = HashIndex(images[stem].get("phash") for stem in stems).groups()
+    for image_id, stem in enumerate(stems):
+        metadata = images[stem]
+        tags = metadata.get("tags", [])
+        extra = {key: value for key, value in metadata.items() if key not in ("filename", "tags")}
+        records.extend([sid(stem), sid(metadata.get("filename", "")), len(image_tags), len(tags),
+                        sid(json.dumps(extra, separators=(",", ":")))])
+        records.extend(sid(str(metadata.get(name) or "")) for name in STRING_COLUMNS)
+        records.extend(int(metadata.get(name) or 0) for name in NUMBER_COLUMNS)
+        records.append(groups[image_id])
+        image_tags.extend(sid(tag) for tag in tags)
+        for tag in tags:
+            tag = normalize_tag(tag)
+            if tag:
+                postings_by_tag.setdefault(tag, set()).add(image_id)
+
+    tag_table, postings = array("I"), array("I")
+    for tag in sorted(postings_by_tag):
+        ids = sorted(postings_by_tag[tag])
+        tag_table.extend([sid(tag), len(postings), len(ids)])
+        postings.extend(ids)
+
+    etag_id = sid(etag or "")
+    offsets = array("I", [0])
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+
+    header = HEADER.pack(MAGIC, VERSION, data["generation"], data.get("updated_at") or 0, etag_id,
+                         len(strings), len(tag_table) // TAG_FIELDS, len(postings),
+                         len(stems), len(image_tags))
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(header)
+        for section in (offsets, tag_table, postings, records, image_tags):
+            section.tofile(f)
+        f.write(b"".join(strings))
+    os.replace(tmp_path, path)
+
+
+class _Records(Sequence):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.n_images
+
+    def __getitem__(self, image_id):
+        return self.snapshot.record(image_id)
+
+
+class _Vocabulary(Sequence):
+    """Normalized tags, sorted, read straight from the tag table."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.n_tags
+
+    def __getitem__(self, tag_id):
+        return self.snapshot.string(self.snapshot._tags[tag_id * TAG_FIELDS])
+
+
+class _Stems(Sequence):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.n_images
+
+    def __getitem__(self, image_id):
+        return self.snapshot.string(self.snapshot._images[image_id * IMAGE_FIELDS])
+
+
+class Snapshot(TagIndex):
+    """A read-only view of one snapshot file, searchable like a TagIndex.
+
+    Also behaves like the index's ``{stem: metadata}`` mapping for ``in`` and
+    ``get``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.generation, self.updated_at, etag_id, self.n_strings, self.n_tags,
+         n_postings, self.n_images, n_image_tags) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} gallery snapshot")
+
+        sections = {}
+        view = memoryview(self._mmap)
+        position = HEADER.size
+        for name, count in (("offsets", self.n_strings + 1), ("tags", self.n_tags * TAG_FIELDS),
+                            ("postings", n_postings), ("images", self.n_images * IMAGE_FIELDS),
+                            ("image_tags", n_image_tags)):
+            sections[name] = view[position:position + 4 * count].cast("I")
+            position += 4 * count
+        self._offsets = sections["offsets"]
+        self._tags = sections["tags"]
+        self._postings = sections["postings"]
+        self._images = sections["images"]
+        self._image_tags = sections["image_tags"]
+        self._strings = view[position:]
+        self.etag = self.string(etag_id)
+
+        self.images = _Records(self)
+        self.vocabulary = _Vocabulary(self)
+        self._stems = _Stems(self)
+
+    @property
+    def last_modified(self):
+        return datetime.fromtimestamp(self.updated_at, timezone.utc) if self.updated_at else None
+
+    def string(self, string_id):
+        return str(self._strings[self._offsets[string_id]:self._offsets[string_id + 1]], "utf-8")
+
+    def record(self, image_id):
+        stem, filename, tags_start, tags_count, extra = self._images[image_id * IMAGE_FIELDS:
+                                                                     image_id * IMAGE_FIELDS + 5]
+        metadata = {
+            "filename": self.string(filename),
+            "tags": [self.string(tag) for tag in self._image_tags[tags_start:tags_start + tags_count]],
+        }
+        metadata.update(json.loads(self.string(extra)))
+        return metadata
+
+    def field(self, image_id, name):
+        """One metadata field of an image; the columns are read without decoding the record."""
+        if name not in COLUMNS:
+            return self.record(image_id).get(name)
+        value = self._images[image_id * IMAGE_FIELDS + COLUMNS[name]]
+        if name in NUMBER_COLUMNS:
+            return value or None
+        return self.string(value) or None
+
+    def representative(self, image_id):
+        return self._images[image_id * IMAGE_FIELDS + REPRESENTATIVE]
+
+    def representative_filename(self, stem):
+        """Filename of the image whose derivatives ``stem`` shows, or None if it isn't indexed."""
+        image_id = self._image_id(stem)
+        return None if image_id is None else self.field(self.representative(image_id), "filename")
+
+    def _image_id(self, stem):
+        image_id = bisect_left(self._stems, stem)
+        if image_id < self.n_images and self._stems[image_id] == stem:
+            return image_id
+        return None
+
+    def __contains__(self, stem):
+        return self._image_id(stem) is not None
+
+    def get(self, stem, default=None):
+        image_id = self._image_id(stem)
+        return default if image_id is None else self.record(image_id)
+
+    def _tag_postings(self, tag_id):
+        _, start, count = self._tags[tag_id * TAG_FIELDS:(tag_id + 1) * TAG_FIELDS]
+        return self._postings[start:start + count]
+
+    def _prefixed_ids(self, prefix):
+        tag_id = bisect_left(self.vocabulary, prefix)
+        while tag_id < self.n_tags and self.vocabulary[tag_id].startswith(prefix):
+            yield tag_id
+            tag_id += 1
+
+    def _prefixed(self, prefix):
+        for tag_id in self._prefixed_ids(prefix):
+            yield self.vocabulary[tag_id]
+
+    def lookup(self, term):
+        if term.endswith("*"):
+            matches = set()
+            for tag_id in self._prefixed_ids(term[:-1]):
+                matches.update(self._tag_postings(tag_id))
+            return matches
+        tag_id = bisect_left(self.vocabulary, term)
+        if tag_id < self.n_tags and self.vocabulary[tag_id] == term:
+            return set(self._tag_postings(tag_id))
+        return set()
+
+    def complete(self, prefix, limit=10):
+        counts = [(self.vocabulary[tag_id], len(self._tag_postings(tag_id)))
+                  for tag_id in self._prefixed_ids(normalize_tag(prefix))]
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        return [{"tag": tag, "count": count} for tag, count in counts[:limit]]
+
+
+class SnapshotStore:
+    """Keeps the current Snapshot of a bucket folder's metadata index mapped."""
+
+    def __init__(self, s3, bucket, bucket_folder="", directory=SNAPSHOT_DIR, max_age=0):
+        self.s3 = s3
+        self.bucket = bucket
+        self.bucket_folder = bucket_folder or ""
+        self.directory = directory
+        self.max_age = max_age
+        self.key = MetadataIndex(s3, bucket, bucket_folder).key
+        self._prefix = hashlib.sha1(f"{bucket}/{self.bucket_folder}".encode()).hexdigest()[:12]
+        self._snapshot = None
+        self._checked_at = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, etag):
+        name = f"{self._prefix}-{hashlib.sha1(etag.encode()).hexdigest()[:16]}.v{VERSION}.snap"
+        return os.path.join(self.directory, name)
+
+    def current(self, rebuild_missing=True):
+        """The Snapshot of the current index; None if there is no index and ``rebuild_missing`` is False."""
+        snapshot = self._snapshot
+        if snapshot is not None and self.max_age and time.monotonic() - self._checked_at < self.max_age:
+            return snapshot
+        try:
+            etag = self.s3.head_object(Bucket=self.bucket, Key=self.key)["ETag"]
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            if not rebuild_missing:
+                return None
+            etag = None
+
+        if snapshot is None or snapshot.etag != etag:
+            if etag is not None and os.path.exists(self._path(etag)):
+                count_cache("snapshot", "mapped")
+                snapshot = Snapshot(self._path(etag))
+            else:
+                snapshot = self._build()
+            # workers still holding the old one keep their mapping until they drop it
+            self._snapshot = snapshot
+        self._checked_at = time.monotonic()
+        return snapshot
+
+    def last_modified(self):
+        """``(generation, datetime of the last write)`` for HTTP validators."""
+        snapshot = self.current()
+        return snapshot.generation, snapshot.last_modified
+
+    def _build(self):
+        # one worker builds while the others wait, then map its file
+        with open(os.path.join(self.directory, f"{self._prefix}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = MetadataIndex(self.s3, self.bucket, self.bucket_folder)
+            data = index.load()
+            path = self._path(index._etag)
+            if os.path.exists(path):
+                count_cache("snapshot", "mapped")
+            else:
+                count_cache("snapshot", "built")
+                write_snapshot(path, data, index._etag)
+                self._prune()
+        return Snapshot(path)
+
+    def _prune(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, f"{self._prefix}-*.snap")), key=os.path.getmtime)
+        for path in paths[:-SNAPSHOTS_KEPT]:
+            # unlinking is safe; processes that mapped it keep their pages
+            os.remove(path)
@@ -0,0 +1,161 @@
+"""In-memory inverted tag index.
+
+Maps every tag to the set of image ids carrying it so that searches only touch
+the posting lists of the queried tags. Queries are whitespace/comma separated
+terms combined with AND by default::
+
+    beach sunset          images tagged beach AND sunset
+    beach OR lake         images tagged beach OR lake
+    beach -night          beach but NOT night (``NOT night`` works too)
+    beac*                 any tag starting with "beac"
+
+Tags are written with their words joined by "-" (``normalize_tag``), so a
+multi-word tag is searched as ``new-york``; older records holding
+``new york`` are indexed the same way.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import re
+
+from common.duplicates import HashIndex
+from common.metadata_index import normalize_tag
+
+OR = "or"
+NOT = "not"
+
+
+def parse_query(query):
+    """Split a query into OR-ed clauses of ``(included, excluded)`` terms."""
+    clauses = []
+    included, excluded = [], []
+    negate = False
+    for term in re.split(r"[\s,]+", query.strip().lower()):
+        if not term:
+            continue
+        if term == OR:
+            if included or excluded:
+                clauses.append((included, excluded))
+            included, excluded = [], []
+            continue
+        if term == NOT:
+            negate = True
+            continue
+        if term.startswith("-") and len(term) > 1:
+            term, negate = term[1:], True
+        (excluded if negate else included).append(term)
+        negate = False
+    if included or excluded:
+        clauses.append((included, excluded))
+    return clauses
+
+
+def compile_query(query):
+    """Return a ``predicate(tags)`` evaluating ``query`` against one image's tags.
+
+    Used where records arrive one at a time (streaming) instead of through
+    a built TagIndex.
+    """
+    clauses = parse_query(query)
+
+    def has(tags, term):
+        if term.endswith("*"):
+            return any(tag.startswith(term[:-1]) for tag in tags)
+        return term in tags
+
+    def predicate(tags):
+        if not clauses:
+            return True
+        tags = {normalize_tag(tag) for tag in tags}
+        return any(
+            all(has(tags, term) for term in included) and not any(has(tags, term) for term in excluded)
+            for included, excluded in clauses
+        )
+    return predicate
+
+
+class TagIndex:
+    def __init__(self, images):
+        self.images = list(images)
+        postings = defaultdict(set)
+        for image_id, metadata in enumerate(self.images):
+            for tag in metadata.get("tags", []):
+                tag = normalize_tag(tag)
+                if tag:
+                    postings[tag].add(image_id)
+        self.postings = dict(postings)
+        self.vocabulary = sorted(self.postings)
+        self._groups = None
+
+    def _prefixed(self, prefix):
+        start = bisect_left(self.vocabulary, prefix)
+        for tag in self.vocabulary[start:]:
+            if not tag.startswith(prefix):
+                break
+            yield tag
+
+    def lookup(self, term):
+        if term.endswith("*"):
+            matches = set()
+            for tag in self._prefixed(term[:-1]):
+                matches |= self.postings[tag]
+            return matches
+        return self.postings.get(term, set())
+
+    def _clause(self, included, excluded):
+        if included:
+            # intersect starting from the rarest term to keep the work small
+            postings = sorted((self.lookup(term) for term in included), key=len)
+            matches = set(postings[0])
+            for posting in postings[1:]:
+                matches &= posting
+                if not matches:
+                    return matches
+        else:
+            matches = set(range(len(self.images)))
+        for term in excluded:
+            matches -= self.lookup(term)
+        return matches
+
+    def search_ids(self, query):
+        clauses = parse_query(query)
+        if not clauses:
+            return list(range(len(self.images)))
+        matches = set()
+        for included, excluded in clauses:
+            matches |= self._clause(included, excluded)
+        return sorted(matches)
+
+    def search(self, query):
+        return [self.images[image_id] for image_id in self.search_ids(query)]
+
+    def field(self, image_id, name):
+        return self.images[image_id].get(name)
+
+    def representative(self, image_id):
+        """Id of the image representing ``image_id``'s group of near-duplicates."""
+        if self._groups is None:
+            self._groups = HashIndex(metadata.get("phash") for metadata in self.images).groups()
+        return self._groups[image_id]
+
+    def complete(self, prefix, limit=10):
+        prefix = normalize_tag(prefix)
+        tags = sorted(self._prefixed(prefix), key=lambda tag: (-len(self.postings[tag]), tag))
+        return [{"tag": tag, "count": len(self.postings[tag])} for tag in tags[:limit]]
+
+
+class CachedTagIndex:
+    """Keeps a TagIndex in sync with a MetadataIndex, rebuilding per generation."""
+
+    def __init__(self, metadata_index, max_age=0):
+        self.metadata_index = metadata_index
+        self.max_age = max_age
+        self._generation = None
+        self._tag_index = None
+
+    def current(self):
+        data = self.metadata_index.load(max_age=self.max_age)
+        if self._tag_index is None or data["generation"] != self._generation:
+            images = data["images"]
+            self._tag_index = TagIndex(images[stem] for stem in sorted(images))
+            self._generation = data["generation"]
+        return self._tag_index
@@ -1,34 +1,92 @@
-from flask import Flask, render_template, request
-import boto3
-import json
+from datetime import datetime, timezone
+from flask import Flask, jsonify, render_template, request, url_for
+import time
 from dotenv import load_dotenv
 
+from common.derivatives import derivative_key
+from common.http_cache import conditional
+from common.image_info import arrange, view_options
+from common.image_proxy import init_app as init_image_proxy
+from common.metadata_index import MetadataIndex
+from common.metrics import init_app as init_metrics
+from common.pagination import DEFAULT_LIMIT, paginate, parse_limit
+from common.s3 import get_client
+from common.tag_index import CachedTagIndex
+
 load_dotenv()
 
 app = Flask(__name__)
-s3 = boto3.client('s3')
+init_metrics(app, "gallery")
+s3 = get_client()
 BUCKET = 'taiwo-images'
+metadata_index = MetadataIndex(s3, BUCKET)
+tag_index = CachedTagIndex(metadata_index)
+init_image_proxy(app, s3, BUCKET)
+PRESIGNED_URL_EXPIRY = 3600
+# pages embed presigned URLs, so a revalidated page must be re-rendered well before they expire
+PRESIGNED_URL_ROTATION = PRESIGNED_URL_EXPIRY // 2
+
+def gallery_state():
+    generation, last_modified = metadata_index.last_modified()
+    window = int(time.time() // PRESIGNED_URL_ROTATION)
+    window_start = datetime.fromtimestamp(window * PRESIGNED_URL_ROTATION, timezone.utc)
+    return f"{generation}:{window}", max(filter(None, [last_modified, window_start]))
+
+def image_page(search, cursor=None, limit=DEFAULT_LIMIT, options=None):
+    image_entries = []
+    index = tag_index.current()
+    image_ids = arrange(index, index.search_ids(search), **(options or {}))
+    page, next_cursor = paginate(image_ids, cursor, limit)
+    for image_id in page:
+        metadata = index.images[image_id]
+        # near-duplicates share the derivatives of the image representing them
+        representative = index.images[index.representative(image_id)]
+        image_url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': BUCKET, 'Key': f"images/{metadata['filename']}"},
+            ExpiresIn=PRESIGNED_URL_EXPIRY
+        )
+        thumbnail_url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': BUCKET, 'Key': derivative_key("", representative['filename'], "thumbnail")},
+            ExpiresIn=PRESIGNED_URL_EXPIRY
+        )
+        image_entries.append({
+            "url": image_url,
+            "thumbnail_url": thumbnail_url,
+            # rendered on demand when the derivative hasn't been generated yet
+            "fallback_url": url_for("image_variant", key=f"images/{metadata['filename']}", w=300),
+            "tags": metadata["tags"],
+            "filename": metadata["filename"],
+            "width": metadata.get("width"),
+            "height": metadata.get("height"),
+            "taken_at": metadata.get("taken_at"),
+        })
+    return image_entries, next_cursor
 
 @app.route("/", methods=["GET"])
+@conditional(gallery_state)
 def gallery():
     search = request.args.get("search", "").lower()
-    image_entries = []
+    options = view_options(request.args)
+    image_entries, next_cursor = image_page(search, options=options)
+    return render_template("gallery.html", images=image_entries, search=search, options=options,
+                           next_cursor=next_cursor)
+
+@app.route("/api/images", methods=["GET"])
+@conditional(gallery_state)
+def list_images():
+    search = request.args.get("search", "").lower()
+    image_entries, next_cursor = image_page(search, request.args.get("cursor"), parse_limit(request.args.get("limit")),
+                                            view_options(request.args))
+    return jsonify({"images": image_entries, "next_cursor": next_cursor})
 
-    result = s3.list_objects_v2(Bucket=BUCKET, Prefix="metadata/")
-    if "Contents" in result:
-        for item in result["Contents"]:
-            metadata_file = item["Key"]
-            obj = s3.get_object(Bucket=BUCKET, Key=metadata_file)
-            metadata = json.loads(obj["Body"].read())
-            if not search or search in metadata["tags"]:
-                image_url = s3.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': BUCKET, 'Key': f"images/{metadata['filename']}"},
-                    ExpiresIn=3600
-                )
-                image_entries.append((image_url, metadata["tags"]))
-
-    return render_template("gallery.html", images=image_entries)
+@app.route("/api/tags", methods=["GET"])
+@conditional(gallery_state)
+def autocomplete_tags():
+    prefix = request.args.get("prefix", "")
+    limit = parse_limit(request.args.get("limit"), 10)
+    return jsonify(tag_index.current().complete(prefix, limit=limit))
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,87 +1,186 @@
-from datetime import datetime
-from flask import Flask, render_template, request, redirect
-import boto3
+from flask import Flask, Response, jsonify, render_template, request, redirect, stream_template, stream_with_context, url_for
 import json
 from dotenv import load_dotenv
 import os
 from werkzeug.utils import secure_filename
 
+from common.derivatives import derivative_key, generate_derivatives
+from common.http_cache import conditional
+from common.image_proxy import init_app as init_image_proxy
+from common.metadata_index import IndexBusy, MetadataIndex, WriteConflict, metadata_stem, update_record
+from common.metrics import init_app as init_metrics
+from common.pagination import list_page, parse_limit
+from common.reconciler import Reconciler, derivatives_handler, image_info_handler, index_handler, phash_handler
+from common.s3 import fetch_many, get_client
+from common.snapshot import SnapshotStore
+from jobs import JOBS_DB, JobQueue
+from planner import list_objects, plan
 from utils import convert_heic_from_s3
 
 load_dotenv()
 
 app = Flask(__name__)
-s3 = boto3.client('s3')
+init_metrics(app, "gallery_edit")
+s3 = get_client()
 BUCKET = os.getenv("S3_BUCKET")
 BUCKET_FOLDER = os.getenv("BUCKET_FOLDER")
+# the edit page renders a full-size image plus a form per row, so keep pages short
+DEFAULT_LIMIT = 20
+# S3 writes in flight per /update/batch request
+BATCH_UPDATE_WORKERS = int(os.getenv("BATCH_UPDATE_WORKERS", 16))
+MAX_BATCH_UPDATES = 1000
+# seconds clients should wait before retrying when the index write is contended
+INDEX_RETRY_AFTER = 5
+# seconds between passes looking for images synced into the bucket directly; 0 disables it
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", 0))
+# ask proxies such as nginx to pass streamed chunks through immediately
+STREAMING_HEADERS = {"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+metadata_index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+snapshots = SnapshotStore(s3, BUCKET, BUCKET_FOLDER)
+init_image_proxy(app, s3, BUCKET, BUCKET_FOLDER)
+
+def convert_heic_job(job, report):
+    image_key, new_image_key = job["key"], job["target_key"]
+    report("checking for an existing png")
+    # one listing of the image stem covers both keys and tells us if the png is stale
+    objects = list_objects(s3, BUCKET, os.path.splitext(image_key)[0])
+    if image_key not in objects:
+        raise FileNotFoundError(f"source missing: {image_key} does not exist")
+    work = plan(objects, objects, lambda key: new_image_key if key == image_key else None)
+    if not work:
+        print('png exists. Skipping...')
+        return "png exists"
+
+    print(f'png is {work[0].reason}. Converting from heic to png...')
+    report(f"converting ({work[0].reason} png)")
+    convert_heic_from_s3(
+        bucket=BUCKET,
+        key=image_key,
+        output_format="PNG",
+        save_to_s3=True,
+        output_bucket=BUCKET,
+        output_key=new_image_key
+    )
+    return "converted"
+
+def derivatives_job(job, report):
+    report("rendering derivatives")
+    keys = generate_derivatives(s3, BUCKET, job["key"], BUCKET_FOLDER)
+    return f"rendered {len(keys)} sizes"
+
+jobs = JobQueue(JOBS_DB, {"heic_to_png": convert_heic_job, "derivatives": derivatives_job})
+jobs.start()
+
+reconciler = Reconciler(s3, BUCKET, BUCKET_FOLDER, handlers=[
+    index_handler(metadata_index),
+    image_info_handler(metadata_index),
+    phash_handler(metadata_index),
+    derivatives_handler(s3, BUCKET, BUCKET_FOLDER, lambda key: jobs.enqueue("derivatives", key)),
+])
+if RECONCILE_INTERVAL:
+    reconciler.start(RECONCILE_INTERVAL)
 
 @app.route("/heic", methods=["POST"])
 def convert_heic():
     if request.method == "POST":
-        image_key = request.form["heic_key"]
+        # the gallery page posts the filename, scripts may post the full key
+        image_key = request.form.get("heic_key") or f"{BUCKET_FOLDER}images/{request.form.get('filename', '')}"
         # handle iphone HEIC formats
         if image_key.lower().endswith('heic'):
-            print("object is of heic ext. Converting to png...")
+            print("object is of heic ext. Queueing conversion to png...")
             new_image_key = f"{os.path.splitext(image_key)[0]}.png"
-            png_exists = False
-            # check if png exists
-            try:
-                s3.head_object(Bucket=BUCKET, Key=new_image_key)
-                png_exists = True
-            except s3.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == "404":
-                    pass
-
-            if png_exists:
-                print('png exists. Skipping...')
-            else:
-                print('png does not exist. Converting from heic to png...')
-                convert_heic_from_s3(
-                    bucket=BUCKET,
-                    key=image_key,
-                    output_format="PNG",
-                    save_to_s3=True,
-                    output_bucket=BUCKET,
-                    output_key=new_image_key
-                )
-                image_key = new_image_key
-            return {"OK": "Updated"}, 200
-            
+            job, created = jobs.enqueue("heic_to_png", image_key, new_image_key)
+            return {"job_id": job["id"], "status": job["status"], "created": created}, 202
+
         return {"error": "Something's wrong"}, 400
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return jsonify(job)
+
+def image_entry(image_key, indexed):
+    # handle iphone HEIC formats
+    is_heic = image_key.lower().endswith('heic')
+
+    image_signed_path = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{image_key}"
+    image_filename = image_key.split(f"{BUCKET_FOLDER}images/")[-1]
+    metadata = indexed.get(metadata_stem(image_filename), {"tags": []})
+    # near-duplicates show the derivatives of their group's representative, as in the other galleries
+    derivatives_of = indexed.representative_filename(metadata_stem(image_filename)) or image_filename
+    medium_url = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{derivative_key(BUCKET_FOLDER, derivatives_of, 'medium')}"
+    return {
+        "url": image_signed_path,
+        "medium_url": medium_url,
+        # rendered on demand when the derivative hasn't been generated yet
+        "fallback_url": url_for("image_variant", key=image_key, w=800),
+        "tags": metadata["tags"],
+        "filename": image_filename,
+        "is_heic": is_heic,
+    }
+
+def listing_filter(search, indexed):
+    if search:
+        matches = {metadata_stem(metadata['filename']) for metadata in indexed.search(search)}
+
+    def is_listed(item):
+        if item["Key"].endswith('/'):
+            # Skip directories
+            return False
+        stem = metadata_stem(item["Key"])
+        # TODO: consider excluding images with no metadata. Temporarily used as forcing metadata declaration
+        return not search or stem not in indexed or stem in matches
+    return is_listed
+
+def image_page(search, cursor=None, limit=DEFAULT_LIMIT):
+    indexed = snapshots.current()
+    is_listed = listing_filter(search, indexed)
+    page, next_cursor = list_page(s3, BUCKET, f"{BUCKET_FOLDER}images/", cursor, limit, predicate=is_listed)
+    return [image_entry(item["Key"], indexed) for item in page], next_cursor
+
+def stream_entries(search):
+    # emit every listing page as soon as it arrives instead of after the whole bucket
+    indexed = snapshots.current()
+    is_listed = listing_filter(search, indexed)
+    paginator = s3.get_paginator("list_objects_v2")
+    for result in paginator.paginate(Bucket=BUCKET, Prefix=f"{BUCKET_FOLDER}images/"):
+        for item in result.get("Contents", []):
+            if is_listed(item):
+                yield image_entry(item["Key"], indexed)
+
+# the gallery views list images/ live, so an index-derived validator would hide out-of-band uploads
 @app.route("/", methods=["GET"])
 def gallery():
     search = request.args.get("search", "").lower()
-    image_entries = []
-
-    result = s3.list_objects_v2(Bucket=BUCKET, Prefix=f"{BUCKET_FOLDER}images/")
-    flag = False
-    if "Contents" in result:
-        for item in result["Contents"]:
-            image_key = item["Key"]
-            if image_key.endswith('/'):
-                # Skip directories
-                continue
-
-            is_heic = False
-            # handle iphone HEIC formats
-            if image_key.lower().endswith('heic'):
-                is_heic = True
-
-            image_signed_path = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{image_key}"
-            image_filename = image_key.split(f"{BUCKET_FOLDER}images/")[-1]
-            metadata_key = f"{BUCKET_FOLDER}metadata/{os.path.splitext(image_filename)[0]}.json"
-            # check if metadata exists
-            try:
-                obj = s3.get_object(Bucket=BUCKET, Key=metadata_key)
-                metadata = json.loads(obj["Body"].read())
-                if not search or search in metadata["tags"]:
-                    image_entries.append((image_signed_path, metadata["tags"], image_filename, is_heic))
-            except s3.exceptions.NoSuchKey as e:
-                # TODO: consider excluding images with no metadata. Temporarily used as forcing metadata declaration
-                image_entries.append((image_signed_path, [], image_filename, is_heic))
-
-    return render_template("gallery.html", images=image_entries)
+    image_entries, next_cursor = image_page(search)
+    return render_template("gallery.html", images=image_entries, search=search, next_cursor=next_cursor)
+
+@app.route("/api/images", methods=["GET"])
+def list_images():
+    search = request.args.get("search", "").lower()
+    image_entries, next_cursor = image_page(search, request.args.get("cursor"), parse_limit(request.args.get("limit"), DEFAULT_LIMIT))
+    return jsonify({"images": image_entries, "next_cursor": next_cursor})
+
+@app.route("/api/tags", methods=["GET"])
+@conditional(snapshots.last_modified)
+def autocomplete_tags():
+    prefix = request.args.get("prefix", "")
+    limit = parse_limit(request.args.get("limit"), 10)
+    return jsonify(snapshots.current().complete(prefix, limit=limit))
+
+@app.route("/stream", methods=["GET"])
+def gallery_stream():
+    search = request.args.get("search", "").lower()
+    body = stream_template("gallery.html", images=stream_entries(search), search=search, next_cursor=None)
+    return Response(body, mimetype="text/html", headers=STREAMING_HEADERS)
+
+@app.route("/api/images/stream", methods=["GET"])
+def stream_images():
+    search = request.args.get("search", "").lower()
+    records = (json.dumps(entry) + "\n" for entry in stream_entries(search))
+    return Response(stream_with_context(records), mimetype="application/x-ndjson", headers=STREAMING_HEADERS)
 
 @app.route("/update", methods=["POST"])
 def update_tags():
@@ -91,30 +190,81 @@ def update_tags():
         filename = secure_filename(filename)
         tag_list = [tag.strip().lower() for tag in tags.split(",")]
 
-        # create metadata if not exists
-        metadata_filename = f"{BUCKET_FOLDER}metadata/{os.path.splitext(filename)[0]}.json"
+        # creates the metadata if it doesn't exist yet
+        try:
+            metadata, _, _ = update_record(s3, BUCKET, BUCKET_FOLDER, filename, tags=tag_list)
+        except WriteConflict as e:
+            return {"error": str(e)}, 409
+        print("metadata:", metadata)
         try:
-            obj = s3.get_object(Bucket=BUCKET, Key=metadata_filename)
-            metadata = json.loads(obj["Body"].read())
-            print("metadata:", metadata)
-            # Update metadata
-            metadata = {
-                "filename": metadata['filename'],
-                "tags": tag_list,
-                "uploaded_at": metadata['uploaded_at']
-            }
-            s3.put_object(Body=json.dumps(metadata), Bucket=BUCKET, Key=metadata_filename)
-        except s3.exceptions.NoSuchKey as e:
-            metadata = {
-                "filename": filename,
-                "tags": tag_list,
-                "uploaded_at": datetime.utcnow().isoformat()
-            }
-            s3.put_object(Body=json.dumps(metadata), Bucket=BUCKET, Key=metadata_filename)
+            metadata_index.put(metadata)
+        except IndexBusy as e:
+            # the record is saved; the reconciler (or the next edit) brings the index up to date
+            print(f"index update of {filename} deferred: {e}")
+            return ({"error": "Saved, but the gallery index is busy and will catch up", "saved": True},
+                    503, {"Retry-After": str(INDEX_RETRY_AFTER)})
 
         return {"OK": "Updated"}, 200
 
     return {"error": "Something bad happened"}, 500
 
+def clean_tags(tags):
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return [tag.strip().lower() for tag in tags if tag.strip()]
+
+@app.route("/update/batch", methods=["POST"])
+def update_tags_batch():
+    """Apply many tag edits at once.
+
+    Takes ``{"updates": [{"filename", "tags" | "add"/"remove", "etag"?}, ...]}``
+    and returns a result per update, in order, so clients can retry only
+    the ones that failed or conflicted. Saved updates carry ``"index":
+    "pending"`` when the index write was contended; the galleries pick them
+    up once the reconciler or a later edit updates the index.
+    """
+    body = request.get_json(silent=True)
+    updates = body.get("updates") if isinstance(body, dict) else None
+    if not isinstance(updates, list) or not updates:
+        return {"error": "Expected a non-empty 'updates' list"}, 400
+    if len(updates) > MAX_BATCH_UPDATES:
+        return {"error": f"At most {MAX_BATCH_UPDATES} updates per request"}, 400
+
+    def apply(update):
+        filename = secure_filename(str(update.get("filename", ""))) if isinstance(update, dict) else ""
+        result = {"filename": filename}
+        if not filename:
+            result.update(status="error", error="Missing filename")
+            return result, None
+        try:
+            metadata, etag, created = update_record(
+                s3, BUCKET, BUCKET_FOLDER, filename,
+                tags=clean_tags(update["tags"]) if "tags" in update else None,
+                add=clean_tags(update.get("add", [])),
+                remove=clean_tags(update.get("remove", [])),
+                etag=update.get("etag"),
+            )
+        except WriteConflict as e:
+            result.update(status="conflict", error=str(e))
+            return result, None
+        except Exception as e:
+            result.update(status="error", error=str(e))
+            return result, None
+        result.update(status="created" if created else "updated", tags=metadata["tags"], etag=etag)
+        return result, metadata
+
+    outcomes = fetch_many(apply, updates, max_workers=BATCH_UPDATE_WORKERS)
+    # one index write for the whole batch
+    changed = {metadata_stem(metadata["filename"]): metadata for _, metadata in outcomes if metadata}
+    if changed:
+        try:
+            metadata_index.update(changed)
+        except IndexBusy as e:
+            print(f"index update of {len(changed)} records deferred: {e}")
+            for result, metadata in outcomes:
+                if metadata:
+                    result["index"] = "pending"
+    return jsonify({"results": [result for result, _ in outcomes]})
+
 if __name__ == "__main__":
     app.run(debug=True)
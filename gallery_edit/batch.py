@@ -0,0 +1,132 @@
+"""Parallel, resumable bulk conversions for the Streamlit "Convert all" buttons.
+
+S3 downloads/uploads run on a thread pool while the Pillow decode/encode work
+runs on a process pool, so a batch uses every core instead of the Streamlit
+script thread alone. Every finished target key is appended to a checkpoint
+file; rerunning an interrupted batch skips those keys without touching S3.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+import json
+import os
+import re
+
+from common.derivatives import render_derivatives
+from common.memory import conversion_budget, image_footprint
+from common.s3 import object_args
+from utils import convert_image, make_thumbnail, s3
+
+IO_WORKERS = int(os.getenv("BATCH_IO_WORKERS", 16))
+CPU_WORKERS = int(os.getenv("BATCH_CPU_WORKERS", os.cpu_count() or 1))
+CHECKPOINT_DIR = os.getenv("BATCH_CHECKPOINT_DIR", ".checkpoints")
+
+ConversionTask = namedtuple("ConversionTask", ["source_key", "target_key", "operation", "options"])
+BatchResult = namedtuple("BatchResult", ["converted", "skipped", "failed"])
+
+
+def _convert(image_bytes, output_format="PNG", quality=None, profile=None):
+    return convert_image(image_bytes, output_format=output_format, quality=quality, profile=profile).getvalue()
+
+
+def _thumbnail(image_bytes, size=(200, 200), profile=None):
+    return make_thumbnail(image_bytes, size=size, profile=profile).getvalue()
+
+
+OPERATIONS = {
+    "convert": _convert,
+    "thumbnail": _thumbnail,
+    # returns {size: bytes}; the task's "targets" option maps each size to its key
+    "derivatives": render_derivatives,
+}
+
+
+def checkpoint_path(name):
+    return os.path.join(CHECKPOINT_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', name)}.jsonl")
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["target_key"])
+            except (ValueError, KeyError):
+                # a run killed mid-write leaves a truncated last line
+                continue
+    return done
+
+
+def run_batch(bucket, tasks, checkpoint=None, progress=None,
+              io_workers=IO_WORKERS, cpu_workers=CPU_WORKERS):
+    """Run ``tasks`` (usually from planner.plan_prefixes) and return a BatchResult.
+
+    ``progress(done, total, task)`` is called from the calling thread after
+    every task, so it may safely update Streamlit elements. The checkpoint is
+    removed once a batch finishes without failures; the planner already
+    knows which targets exist, so it only matters for interrupted runs.
+    """
+    tasks = list(tasks)
+    total = len(tasks)
+    done = load_checkpoint(checkpoint) if checkpoint else set()
+    pending = [task for task in tasks if task.target_key not in done]
+
+    if checkpoint:
+        os.makedirs(os.path.dirname(checkpoint) or ".", exist_ok=True)
+    log = open(checkpoint, "a") if checkpoint else None
+
+    def record(task, status):
+        if log:
+            log.write(json.dumps({"target_key": task.target_key, "status": status}) + "\n")
+            log.flush()
+
+    try:
+        skipped = total - len(pending)
+        completed = skipped
+        if progress:
+            progress(completed, total, None)
+
+        converted, failed = 0, []
+        with ProcessPoolExecutor(max_workers=cpu_workers) as cpu_pool, \
+                ThreadPoolExecutor(max_workers=io_workers) as io_pool:
+
+            def process(task):
+                response = s3.get_object(Bucket=bucket, Key=task.source_key)
+                source = response["Body"].read()
+                options = dict(task.options)
+                targets = options.pop("targets", None)
+                # the decode happens in a worker process, but the budget is this process's to spend
+                with conversion_budget.reserve(image_footprint(BytesIO(source))):
+                    output = cpu_pool.submit(OPERATIONS[task.operation], source, **options).result()
+                del source
+                if targets:
+                    # upload the task's own target last so its presence means the task finished
+                    for name in sorted(output, key=lambda name: targets[name] == task.target_key):
+                        s3.put_object(Bucket=bucket, Key=targets[name], Body=output[name],
+                                      **object_args(targets[name]))
+                else:
+                    s3.put_object(Bucket=bucket, Key=task.target_key, Body=output, **object_args(task.target_key))
+                return task
+
+            futures = {io_pool.submit(process, task): task for task in pending}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    future.result()
+                    record(task, "converted")
+                    converted += 1
+                except Exception as e:
+                    print(f"failed to convert {task.source_key}: {e}")
+                    failed.append((task, e))
+                completed += 1
+                if progress:
+                    progress(completed, total, task)
+    finally:
+        if log:
+            log.close()
+
+    if checkpoint and not failed:
+        os.remove(checkpoint)
+    return BatchResult(converted, skipped, failed)
@@ -0,0 +1,156 @@
+"""SQLite-backed background job queue for slow per-image work such as ``/heic``.
+
+A request only inserts a row and returns its id; worker threads started in
+every gunicorn worker claim queued rows and run them. The queue lives in one
+SQLite file on the host, so all workers share it and no outside service is
+needed. A partial unique index allows at most one queued or running job per
+(kind, key): asking again for a key that is already in flight returns the
+existing job instead of doing the work twice. A running job whose worker died
+is picked up again once its lease runs out.
+"""
+from contextlib import closing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+JOBS_DB = os.getenv("JOBS_DB", "/tmp/gallery-jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# seconds a claimed job may run before another worker may take it over
+JOB_LEASE = int(os.getenv("JOB_LEASE", 600))
+# finished jobs are kept this long for the status endpoint
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", 86400))
+POLL_INTERVAL = 1
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    target_key TEXT,
+    status TEXT NOT NULL,
+    detail TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_in_flight ON jobs (kind, key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+"""
+
+COLUMNS = ("id", "kind", "key", "target_key", "status", "detail", "attempts", "created_at", "updated_at")
+
+
+class JobQueue:
+    def __init__(self, path, handlers):
+        """``handlers`` maps a job kind to ``fn(job, report)``.
+
+        The handler calls ``report(detail)`` to publish progress and returns a
+        final detail string; raising marks the job failed.
+        """
+        self.path = path
+        self.handlers = handlers
+        self._wakeup = threading.Event()
+        with closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        # autocommit; claim() opens its own write transaction
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, kind, key, target_key=None):
+        """Queue a job, or return the job already in flight for ``key``; returns ``(job, created)``."""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as db:
+            db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                       (DONE, FAILED, now - JOB_RETENTION))
+            row = None
+            while row is None:
+                inserted = db.execute(
+                    "INSERT OR IGNORE INTO jobs (id, kind, key, target_key, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, key, target_key, QUEUED, now, now),
+                ).rowcount
+                row = db.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE kind = ? AND key = ? AND status IN (?, ?)",
+                    (kind, key, *ACTIVE),
+                ).fetchone()
+                if row is None:
+                    # the job in flight (ours, or the one that blocked the insert) finished in
+                    # between; report it, or insert again if it is already gone
+                    row = db.execute(
+                        f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE kind = ? AND key = ? "
+                        "ORDER BY updated_at DESC LIMIT 1",
+                        (kind, key),
+                    ).fetchone()
+        self._wakeup.set()
+        return dict(zip(COLUMNS, row)), bool(inserted)
+
+    def get(self, job_id):
+        with closing(self._connect()) as db:
+            row = db.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def claim(self):
+        """Take the oldest runnable job, or None."""
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            job = dict(zip(COLUMNS, row))
+            db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                (RUNNING, now + JOB_LEASE, now, job["id"]),
+            )
+            db.execute("COMMIT")
+        job["status"] = RUNNING
+        return job
+
+    def update(self, job_id, status=None, detail=None):
+        with closing(self._connect()) as db:
+            db.execute(
+                "UPDATE jobs SET status = COALESCE(?, status), detail = ?, updated_at = ? WHERE id = ?",
+                (status, detail, time.time(), job_id),
+            )
+
+    def run_one(self):
+        job = self.claim()
+        if job is None:
+            return False
+        try:
+            detail = self.handlers[job["kind"]](job, lambda detail: self.update(job["id"], detail=detail))
+            self.update(job["id"], DONE, detail)
+        except Exception as e:
+            print(f"job {job['id']} ({job['kind']} {job['key']}) failed: {e}")
+            self.update(job["id"], FAILED, str(e))
+        return True
+
+    def _work(self):
+        while True:
+            try:
+                busy = self.run_one()
+            except sqlite3.Error as e:
+                print(f"job queue error: {e}")
+                busy = False
+            if not busy:
+                # jobs queued by other processes are found by polling
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def start(self, workers=JOB_WORKERS):
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
@@ -0,0 +1,50 @@
+"""Work planner for derivative images (PNG/JPEG conversions, thumbnails).
+
+Rather than sending a HEAD request per image to find out whether its
+derivative exists, the planner lists the source and target prefixes once and
+diffs the listings in memory. A derivative older than its source is reported
+as stale so it gets regenerated too.
+"""
+from collections import namedtuple
+
+PlannedWork = namedtuple("PlannedWork", ["source_key", "target_key", "reason"])
+
+MISSING = "missing"
+STALE = "stale"
+
+
+def list_objects(s3, bucket, prefix):
+    """Return ``{key: listing entry}`` for every object under ``prefix``."""
+    paginator = s3.get_paginator("list_objects_v2")
+    return {
+        item["Key"]: item
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if not item["Key"].endswith("/")
+    }
+
+
+def plan(source_objects, target_objects, target_key_for):
+    """Diff two listings; ``target_key_for(source_key)`` returns None to skip a source."""
+    work = []
+    for source_key in sorted(source_objects):
+        target_key = target_key_for(source_key)
+        if target_key is None:
+            continue
+        target = target_objects.get(target_key)
+        if target is None:
+            work.append(PlannedWork(source_key, target_key, MISSING))
+        elif source_objects[source_key]["LastModified"] > target["LastModified"]:
+            work.append(PlannedWork(source_key, target_key, STALE))
+    return work
+
+
+def plan_prefixes(s3, bucket, source_prefix, target_prefix, target_key_for):
+    """List ``source_prefix`` and ``target_prefix`` once each and plan the work."""
+    source_objects = list_objects(s3, bucket, source_prefix)
+    if target_prefix.startswith(source_prefix):
+        # the targets are already part of the source listing
+        target_objects = {key: item for key, item in source_objects.items() if key.startswith(target_prefix)}
+    else:
+        target_objects = list_objects(s3, bucket, target_prefix)
+    return plan(source_objects, target_objects, target_key_for)
@@ -1,11 +1,20 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import boto3
 import json
 import os
+import random
 from dotenv import load_dotenv
 
-from utils import convert_heic_from_s3, generate_thumbnail
+from common.derivatives import (
+    DERIVATIVE_FORMAT, DERIVATIVE_SIZES, DERIVATIVES_FOLDER, derivative_key, derivative_keys,
+)
+from common.duplicates import redundant_work
+from common.encoding import ENCODE_PROFILE, PROFILES, measure
+from common.metadata_index import IndexBusy, MetadataIndex, WriteConflict, metadata_stem, update_record
+from common.s3 import get_objects, is_missing, make_client
+from batch import ConversionTask, checkpoint_path, run_batch
+from planner import list_objects, plan_prefixes
+from utils import convert_heic_from_s3
 
 # Load environment variables
 load_dotenv()
@@ -21,9 +30,17 @@ IMAGES_FOLDER = 'images/'
 THUMBNAIL_FOLDER = 'thumbnails/'
 METADATA_FOLDER = 'metadata/'
 
+# lookups are memoized for this long (seconds); our own writes invalidate them
+LOOKUP_TTL = int(os.getenv("LOOKUP_TTL", 300))
+PRESIGNED_URL_EXPIRY = 3600
+# images on either side of the current one to fetch ahead
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", 3))
+PREVIEW_SIZE = "large"
+# images encoded by the "Measure encode profiles" button
+MEASURE_SAMPLE = int(os.getenv("ENCODE_MEASURE_SAMPLE", 5))
+
 # S3 client
-s3 = boto3.client(
-    "s3",
+s3 = make_client(
     region_name=S3_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
@@ -33,32 +50,44 @@ def extract_filename_from_s3key(s3key):
     return os.path.splitext(os.path.basename(s3key))[0]
 
 def list_images(bucket_folder):
-    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=f"{bucket_folder}{IMAGES_FOLDER}")
-    return [obj["Key"] for obj in response.get("Contents", [])]
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=BUCKET, Prefix=f"{bucket_folder}{IMAGES_FOLDER}")
+    return [obj["Key"] for page in pages for obj in page.get("Contents", [])]
     # return [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].lower().endswith((".jpg", ".jpeg", ".png"))]
 
-def get_metadata(bucket_folder, image_key):
-    filename = extract_filename_from_s3key(image_key)
-    meta_key = f"{bucket_folder}{METADATA_FOLDER}{filename}.json"
+@st.cache_data(ttl=LOOKUP_TTL, show_spinner=False)
+def load_metadata(meta_key):
+    """``(record, ETag)``; the ETag is None when the record doesn't exist yet."""
     try:
         meta_obj = s3.get_object(Bucket=BUCKET, Key=meta_key)
-        return json.loads(meta_obj["Body"].read()), meta_key
+        return json.loads(meta_obj["Body"].read()), meta_obj["ETag"]
     except s3.exceptions.ClientError:
-        return {"tags": []}, meta_key
-
-def update_metadata(meta_key, filename, tags):
-    metadata = {
-            "filename": filename,
-            "tags": [tag.strip() for tag in tags.split(",")],
-            "uploaded_at": datetime.utcnow().isoformat()
-        }
-    s3.put_object(
-        Bucket=BUCKET,
-        Key=meta_key,
-        Body=json.dumps(metadata),
-        ContentType="application/json"
-    )
+        return {"tags": []}, None
 
+def get_metadata(bucket_folder, image_key):
+    filename = extract_filename_from_s3key(image_key)
+    meta_key = f"{bucket_folder}{METADATA_FOLDER}{filename}.json"
+    metadata, etag = load_metadata(meta_key)
+    return metadata, etag, meta_key
+
+def update_metadata(bucket_folder, meta_key, filename, tags, etag):
+    """Save the tags over the record version ``etag``; returns False if the index write is still pending.
+
+    Raises WriteConflict if someone else changed the record since it was read.
+    """
+    # keeps uploaded_at and any other fields of the existing record
+    metadata, _, _ = update_record(s3, BUCKET, bucket_folder, filename, tags=[tag.strip() for tag in tags.split(",")],
+                                   etag=etag)
+    load_metadata.clear(meta_key)
+    try:
+        MetadataIndex(s3, BUCKET, bucket_folder).put(metadata)
+    except IndexBusy as e:
+        # the record is saved; the reconciler (or the next edit) brings the index up to date
+        print(f"index update of {filename} deferred: {e}")
+        return False
+    return True
+
+@st.cache_data(ttl=LOOKUP_TTL, show_spinner=False)
 def key_exists(s3_key):
     try:
         s3.head_object(Bucket=BUCKET, Key=s3_key)
@@ -68,6 +97,69 @@ def key_exists(s3_key):
             pass
     return False
 
+# re-sign well before the URL expires so a cached one is always usable
+@st.cache_data(ttl=PRESIGNED_URL_EXPIRY // 2, show_spinner=False)
+def presigned_url(s3_key):
+    return s3.generate_presigned_url("get_object", Params={"Bucket": BUCKET, "Key": s3_key},
+                                     ExpiresIn=PRESIGNED_URL_EXPIRY)
+
+@st.cache_data(ttl=LOOKUP_TTL, max_entries=4 * PREFETCH_COUNT + 4, show_spinner=False)
+def load_preview(bucket_folder, image_key):
+    """Bytes of the screen-sized derivative of ``image_key``, or None if it hasn't been generated."""
+    try:
+        obj = s3.get_object(Bucket=BUCKET, Key=derivative_key(bucket_folder, image_key, PREVIEW_SIZE))
+        return obj["Body"].read()
+    except s3.exceptions.ClientError as e:
+        if is_missing(e):
+            return None
+        raise
+
+@st.cache_resource
+def prefetch_executor():
+    return ThreadPoolExecutor(max_workers=2 * PREFETCH_COUNT)
+
+def prefetch(bucket_folder, images, index):
+    """Warm the caches for the images around ``index`` so Previous/Next don't wait on S3."""
+    executor = prefetch_executor()
+    for offset in range(1, PREFETCH_COUNT + 1):
+        for neighbour in (index + offset, index - offset):
+            if 0 <= neighbour < len(images):
+                executor.submit(get_metadata, bucket_folder, images[neighbour])
+                executor.submit(load_preview, bucket_folder, images[neighbour])
+
+def skip_converted_duplicates(work, bucket_folder, target_prefix):
+    """Drop conversions whose picture is already under ``target_prefix`` in the target format."""
+    images = MetadataIndex(s3, BUCKET, bucket_folder).load()["images"]
+    redundant = redundant_work(work, images, list_objects(s3, BUCKET, target_prefix))
+    if redundant:
+        st.info(f"Skipping {len(redundant)} images already converted under another name.")
+    return [w for w in work if w not in redundant]
+
+def skip_duplicate_sources(work):
+    """Render each target from one source; near-duplicates still get derivatives of their own."""
+    by_target = {}
+    for w in work:
+        # a HEIC and its PNG share derivatives; the PNG decodes faster
+        current = by_target.get(w.target_key)
+        if current is None or current.source_key.lower().endswith(('.heic', '.heif')):
+            by_target[w.target_key] = w
+    if len(by_target) < len(work):
+        st.info(f"Skipping {len(work) - len(by_target)} images whose sibling renders the same derivatives.")
+    return list(by_target.values())
+
+def run_bulk_conversion(job_name, tasks, label):
+    n_images = len(tasks)
+    progress_bar = st.progress(0, label)
+    status_text = st.empty()
+
+    def report(done, total, task):
+        status_text.text(f"{done}/{total}...")
+        progress_bar.progress(done / total if total else 1.0)
+
+    with st.spinner(f'converting {n_images} images...'):
+        result = run_batch(BUCKET, tasks, checkpoint=checkpoint_path(f"{BUCKET}-{job_name}"), progress=report)
+    st.success(f"{result.converted} converted, {result.skipped} already done, {len(result.failed)} failed.")
+
 # Set Streamlit to use a wide layout
 st.set_page_config(layout="wide")
 
@@ -116,30 +208,34 @@ with st.sidebar:
 
     st.markdown('---')
 
+    # the planner lists the bucket itself; only convert what the extension filter shows
+    selected = set(images)
+
+    encode_profile = st.selectbox("Encode profile", list(PROFILES), index=list(PROFILES).index(ENCODE_PROFILE),
+                                  help="fast encodes quickest, archival writes the smallest files")
+    measure_sample = st.number_input("Images to measure", min_value=1, value=MEASURE_SAMPLE, step=1)
+    if st.button("Measure encode profiles"):
+        # a random sample of what the extension filter shows, encoded with every profile
+        sample = random.sample(images, min(int(measure_sample), len(images)))
+        with st.spinner(f'encoding {len(sample)} images with every profile...'):
+            sources = [body for body in get_objects(s3, BUCKET, sample).values() if body is not None]
+            st.dataframe(measure(sources), hide_index=True)
+
+    st.markdown('---')
+
     if st.button("Convert all HEIC to PNG"):
-        n_images = len(images)
-        progress_bar = st.progress(0, 'Conversion')
-        status_text = st.empty()
-        with st.spinner(f'converting {n_images} images...'):
-            for index, image_key in enumerate(images):
-                status_text.text(f"{index+1}/{n_images}...")
-                progress_bar.progress(index/n_images)
-                if image_key.endswith('/'):
-                    # skip folders
-                    continue
-                if image_key.lower().endswith('heic'):
-                    png_image_key = f"{os.path.splitext(image_key)[0]}.png"
-                    if not key_exists(png_image_key):
-                        convert_heic_from_s3(
-                                bucket=BUCKET,
-                                key=image_key,
-                                output_format="PNG",
-                                save_to_s3=True,
-                                output_bucket=BUCKET,
-                                output_key=png_image_key
-                            )
-                    else:
-                        print(f'file exists: {png_image_key}')
+        work = plan_prefixes(
+            s3, BUCKET,
+            source_prefix=f"{bucket_folder}{IMAGES_FOLDER}",
+            target_prefix=f"{bucket_folder}{IMAGES_FOLDER}",
+            target_key_for=lambda key: f"{os.path.splitext(key)[0]}.png" if key.lower().endswith('heic') else None,
+        )
+        work = skip_converted_duplicates(work, bucket_folder, f"{bucket_folder}{IMAGES_FOLDER}")
+        tasks = [ConversionTask(w.source_key, w.target_key, "convert",
+                                {"output_format": "PNG", "profile": encode_profile})
+                 for w in work if w.source_key in selected]
+        run_bulk_conversion(f"{bucket_folder}heic-to-png", tasks, 'Conversion')
+        key_exists.clear()
     
     st.markdown('---')
 
@@ -147,55 +243,48 @@ with st.sidebar:
     # jpeg_quality = st.number_input('JPEG quality', value=95, key='jpeg-quality', step=1)
     st.write(f'Full path: {bucket_folder}{jpeg_path}')
     if st.button("Convert all HEIC to JPEG"):
-        n_images = len(images)
-        progress_bar = st.progress(0, 'Conversion')
-        status_text = st.empty()
-        with st.spinner(f'converting {n_images} images...'):
-            for index, image_key in enumerate(images):
-                status_text.text(f"{index+1}/{n_images}...")
-                progress_bar.progress(index/n_images)
-                if image_key.endswith('/'):
-                    continue
-                if image_key.lower().endswith('heic'):
-                    filename = extract_filename_from_s3key(image_key)
-                    jpeg_image_key = f"{bucket_folder}{jpeg_path}{filename}.jpeg"
-                    if not key_exists(jpeg_image_key):
-                        # print(f"saving to '{jpeg_image_key}'")
-                        convert_heic_from_s3(
-                                bucket=BUCKET,
-                                key=image_key,
-                                output_format="JPEG",
-                                save_to_s3=True,
-                                output_bucket=BUCKET,
-                                output_key=jpeg_image_key,
-                                # quality=jpeg_quality
-                            )
-                    else:
-                        print(f'file exists: {jpeg_image_key}')
+        work = plan_prefixes(
+            s3, BUCKET,
+            source_prefix=f"{bucket_folder}{IMAGES_FOLDER}",
+            target_prefix=f"{bucket_folder}{jpeg_path}",
+            target_key_for=lambda key: (f"{bucket_folder}{jpeg_path}{extract_filename_from_s3key(key)}.jpeg"
+                                        if key.lower().endswith('heic') else None),
+        )
+        work = skip_converted_duplicates(work, bucket_folder, f"{bucket_folder}{jpeg_path}")
+        tasks = [ConversionTask(w.source_key, w.target_key, "convert",
+                                {"output_format": "JPEG", "profile": encode_profile})
+                 for w in work if w.source_key in selected]
+        run_bulk_conversion(f"{bucket_folder}{jpeg_path}heic-to-jpeg", tasks, 'Conversion')
     st.markdown('---')
     if st.button("Generate thumbnails of all PNG"):
-        n_images = len(images)
-        progress_bar = st.progress(0, 'thumbnails')
-        status_text = st.empty()
-        with st.spinner(f'converting {n_images} images...'):
-            for index, image_key in enumerate(images):
-                status_text.text(f"{index+1}/{n_images}...")
-                progress_bar.progress(index/n_images)
-                if image_key.endswith('/'):
-                    continue
-                if image_key.lower().endswith('png'):
-                    image_filename = extract_filename_from_s3key(image_key)
-                    thumbnail_image_key = f"{bucket_folder}{THUMBNAIL_FOLDER}{image_filename}.png"
-                    if not key_exists(thumbnail_image_key):
-                        generate_thumbnail(
-                            source_bucket=BUCKET,
-                            source_key=image_key,
-                            target_bucket=BUCKET,
-                            target_key=thumbnail_image_key,
-                            size=(300, 300)
-                        )
-                    else:
-                        print(f'thumbnail exists: {thumbnail_image_key}')
+        work = plan_prefixes(
+            s3, BUCKET,
+            source_prefix=f"{bucket_folder}{IMAGES_FOLDER}",
+            target_prefix=f"{bucket_folder}{THUMBNAIL_FOLDER}",
+            target_key_for=lambda key: (f"{bucket_folder}{THUMBNAIL_FOLDER}{extract_filename_from_s3key(key)}.png"
+                                        if key.lower().endswith('png') else None),
+        )
+        tasks = [ConversionTask(w.source_key, w.target_key, "thumbnail",
+                                {"size": (300, 300), "profile": encode_profile})
+                 for w in work if w.source_key in selected]
+        run_bulk_conversion(f"{bucket_folder}png-thumbnails", tasks, 'thumbnails')
+    st.markdown('---')
+    st.write(f"Web sizes: {', '.join(f'{name} {edge}px' for name, edge in DERIVATIVE_SIZES.items())}")
+    if st.button(f"Generate {DERIVATIVE_FORMAT} derivatives of all images"):
+        # the thumbnail is uploaded last, so planning against it covers every size
+        work = plan_prefixes(
+            s3, BUCKET,
+            source_prefix=f"{bucket_folder}{IMAGES_FOLDER}",
+            target_prefix=f"{bucket_folder}{DERIVATIVES_FOLDER}thumbnail/",
+            target_key_for=lambda key: derivative_key(bucket_folder, key, "thumbnail"),
+        )
+        work = skip_duplicate_sources(work)
+        tasks = [ConversionTask(w.source_key, w.target_key, "derivatives",
+                                {"targets": derivative_keys(bucket_folder, w.source_key),
+                                 "profile": encode_profile})
+                 for w in work if w.source_key in selected]
+        run_bulk_conversion(f"{bucket_folder}derivatives", tasks, 'derivatives')
+        load_preview.clear()
 
 
 
@@ -214,8 +303,10 @@ if images:
                         output_format="PNG",
                         save_to_s3=True,
                         output_bucket=BUCKET,
-                        output_key=png_image_key
+                        output_key=png_image_key,
+                        profile=encode_profile,
                     )
+                key_exists.clear(png_image_key)
                 st.success('conversion done.')
         if key_exists(png_image_key):
             st.write(f'PNG key exists: {png_image_key}')
@@ -223,8 +314,8 @@ if images:
     col1, col2 = st.columns([4,7])
 
     with col1:
-        url = s3.generate_presigned_url("get_object", Params={"Bucket": BUCKET, "Key": image_key}, ExpiresIn=3600)
-        st.image(url)
+        preview = load_preview(bucket_folder, image_key)
+        st.image(preview if preview is not None else presigned_url(image_key))
 
     with col2:
         with st.columns([4,1,5])[1]:
@@ -245,15 +336,25 @@ if images:
                 st.session_state.index += 1
                 st.rerun()
                 
-        metadata, meta_key = get_metadata(bucket_folder, image_key)
+        metadata, etag, meta_key = get_metadata(bucket_folder, image_key)
         st.write('**Metadata:**')
         st.json(metadata)
         tags = st.text_input("Tags (comma-separated)", value=", ".join(metadata.get("tags", [])))
 
         if st.button("Update Tags"):
-            update_metadata(meta_key, filename=metadata.get('filename', image_filename), tags=tags)
-            st.success("Tags updated!")
-            st.rerun()
+            try:
+                indexed = update_metadata(bucket_folder, meta_key, filename=metadata.get('filename', image_filename),
+                                          tags=tags, etag=etag)
+            except WriteConflict:
+                load_metadata.clear(meta_key)
+                st.error("These tags were just changed by someone else. Check them and try again.")
+            else:
+                if indexed:
+                    st.success("Tags updated!")
+                    st.rerun()
+                st.warning("Tags saved, but the gallery index is busy; the galleries will show them shortly.")
+
+    prefetch(bucket_folder, images, st.session_state.index)
 
         
 else:
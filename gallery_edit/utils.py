@@ -1,60 +1,117 @@
-import boto3
 from io import BytesIO
+import os
+from tempfile import SpooledTemporaryFile
+
+from boto3.s3.transfer import TransferConfig
+from dotenv import load_dotenv
 from pillow_heif import register_heif_opener
 from PIL import Image
 
+from common.derivatives import open_reduced
+from common.encoding import encode
+from common.memory import conversion_budget, image_footprint
+from common.metrics import timed
+from common.s3 import get_client, object_args
+
+load_dotenv()
+
 # Register HEIC format
 register_heif_opener()
 
-s3 = boto3.client("s3")
+s3 = get_client()
 
-def convert_heic_from_s3(bucket, key, output_format="PNG", 
-                         save_to_s3=False, output_bucket=None, output_key=None,
-                         quality=95):
-    # Download S3 object into memory
-    response = s3.get_object(Bucket=bucket, Key=key)
-    heic_bytes = response['Body'].read()
-
-    # Open image from bytes
-    image = Image.open(BytesIO(heic_bytes))
-
-    # Convert and prepare output
-    output_buffer = BytesIO()
-    if output_format.upper() == "JPEG":
-        image = image.convert("RGB")
-        image.save(output_buffer, format="JPEG", quality=quality, optimize=True)
-    elif output_format.upper() == "PNG":
-        image.save(output_buffer, format="PNG", optimize=True)
-    else:
+# S3 bodies above this many bytes are spooled to a temp file instead of memory
+SPOOL_MAX_SIZE = int(os.getenv("CONVERSION_SPOOL_MAX_MB", 8)) * 1024 * 1024
+# multipart transfers stream in chunks, so only a few chunks are ever buffered
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=SPOOL_MAX_SIZE,
+    multipart_chunksize=SPOOL_MAX_SIZE,
+    max_concurrency=4,
+)
+
+
+def _as_file(image):
+    return BytesIO(image) if isinstance(image, (bytes, bytearray)) else image
+
+
+def spooled():
+    return SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+
+@timed("convert_image")
+def convert_image(image_bytes, output_format="PNG", quality=None, output=None, profile=None):
+    """Encode an image (bytes or a file object) as PNG or JPEG into ``output``, a new BytesIO by default.
+
+    ``profile`` names an encode profile (``common.encoding.PROFILES``);
+    ``quality`` overrides its JPEG quality.
+    """
+    output_format = output_format.upper()
+    if output_format not in ("JPEG", "PNG"):
         raise ValueError("Unsupported format. Use 'PNG' or 'JPEG'.")
 
+    output_buffer = BytesIO() if output is None else output
+    with Image.open(_as_file(image_bytes)) as image:
+        if output_format == "JPEG":
+            # convert() always copies; skip it when there's nothing to convert
+            rgb = image if image.mode == "RGB" else image.convert("RGB")
+            encode(rgb, output_buffer, "JPEG", profile, quality)
+            rgb.close()
+        else:
+            encode(image, output_buffer, "PNG", profile)
+
     output_buffer.seek(0)
+    return output_buffer
+
+
+def convert_heic_from_s3(bucket, key, output_format="PNG", 
+                         save_to_s3=False, output_bucket=None, output_key=None,
+                         quality=None, profile=None):
+    if save_to_s3 and (not output_bucket or not output_key):
+        raise ValueError("Output S3 bucket and key must be provided.")
+
+    output_buffer = spooled()
+    with spooled() as source:
+        s3.download_fileobj(bucket, key, source, Config=TRANSFER_CONFIG)
+        source.seek(0)
+        with conversion_budget.reserve(image_footprint(source)):
+            convert_image(source, output_format=output_format, quality=quality, output=output_buffer,
+                          profile=profile)
 
     if save_to_s3:
-        if not output_bucket or not output_key:
-            raise ValueError("Output S3 bucket and key must be provided.")
-        s3.upload_fileobj(output_buffer, output_bucket, output_key)
+        with output_buffer:
+            s3.upload_fileobj(output_buffer, output_bucket, output_key,
+                              ExtraArgs=object_args(output_key), Config=TRANSFER_CONFIG)
         print(f"Uploaded converted image to s3://{output_bucket}/{output_key}")
         return f"s3://{output_bucket}/{output_key}"
     else:
         return output_buffer  # You can use this buffer to save locally or return as HTTP response
 
 
-def generate_thumbnail(source_bucket, source_key, target_bucket=None, 
-                       target_key=None, size=(200, 200)):
-    # Download image from S3
-    response = s3.get_object(Bucket=source_bucket, Key=source_key)
-    image_data = response['Body'].read()
-
-    # Open image with Pillow
-    image = Image.open(BytesIO(image_data))
+@timed("make_thumbnail")
+def make_thumbnail(image_bytes, size=(200, 200), profile=None):
+    source = _as_file(image_bytes)
+    with Image.open(source) as header:
+        image_format = header.format or 'JPEG'
+    source.seek(0)
+    # Decode at reduced resolution where the codec allows it
+    image = open_reduced(source, max(size))
     image.thumbnail(size)
 
     # Save thumbnail to memory
     buffer = BytesIO()
-    image_format = image.format or 'JPEG'
-    image.save(buffer, format=image_format)
+    encode(image, buffer, image_format, profile)
+    image.close()
     buffer.seek(0)
+    return buffer
+
+
+def generate_thumbnail(source_bucket, source_key, target_bucket=None, 
+                       target_key=None, size=(200, 200), profile=None):
+    with spooled() as source:
+        s3.download_fileobj(source_bucket, source_key, source, Config=TRANSFER_CONFIG)
+        source.seek(0)
+        with conversion_budget.reserve(image_footprint(source)):
+            buffer = make_thumbnail(source, size=size, profile=profile)
 
     # Determine where to upload
     if not target_bucket:
@@ -65,5 +122,5 @@ def generate_thumbnail(source_bucket, source_key, target_bucket=None,
         target_key = f"{key_parts[0]}{suffix}" if len(key_parts) > 1 else f"{source_key}_thumbnail"
 
     # Upload thumbnail back to S3
-    s3.upload_fileobj(buffer, target_bucket, target_key)
+    s3.upload_fileobj(buffer, target_bucket, target_key, ExtraArgs=object_args(target_key))
     print(f"Thumbnail saved to s3://{target_bucket}/{target_key}")
\ No newline at end of file
@@ -1,20 +1,47 @@
-from flask import Flask, jsonify, render_template, request
-import boto3
-import json
+from flask import Flask, Response, jsonify, render_template, request, stream_template, stream_with_context, url_for
 from dotenv import load_dotenv
+import json
 import os
 
 from flask_caching import Cache
+
+from common.derivatives import derivative_keys
+from common.http_cache import conditional
+from common.image_info import arrange, view_options
+from common.image_proxy import init_app as init_image_proxy
+from common.metadata_index import MetadataIndex
+from common.metrics import init_app as init_metrics
+from common.pagination import DEFAULT_LIMIT, paginate, parse_limit
+from common.response_cache import VersionedResponseCache
+from common.s3 import get_client
+from common.snapshot import SnapshotStore
+from common.tag_index import compile_query
 load_dotenv()
 
 app = Flask(__name__)
-s3 = boto3.client('s3')
+init_metrics(app, "gallery_view_only")
+s3 = get_client()
 BUCKET = os.getenv("S3_BUCKET")
 BUCKET_FOLDER = os.getenv("BUCKET_FOLDER")
+# how often (seconds) to check the metadata index for a new generation
+INDEX_POLL_INTERVAL = float(os.getenv("INDEX_POLL_INTERVAL", 1))
+metadata_index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+# every worker maps the same on-disk snapshot of the index instead of parsing its own copy
+snapshots = SnapshotStore(s3, BUCKET, BUCKET_FOLDER, max_age=INDEX_POLL_INTERVAL)
+init_image_proxy(app, s3, BUCKET, BUCKET_FOLDER)
 
-app.config["CACHE_TYPE"] = "SimpleCache"
-app.config["CACHE_DEFAULT_TIMEOUT"] = 300
+# shared by every gunicorn worker on the host; entries are invalidated by
+# metadata generation rather than by age
+app.config["CACHE_TYPE"] = "FileSystemCache"
+app.config["CACHE_DIR"] = os.getenv("CACHE_DIR", "/tmp/gallery-cache")
+app.config["CACHE_THRESHOLD"] = int(os.getenv("CACHE_THRESHOLD", 2000))
+app.config["CACHE_DEFAULT_TIMEOUT"] = 0
 cache = Cache(app)
+# ask proxies such as nginx to pass streamed chunks through immediately
+STREAMING_HEADERS = {"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+response_cache = VersionedResponseCache(
+    cache, lambda: snapshots.current().generation
+)
 
 @app.route('/clear-cache', methods=["POST"])
 def clear_cache():
@@ -22,32 +49,96 @@ def clear_cache():
     return jsonify({"status": "success", "message": "Cache cleared."})
 
 
+def image_entry(metadata, derivatives_of=None):
+    """``derivatives_of`` is the filename of the near-duplicate whose derivatives to show."""
+    filename = metadata['filename']
+    # image_url = s3.generate_presigned_url(
+    #     'get_object',
+    #     Params={'Bucket': BUCKET, 'Key': f"{BUCKET_FOLDER}images/{filename}"},
+    #     ExpiresIn=3600
+    # )
+    image_url = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{BUCKET_FOLDER}images/{filename}"
+    derivative_urls = {
+        size: f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{key}"
+        for size, key in derivative_keys(BUCKET_FOLDER, derivatives_of or filename).items()
+    }
+    # rendered on demand when the derivative hasn't been generated yet
+    fallback_url = url_for("image_variant", key=f"{BUCKET_FOLDER}images/{filename}", w=300)
+    return {
+        "url": image_url,
+        "thumbnail_url": derivative_urls["thumbnail"],
+        "medium_url": derivative_urls["medium"],
+        "fallback_url": fallback_url,
+        "filename": filename,
+        # known from the header at ingest, so the page can reserve the space
+        "width": metadata.get("width"),
+        "height": metadata.get("height"),
+        "taken_at": metadata.get("taken_at"),
+    }
+
+def image_page(search, cursor=None, limit=DEFAULT_LIMIT, options=None):
+    snapshot = snapshots.current()
+    image_ids = arrange(snapshot, snapshot.search_ids(search), **(options or {}))
+    # only the records on the page are decoded from the snapshot
+    page, next_cursor = paginate(image_ids, cursor, limit)
+    return [image_entry(snapshot.images[image_id], snapshot.field(snapshot.representative(image_id), "filename"))
+            for image_id in page], next_cursor
+
+def stream_entries(search, options=None):
+    snapshot = snapshots.current(rebuild_missing=False)
+    if snapshot is not None:
+        # arranged and collapsed like the paged views
+        for image_id in arrange(snapshot, snapshot.search_ids(search), **(options or {})):
+            yield image_entry(snapshot.images[image_id],
+                              snapshot.field(snapshot.representative(image_id), "filename"))
+        return
+    # filters record by record so a cold index still streams while the bucket is scanned;
+    # near-duplicates can't be grouped until the snapshot exists, and each has its own derivatives
+    matches = compile_query(search)
+    for metadata in metadata_index.stream():
+        if matches(metadata.get("tags", [])):
+            yield image_entry(metadata)
+
 @app.route("/", methods=["GET"])
-@cache.cached(query_string=True)
+@conditional(snapshots.last_modified)
+@response_cache.cached
 def gallery():
-    print('cache miss!')
     search = request.args.get("search", "").lower()
-    image_entries = []
-
-    result = s3.list_objects_v2(Bucket=BUCKET, Prefix=f"{BUCKET_FOLDER}metadata/")
-    if "Contents" in result:
-        for item in result["Contents"]:
-            metadata_file = item["Key"]
-            obj = s3.get_object(Bucket=BUCKET, Key=metadata_file)
-            metadata = json.loads(obj["Body"].read())
-            filename = metadata['filename']
-            # search takes only the first keyword
-            if not search or search.split()[0].split(',')[0] in metadata["tags"]:
-                # image_url = s3.generate_presigned_url(
-                #     'get_object',
-                #     Params={'Bucket': BUCKET, 'Key': f"{BUCKET_FOLDER}images/{filename}"},
-                #     ExpiresIn=3600
-                # )
-                image_url = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{BUCKET_FOLDER}images/{filename}"
-                thumbnail_url = f"https://{BUCKET}.s3.us-east-1.amazonaws.com/{BUCKET_FOLDER}thumbnails/{filename}"
-                image_entries.append((image_url, thumbnail_url))
-
-    return render_template("gallery.html", images=image_entries, search=search)
+    options = view_options(request.args)
+    image_entries, next_cursor = image_page(search, options=options)
+    return render_template("gallery.html", images=image_entries, search=search, options=options,
+                           next_cursor=next_cursor)
+
+@app.route("/api/images", methods=["GET"])
+@conditional(snapshots.last_modified)
+@response_cache.cached
+def list_images():
+    search = request.args.get("search", "").lower()
+    image_entries, next_cursor = image_page(search, request.args.get("cursor"), parse_limit(request.args.get("limit")),
+                                            view_options(request.args))
+    return jsonify({"images": image_entries, "next_cursor": next_cursor})
+
+@app.route("/api/tags", methods=["GET"])
+@conditional(snapshots.last_modified)
+@response_cache.cached
+def autocomplete_tags():
+    prefix = request.args.get("prefix", "")
+    limit = parse_limit(request.args.get("limit"), 10)
+    return jsonify(snapshots.current().complete(prefix, limit=limit))
+
+@app.route("/stream", methods=["GET"])
+def gallery_stream():
+    search = request.args.get("search", "").lower()
+    options = view_options(request.args)
+    body = stream_template("gallery.html", images=stream_entries(search, options), search=search,
+                           options=options, next_cursor=None)
+    return Response(body, mimetype="text/html", headers=STREAMING_HEADERS)
+
+@app.route("/api/images/stream", methods=["GET"])
+def stream_images():
+    search = request.args.get("search", "").lower()
+    records = (json.dumps(entry) + "\n" for entry in stream_entries(search, view_options(request.args)))
+    return Response(stream_with_context(records), mimetype="application/x-ndjson", headers=STREAMING_HEADERS)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
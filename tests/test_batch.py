@@ -0,0 +1,59 @@
+from io import BytesIO
+import json
+import sys
+
+from PIL import Image
+import pytest
+
+from conftest import BUCKET, load_service
+
+
+@pytest.fixture
+def batch(s3, monkeypatch):
+    module = load_service("gallery_edit", "batch")
+    # the process pool pickles the operations by module name
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    return module
+
+
+def png():
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8), "red").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def task(batch, name):
+    return batch.ConversionTask(f"src/{name}.png", f"out/{name}.jpg", "convert", {"output_format": "JPEG"})
+
+
+def test_resume_skips_checkpointed_targets_without_touching_s3(batch, s3, tmp_path):
+    checkpoint = str(tmp_path / "run.jsonl")
+    # "a" finished in the interrupted run; its source is gone, so re-reading it would fail the task
+    with open(checkpoint, "w") as f:
+        f.write(json.dumps({"target_key": "out/a.jpg", "status": "converted"}) + "\n")
+        f.write('{"target_key": "out/')
+    s3.put_object(Bucket=BUCKET, Key="src/b.png", Body=png())
+    calls = []
+
+    result = batch.run_batch(BUCKET, [task(batch, "a"), task(batch, "b")], checkpoint=checkpoint,
+                             progress=lambda done, total, task: calls.append((done, total)),
+                             io_workers=2, cpu_workers=1)
+    assert (result.converted, result.skipped, result.failed) == (1, 1, [])
+    assert calls == [(1, 2), (2, 2)]
+    assert Image.open(BytesIO(s3.get_object(Bucket=BUCKET, Key="out/b.jpg")["Body"].read())).format == "JPEG"
+    # a clean finish leaves nothing to resume
+    assert not (tmp_path / "run.jsonl").exists()
+
+
+def test_failed_run_keeps_finished_targets_for_the_next_attempt(batch, s3, tmp_path):
+    checkpoint = str(tmp_path / "run.jsonl")
+    s3.put_object(Bucket=BUCKET, Key="src/a.png", Body=png())
+    tasks = [task(batch, "a"), task(batch, "b")]
+
+    first = batch.run_batch(BUCKET, tasks, checkpoint=checkpoint, io_workers=2, cpu_workers=1)
+    assert first.converted == 1 and [failed.source_key for failed, _ in first.failed] == ["src/b.png"]
+    assert batch.load_checkpoint(checkpoint) == {"out/a.jpg"}
+
+    s3.put_object(Bucket=BUCKET, Key="src/b.png", Body=png())
+    second = batch.run_batch(BUCKET, tasks, checkpoint=checkpoint, io_workers=2, cpu_workers=1)
+    assert (second.converted, second.skipped, second.failed) == (1, 1, [])
@@ -0,0 +1,67 @@
+from io import BytesIO
+
+from PIL import Image
+import pytest
+
+from common.derivatives import open_reduced, render_derivatives
+from common.duplicates import image_hash
+from conftest import load_service
+
+
+def encoded(image, fmt="PNG", **options):
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+def palette_png(transparent=False):
+    image = Image.effect_mandelbrot((2000, 1500), (-2.0, -1.2, 0.8, 1.2), 60).convert("RGB").quantize(64)
+    return encoded(image, transparency=0) if transparent else encoded(image)
+
+
+SOURCES = {
+    "palette png": lambda: palette_png(),
+    "transparent palette png": lambda: palette_png(transparent=True),
+    "bilevel png": lambda: encoded(Image.new("1", (2000, 1500), 1)),
+    "16-bit png": lambda: encoded(Image.new("I;16", (2000, 1500), 1000)),
+    "gif": lambda: encoded(Image.new("P", (2000, 1500), 3), "GIF"),
+    "jpeg": lambda: encoded(Image.new("RGB", (2000, 1500), "red"), "JPEG"),
+}
+
+
+@pytest.mark.parametrize("name", SOURCES)
+def test_open_reduced_handles_every_mode(name):
+    image = open_reduced(BytesIO(SOURCES[name]()), 300)
+    assert image.mode in ("RGB", "RGBA")
+    assert max(image.size) < 1000
+
+
+@pytest.mark.parametrize("name", SOURCES)
+def test_render_derivatives(name):
+    outputs = render_derivatives(SOURCES[name](), sizes={"thumbnail": 300, "medium": 800})
+    sizes = {size: Image.open(BytesIO(data)).size for size, data in outputs.items()}
+    assert sizes == {"thumbnail": (300, 225), "medium": (800, 600)}
+
+
+def test_transparency_is_kept():
+    image = open_reduced(BytesIO(palette_png(transparent=True)), 300)
+    assert image.mode == "RGBA"
+
+
+def test_reduced_decode_applies_exif_orientation():
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    source = encoded(Image.new("RGB", (2000, 1000), "red").quantize(), exif=exif.tobytes())
+    width, height = open_reduced(BytesIO(source), 300).size
+    assert height == 2 * width
+
+
+def test_palette_png_thumbnail():
+    utils = load_service("gallery_edit", "utils")
+    thumbnail = Image.open(utils.make_thumbnail(palette_png(), size=(300, 300)))
+    assert thumbnail.format == "PNG"
+    assert thumbnail.size == (300, 225)
+
+
+def test_palette_png_hash():
+    assert len(image_hash(BytesIO(palette_png()))) == 16
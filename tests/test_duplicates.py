@@ -0,0 +1,38 @@
+from io import BytesIO
+
+from PIL import Image
+
+from common.duplicates import HashIndex, image_hash, informative, representatives
+from common.metadata_index import MetadataIndex
+from conftest import BUCKET, BUCKET_FOLDER, load_service
+
+
+def encoded(image):
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_flat_images_are_never_duplicates():
+    red, blue = (image_hash(BytesIO(encoded(Image.new("RGB", (400, 300), colour)))) for colour in ("red", "blue"))
+    assert red == blue and not informative(red)
+    assert representatives({"red": {"phash": red}, "blue": {"phash": blue}}) == {}
+    assert HashIndex([red, blue]).near(red) == []
+
+
+def test_detailed_near_duplicates_are_grouped():
+    picture = Image.effect_mandelbrot((400, 300), (-2.0, -1.2, 0.8, 1.2), 60).convert("RGB")
+    original = image_hash(BytesIO(encoded(picture)))
+    smaller = image_hash(BytesIO(encoded(picture.resize((200, 150)))))
+    assert informative(original)
+    assert representatives({"a": {"phash": original}, "b": {"phash": smaller}}) == {"b": "a"}
+
+
+def test_near_duplicate_uploads_get_their_own_derivatives(s3):
+    processing = load_service("uploader", "processing")
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    body = encoded(Image.effect_mandelbrot((400, 300), (-2.0, -1.2, 0.8, 1.2), 60).convert("RGB"))
+    for name in ("a.png", "b.png"):
+        s3.put_object(Bucket=BUCKET, Key=f"{BUCKET_FOLDER}images/{name}", Body=body)
+        written = processing.process_upload(s3, BUCKET, BUCKET_FOLDER, f"{BUCKET_FOLDER}images/{name}", index)
+        assert any(key.startswith(f"{BUCKET_FOLDER}derivatives/") for key in written)
@@ -0,0 +1,43 @@
+from io import BytesIO
+
+from PIL import Image
+import pytest
+
+from common import encoding
+from common.encoding import PROFILES, encode, measure, save_options
+
+
+def noisy(size=(64, 64)):
+    return Image.effect_noise(size, 64).convert("RGB")
+
+
+def jpeg(profile=None, quality=None):
+    buffer = BytesIO()
+    encode(noisy(), buffer, "JPEG", profile, quality)
+    buffer.seek(0)
+    return buffer
+
+
+def test_profiles_select_their_settings(monkeypatch):
+    assert save_options("jpeg", "fast") == PROFILES["fast"]["JPEG"]
+    monkeypatch.setattr(encoding, "ENCODE_PROFILE", "archival")
+    assert save_options("PNG") == {"optimize": True}
+    # formats a profile doesn't cover keep Pillow's defaults
+    assert save_options("HEIF", "fast") == {}
+    with pytest.raises(ValueError, match="Unknown encode profile"):
+        save_options("PNG", "smallest")
+
+
+def test_quality_overrides_the_profile_without_changing_it():
+    assert save_options("JPEG", "archival", quality=40)["quality"] == 40
+    assert PROFILES["archival"]["JPEG"]["quality"] == 95
+    assert len(jpeg("archival", quality=40).getvalue()) < len(jpeg("archival").getvalue())
+
+
+def test_profiles_change_the_encoded_output():
+    assert "progressive" not in Image.open(jpeg("fast")).info
+    assert Image.open(jpeg("balanced")).info.get("progressive")
+
+    rows = measure([jpeg().getvalue()], formats=("JPEG",), profiles=("fast", "archival"))
+    assert [(row["profile"], row["images"]) for row in rows] == [("fast", 1), ("archival", 1)]
+    assert all(row["bytes_per_image"] > 0 for row in rows)
@@ -0,0 +1,72 @@
+import json
+
+from common.metadata_index import IndexBusy
+from common.snapshot import Snapshot, write_snapshot
+from conftest import BUCKET, BUCKET_FOLDER
+
+
+def busy(changes):
+    raise IndexBusy("too many concurrent writers")
+
+
+def test_update_reports_busy_index_after_saving_the_record(load_app, s3, monkeypatch):
+    app = load_app("gallery_edit")
+    monkeypatch.setattr(app.metadata_index, "update", busy)
+
+    response = app.app.test_client().post("/update", data={"filename": "a.jpg", "tags": "beach"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    assert response.json["saved"] is True
+    record = json.loads(s3.get_object(Bucket=BUCKET, Key=f"{BUCKET_FOLDER}metadata/a.json")["Body"].read())
+    assert record["tags"] == ["beach"]
+
+
+def test_batch_marks_saved_updates_index_pending(load_app, monkeypatch):
+    app = load_app("gallery_edit")
+    monkeypatch.setattr(app.metadata_index, "update", busy)
+
+    response = app.app.test_client().post("/update/batch", json={"updates": [
+        {"filename": "a.jpg", "tags": "beach"},
+        {"filename": "", "tags": "x"},
+    ]})
+    assert response.status_code == 200
+    saved, missing = response.json["results"]
+    assert (saved["status"], saved["index"]) == ("created", "pending")
+    assert missing["status"] == "error" and "index" not in missing
+
+
+def test_near_duplicates_show_the_representatives_derivatives(load_app, tmp_path):
+    app = load_app("gallery_edit")
+    path = str(tmp_path / "snapshot.bin")
+    write_snapshot(path, {"generation": 1, "images": {
+        "a": {"filename": "a.png", "tags": [], "phash": "ff00ff00ff00ff00"},
+        "b": {"filename": "b.jpg", "tags": [], "phash": "ff00ff00ff00ff01"},
+        "c": {"filename": "c.jpg", "tags": [], "phash": "00ff00ff00ff00ff"},
+    }}, "etag")
+    snapshot = Snapshot(path)
+
+    with app.app.test_request_context():
+        entries = {name: app.image_entry(f"{BUCKET_FOLDER}images/{name}", snapshot)
+                   for name in ("a.png", "b.jpg", "c.jpg", "new.jpg")}
+    assert entries["b.jpg"]["medium_url"] == entries["a.png"]["medium_url"]
+    assert "/medium/a." in entries["a.png"]["medium_url"]
+    assert "/medium/c." in entries["c.jpg"]["medium_url"]
+    assert "/medium/new." in entries["new.jpg"]["medium_url"]
+
+
+def test_batch_rejects_bodies_that_are_not_objects(load_app):
+    client = load_app("gallery_edit").app.test_client()
+    for body in ([{"filename": "a.jpg", "tags": "x"}], "updates", 3):
+        assert client.post("/update/batch", json=body).status_code == 400
+
+
+def test_listing_views_show_images_synced_out_of_band(load_app, s3):
+    client = load_app("gallery_edit").app.test_client()
+    first = client.get("/api/images")
+    assert first.json["images"] == []
+
+    s3.put_object(Bucket=BUCKET, Key=f"{BUCKET_FOLDER}images/synced.jpg", Body=b"jpeg")
+    headers = {"If-None-Match": first.headers.get("ETag", "*")}
+    again = client.get("/api/images", headers=headers)
+    assert again.status_code == 200
+    assert [entry["filename"] for entry in again.json["images"]] == ["synced.jpg"]
@@ -0,0 +1,39 @@
+import json
+
+from common.metadata_index import MetadataIndex
+from conftest import BUCKET, BUCKET_FOLDER
+
+IMAGES = {
+    "a": {"filename": "a.png", "tags": ["beach"], "phash": "0f0f0f0f0f0f0f0f"},
+    "b": {"filename": "b.jpg", "tags": ["beach"], "phash": "0f0f0f0f0f0f0f0e"},
+    "c": {"filename": "c.jpg", "tags": ["beach"], "phash": "f0f0f0f0f0f0f0f0"},
+}
+
+
+def stream(client, query=""):
+    response = client.get(f"/api/images/stream?search=beach{query}")
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_stream_collapses_near_duplicates_like_the_paged_views(load_app, s3):
+    MetadataIndex(s3, BUCKET, BUCKET_FOLDER).update(IMAGES)
+    app = load_app("gallery_view_only")
+    app.snapshots.current()
+    client = app.app.test_client()
+
+    paged = client.get("/api/images?search=beach").json["images"]
+    assert [entry["filename"] for entry in stream(client)] == [entry["filename"] for entry in paged] == ["a.png", "c.jpg"]
+
+    shown = {entry["filename"]: entry for entry in stream(client, "&duplicates=show")}
+    assert set(shown) == {"a.png", "b.jpg", "c.jpg"}
+    assert shown["b.jpg"]["medium_url"] == shown["a.png"]["medium_url"]
+
+
+def test_tag_completion_limit_is_bounded(load_app, s3):
+    MetadataIndex(s3, BUCKET, BUCKET_FOLDER).update({
+        "a": {"filename": "a.png", "tags": ["beach", "bay", "boat"]},
+    })
+    client = load_app("gallery_view_only").app.test_client()
+    assert len(client.get("/api/tags?prefix=b&limit=-5").json) == 1
+    assert len(client.get("/api/tags?prefix=b&limit=99999999999").json) == 3
+    assert len(client.get("/api/tags?prefix=b&limit=x").json) == 3
@@ -0,0 +1,81 @@
+import fcntl
+import hashlib
+import os
+import time
+
+from flask import Flask
+from flask_caching import Cache
+
+from common.http_cache import conditional
+from common.response_cache import LOCK_STRIPES, VersionedResponseCache
+
+
+def make_app(state, **kwargs):
+    app = Flask(__name__)
+    app.config["CACHE_TYPE"] = "SimpleCache"
+    cache = Cache(app)
+    response_cache = VersionedResponseCache(cache, lambda: state["version"], **kwargs)
+
+    @app.route("/")
+    @conditional(lambda: (state["version"], None))
+    @response_cache.cached
+    def page():
+        return f"generation {state['version']}"
+
+    return app, cache
+
+
+def wait_for_refresh(cache, version):
+    for _ in range(100):
+        entry = cache.get("view//?")
+        if entry and entry[0] == version:
+            return
+        time.sleep(0.01)
+    raise AssertionError("background refresh did not finish")
+
+
+def test_stale_response_is_not_revalidated_as_current():
+    state = {"version": 1}
+    app, cache = make_app(state)
+    client = app.test_client()
+
+    first = client.get("/")
+    assert first.headers["X-Cache"] == "MISS"
+    etag_1 = first.headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag_1}).status_code == 304
+
+    state["version"] = 2
+    stale = client.get("/", headers={"If-None-Match": etag_1})
+    assert stale.status_code == 200
+    assert stale.headers["X-Cache"] == "STALE"
+    assert stale.get_data(as_text=True) == "generation 1"
+    # validators describe the generation that was sent, not the current one
+    assert stale.headers["ETag"] == etag_1
+    assert "Last-Modified" not in stale.headers
+
+    wait_for_refresh(cache, 2)
+    revalidated = client.get("/", headers={"If-None-Match": stale.headers["ETag"]})
+    assert revalidated.status_code == 200
+    assert revalidated.get_data(as_text=True) == "generation 2"
+    assert revalidated.headers["ETag"] != etag_1
+    assert client.get("/", headers={"If-None-Match": revalidated.headers["ETag"]}).status_code == 304
+
+
+def test_refresh_is_skipped_while_another_worker_holds_the_lock(tmp_path):
+    state = {"version": 1}
+    app, cache = make_app(state, lock_directory=str(tmp_path))
+    client = app.test_client()
+    client.get("/")
+    state["version"] = 2
+
+    stripe = int(hashlib.sha1(b"view//?").hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(tmp_path, f"{stripe}.lock"), "w") as other_worker:
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+        assert client.get("/").headers["X-Cache"] == "STALE"
+        time.sleep(0.1)
+        assert cache.get("view//?")[0] == 1
+        fcntl.flock(other_worker, fcntl.LOCK_UN)
+
+    assert client.get("/").headers["X-Cache"] == "STALE"
+    wait_for_refresh(cache, 2)
+    assert client.get("/").headers["X-Cache"] == "HIT"
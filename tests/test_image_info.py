@@ -0,0 +1,44 @@
+from io import BytesIO
+
+from botocore.exceptions import EndpointConnectionError
+import pytest
+from PIL import Image
+
+from common.image_info import fetch_image_info
+from conftest import BUCKET
+
+
+def png(size=(40, 30)):
+    buffer = BytesIO()
+    Image.new("RGB", size).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_header_facts_of_a_stored_image(s3):
+    s3.put_object(Bucket=BUCKET, Key="images/a.png", Body=png())
+    info = fetch_image_info(s3, BUCKET, "images/a.png")
+    assert (info["width"], info["height"]) == (40, 30)
+
+
+@pytest.mark.parametrize("body", [b"", b"not an image", png()[:40]], ids=["empty", "garbage", "truncated"])
+def test_unreadable_objects_have_no_header_facts(s3, body):
+    s3.put_object(Bucket=BUCKET, Key="images/bad.png", Body=body)
+    assert fetch_image_info(s3, BUCKET, "images/bad.png") == {}
+
+
+def test_missing_objects_have_no_header_facts(s3):
+    assert fetch_image_info(s3, BUCKET, "images/gone.png") == {}
+
+
+def test_connection_errors_propagate(s3):
+    s3.put_object(Bucket=BUCKET, Key="images/a.png", Body=png())
+
+    def unreachable(**kwargs):
+        raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+    s3.meta.events.register("before-call.s3.GetObject", unreachable)
+    try:
+        with pytest.raises(EndpointConnectionError):
+            fetch_image_info(s3, BUCKET, "images/a.png")
+    finally:
+        s3.meta.events.unregister("before-call.s3.GetObject", unreachable)
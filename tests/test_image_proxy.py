@@ -0,0 +1,72 @@
+from io import BytesIO
+import os
+
+from flask import Flask
+from PIL import Image
+
+from common import image_proxy
+from common.image_proxy import DiskLRUCache, init_app
+from conftest import BUCKET, BUCKET_FOLDER
+
+KEY = f"{BUCKET_FOLDER}images/a.png"
+
+
+def png(colour):
+    buffer = BytesIO()
+    Image.new("RGB", (400, 300), colour).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def proxy(s3, cache):
+    app = Flask(__name__)
+    init_app(app, s3, BUCKET, BUCKET_FOLDER, cache=cache)
+    return app.test_client()
+
+
+def colour_of(response):
+    return Image.open(BytesIO(response.data)).convert("RGB").getpixel((0, 0))
+
+
+def test_replaced_original_gets_new_variants(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(image_proxy, "IMG_SOURCE_TTL", 0)
+    client = proxy(s3, DiskLRUCache(str(tmp_path)))
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=png("red"))
+    assert colour_of(client.get(f"/img/{KEY}?w=100&fmt=png"))[0] > 200
+
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=png("blue"))
+    assert colour_of(client.get(f"/img/{KEY}?w=100&fmt=png"))[2] > 200
+
+
+def test_variant_evicted_before_it_is_sent_is_rendered_again(s3, tmp_path):
+    cache = DiskLRUCache(str(tmp_path))
+    client = proxy(s3, cache)
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=png("red"))
+    assert client.get(f"/img/{KEY}?w=100&fmt=png").status_code == 200
+
+    get = cache.get
+
+    def evicted(name):
+        path = get(name)
+        if path:
+            os.remove(path)
+        return path
+
+    cache.get = evicted
+    response = client.get(f"/img/{KEY}?w=100&fmt=png")
+    assert response.status_code == 200
+    assert colour_of(response)[0] > 200
+
+
+def test_cache_evicts_least_recently_used_files_below_its_cap(tmp_path):
+    cache = DiskLRUCache(str(tmp_path), max_bytes=100)
+    for name, last_used in (("a", 1000), ("b", 2000)):
+        path = cache.put(name, b"x" * 40)
+        os.utime(path, (last_used, os.stat(path).st_mtime))
+    # reading "a" makes "b" the least recently used
+    assert cache.get("a")
+
+    cache.put("c", b"x" * 40)
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    # a new cache over the same directory starts from what is on disk
+    assert DiskLRUCache(str(tmp_path), max_bytes=100)._size == 80
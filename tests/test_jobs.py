@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import BUCKET, BUCKET_FOLDER, load_service
+
+jobs = load_service("gallery_edit", "jobs")
+
+
+class FinishingConnection:
+    """Finishes ``job_id`` right after the next insert, as a worker in another process might."""
+
+    def __init__(self, db, queue, job_id):
+        self.db, self.queue, self.job_id = db, queue, job_id
+
+    def execute(self, sql, params=()):
+        cursor = self.db.execute(sql, params)
+        if sql.startswith("INSERT"):
+            self.queue.update(self.job_id, jobs.DONE, "converted")
+        return cursor
+
+    def close(self):
+        self.db.close()
+
+
+def test_enqueue_reports_the_job_that_finished_meanwhile(tmp_path, monkeypatch):
+    queue = jobs.JobQueue(str(tmp_path / "jobs.sqlite3"), {})
+    first, created = queue.enqueue("heic_to_png", "a.heic", "a.png")
+    assert created
+
+    connect = queue._connect
+    monkeypatch.setattr(queue, "_connect", lambda: FinishingConnection(connect(), queue, first["id"]))
+    job, created = queue.enqueue("heic_to_png", "a.heic", "a.png")
+    assert (job["id"], job["status"], created) == (first["id"], jobs.DONE, False)
+
+
+def test_heic_job_fails_when_the_source_is_missing(load_app, s3):
+    app = load_app("gallery_edit")
+    job = {"key": f"{BUCKET_FOLDER}images/gone.heic", "target_key": f"{BUCKET_FOLDER}images/gone.png"}
+    s3.put_object(Bucket=BUCKET, Key=job["target_key"], Body=b"png")
+
+    with pytest.raises(FileNotFoundError, match="source missing"):
+        app.convert_heic_job(job, lambda detail: None)
+
+    s3.put_object(Bucket=BUCKET, Key=job["key"], Body=b"heic")
+    s3.put_object(Bucket=BUCKET, Key=job["target_key"], Body=b"png")
+    assert app.convert_heic_job(job, lambda detail: None) == "png exists"
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+import time
+
+from common.memory import MemoryBudget
+
+
+def hold(directory, started, release):
+    budget = MemoryBudget(limit=100, directory=directory)
+    with budget.reserve(80):
+        started.set()
+        release.wait(10)
+
+
+def test_budget_is_shared_across_processes(tmp_path):
+    context = multiprocessing.get_context("fork")
+    started, release = context.Event(), context.Event()
+    other = context.Process(target=hold, args=(str(tmp_path), started, release))
+    other.start()
+    try:
+        assert started.wait(10)
+        budget = MemoryBudget(limit=100, directory=str(tmp_path))
+        assert budget.in_use == 80
+
+        waited = time.monotonic()
+        context.Process(target=lambda: (time.sleep(0.3), release.set())).start()
+        with budget.reserve(50):
+            assert time.monotonic() - waited >= 0.25
+            assert budget.in_use == 50
+    finally:
+        release.set()
+        other.join(10)
+    assert budget.in_use == 0
+
+
+def test_reservations_of_dead_processes_are_dropped(tmp_path):
+    context = multiprocessing.get_context("fork")
+    started, release = context.Event(), context.Event()
+    other = context.Process(target=hold, args=(str(tmp_path), started, release))
+    other.start()
+    assert started.wait(10)
+    os.kill(other.pid, 9)
+    other.join(10)
+
+    budget = MemoryBudget(limit=100, directory=str(tmp_path))
+    with budget.reserve(100):
+        assert budget.in_use == 100
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from common.metadata_index import MetadataIndex
+from conftest import BUCKET, BUCKET_FOLDER
+
+THREADS = 3
+UPDATES = 15
+
+
+def test_concurrent_writers_keep_every_record(s3):
+    # one instance shared by request and background threads, as in the services
+    shared = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    shared.load()
+
+    def write(thread):
+        for i in range(UPDATES):
+            shared.put({"filename": f"t{thread}_{i}.jpg", "tags": [str(thread)]})
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        list(pool.map(write, range(THREADS)))
+
+    images = MetadataIndex(s3, BUCKET, BUCKET_FOLDER).load()["images"]
+    assert len(images) == THREADS * UPDATES
+    assert shared.load()["images"] == images
+    assert shared.generation == THREADS * UPDATES + 1
+
+
+def test_write_after_another_process_reapplies_on_its_version(s3):
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    index.put({"filename": "a.jpg", "tags": ["x"]})
+    before = index.load()
+    # another process writes the index behind this instance's back
+    MetadataIndex(s3, BUCKET, BUCKET_FOLDER).put({"filename": "b.jpg", "tags": []})
+
+    index.put({"filename": "c.jpg", "tags": []})
+    assert sorted(before["images"]) == ["a"]
+    assert sorted(index.load()["images"]) == ["a", "b", "c"]
@@ -0,0 +1,17 @@
+import pytest
+
+from common.metrics import registry
+from common.s3 import make_client
+
+
+def test_requests_failing_without_a_response_are_counted():
+    s3 = make_client(region_name="us-east-1")
+
+    def closed_body(**kwargs):
+        raise ValueError("I/O operation on closed file.")
+
+    s3.meta.events.register_first("before-send.s3", closed_body)
+    # the hook must not replace the request's own error with a TypeError
+    with pytest.raises(ValueError):
+        s3.head_object(Bucket="b", Key="k")
+    assert 's3_errors_total{code="ValueError",operation="HeadObject"}' in registry.render()
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+
+from conftest import BUCKET, load_service
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def listing(ages):
+    """A listing of ``{key: minutes after T0}``."""
+    return {key: {"LastModified": T0 + timedelta(minutes=minutes)} for key, minutes in ages.items()}
+
+
+def to_png(key):
+    return f"png/{key.split('/')[-1].rsplit('.', 1)[0]}.png" if key.endswith(".heic") else None
+
+
+def test_plan_reports_missing_and_stale_targets_and_skips_unmapped_sources():
+    planner = load_service("gallery_edit", "planner")
+    sources = listing({"src/a.heic": 0, "src/b.heic": 10, "src/c.heic": 0, "src/d.jpg": 0})
+    targets = listing({"png/b.png": 5, "png/c.png": 5})
+
+    assert planner.plan(sources, targets, to_png) == [
+        planner.PlannedWork("src/a.heic", "png/a.png", planner.MISSING),
+        planner.PlannedWork("src/b.heic", "png/b.png", planner.STALE),
+    ]
+
+
+def test_plan_prefixes_reuses_the_source_listing_for_nested_targets(s3):
+    planner = load_service("gallery_edit", "planner")
+    for key in ("f/a.heic", "f/b.heic", "f/png/b.png", "f/"):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+    listed = []
+    s3.meta.events.register("before-parameter-build.s3.ListObjectsV2",
+                            lambda params, **kwargs: listed.append(params["Prefix"]))
+
+    work = planner.plan_prefixes(s3, BUCKET, "f/", "f/png/",
+                                 lambda key: f"f/png/{key[2:-5]}.png" if key.endswith(".heic") else None)
+    assert work == [planner.PlannedWork("f/a.heic", "f/png/a.png", planner.MISSING)]
+    assert listed == ["f/"]
@@ -0,0 +1,95 @@
+from io import BytesIO
+
+from botocore.exceptions import EndpointConnectionError
+from PIL import Image
+
+from common.metadata_index import IndexBusy, MetadataIndex
+from common.reconciler import (ADDED, IMAGE, Change, Reconciler, derivatives_handler, index_handler,
+                               phash_handler)
+from conftest import BUCKET, BUCKET_FOLDER, load_service
+
+
+def png(size=(64, 48)):
+    buffer = BytesIO()
+    Image.effect_noise(size, 64).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def put_images(s3, bodies):
+    changes = []
+    for name, body in bodies.items():
+        key = f"{BUCKET_FOLDER}images/{name}"
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        changes.append(Change(IMAGE, ADDED, key, f'"{name}"', "2026-01-01T00:00:00"))
+    return changes
+
+
+def test_phash_handler_skips_images_it_cannot_decode(s3):
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    body = png()
+    changes = put_images(s3, {"ok.png": body, "cut.png": body[:len(body) // 2], "junk.png": b"not an image"})
+
+    assert phash_handler(index)(changes, {}) == []
+    images = index.load()["images"]
+    assert images["ok"]["phash"]
+    assert "cut" not in images and "junk" not in images
+
+
+def test_process_upload_skips_images_it_cannot_decode(s3):
+    processing = load_service("uploader", "processing")
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    body = png()
+    put_images(s3, {"cut.png": body[:len(body) // 2]})
+
+    assert processing.process_upload(s3, BUCKET, BUCKET_FOLDER, f"{BUCKET_FOLDER}images/cut.png", index) == []
+
+
+def test_failed_keys_are_retried_alone(s3, tmp_path):
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    put_images(s3, {"ok.png": png(), "bad.png": png()})
+    s3.put_object(Bucket=BUCKET, Key=f"{BUCKET_FOLDER}metadata/junk.json", Body=b"{")
+    bad, submitted = f"{BUCKET_FOLDER}images/bad.png", []
+
+    def unreachable(params, **kwargs):
+        if params["Key"] == bad:
+            raise EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+
+    def submit(key):
+        submitted.append(key)
+
+    reconciler = Reconciler(s3, BUCKET, BUCKET_FOLDER, state_dir=str(tmp_path), handlers=[
+        index_handler(index), phash_handler(index), derivatives_handler(s3, BUCKET, BUCKET_FOLDER, submit),
+    ])
+    s3.meta.events.register("before-parameter-build.s3.GetObject", unreachable)
+    try:
+        assert len(reconciler.run_once()) == 3
+        # the second pass picks up the records the first one created
+        reconciler.run_once()
+        submitted.clear()
+        retried = reconciler.run_once()
+    finally:
+        s3.meta.events.unregister("before-parameter-build.s3.GetObject", unreachable)
+    assert {change.key for change in retried} == {bad, f"{BUCKET_FOLDER}metadata/junk.json"}
+    assert submitted == [bad]
+    assert index.load()["images"]["ok"]["phash"]
+
+    reconciler.run_once()
+    assert index.load()["images"]["bad"]["phash"]
+    assert bad not in {change.key for change in reconciler.run_once()}
+
+
+def test_changes_are_retried_when_the_index_is_busy(s3, tmp_path, monkeypatch):
+    index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+    put_images(s3, {"a.png": png()})
+    reconciler = Reconciler(s3, BUCKET, BUCKET_FOLDER, handlers=[index_handler(index)], state_dir=str(tmp_path))
+
+    def busy(updates):
+        raise IndexBusy("too many concurrent writers")
+
+    monkeypatch.setattr(index, "update", busy)
+    assert len(reconciler.run_once()) == 1
+    monkeypatch.undo()
+    # the record created on the first pass is new to the state as well
+    assert f"{BUCKET_FOLDER}images/a.png" in {change.key for change in reconciler.run_once()}
+    assert "a" in index.load()["images"]
+    assert reconciler.run_once() == []
@@ -0,0 +1,32 @@
+import time
+
+from common.s3 import iter_objects, object_args
+from conftest import BUCKET
+
+
+def test_rewritable_objects_are_not_cached_as_immutable():
+    args = object_args("f/derivatives/medium/a.webp")
+    assert args["ContentType"] == "image/webp"
+    assert "immutable" not in args["CacheControl"]
+    assert "must-revalidate" in args["CacheControl"]
+
+
+def test_iter_objects_keeps_few_downloads_ahead_of_the_consumer(s3):
+    keys = [f"k{i}" for i in range(20)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+    started = []
+
+    def count(params, **kwargs):
+        started.append(params["Key"])
+
+    s3.meta.events.register("before-parameter-build.s3.GetObject", count)
+    try:
+        objects = iter_objects(s3, BUCKET, keys + ["missing"], max_workers=2)
+        next(objects)
+        time.sleep(0.2)
+        assert len(started) <= 3
+        rest = dict(objects)
+    finally:
+        s3.meta.events.unregister("before-parameter-build.s3.GetObject", count)
+    assert len(rest) == 19 and "missing" not in rest
@@ -0,0 +1,55 @@
+import struct
+
+import pytest
+
+from common import snapshot as snapshot_module
+from common.snapshot import Snapshot, write_snapshot
+
+INDEX = {
+    "generation": 7,
+    "updated_at": 1700000000.0,
+    "images": {
+        "a": {"filename": "a.jpg", "tags": ["Beach", "sunset"], "uploaded_at": "2024-01-01T00:00:00",
+              "width": 640, "height": 480, "camera": "X100", "phash": "0f0f0f0f0f0f0f0f", "note": {"k": [1]}},
+        "b": {"filename": "b.heic", "tags": ["beach"], "phash": "0f0f0f0f0f0f0f0e"},
+        "c": {"filename": "c.png", "tags": []},
+    },
+}
+
+
+def write(tmp_path, data=INDEX):
+    path = str(tmp_path / "index.snap")
+    write_snapshot(path, data, '"etag-1"')
+    return path
+
+
+def test_snapshot_round_trips_the_index(tmp_path):
+    snapshot = Snapshot(write(tmp_path))
+    assert (snapshot.generation, snapshot.etag) == (7, '"etag-1"')
+    assert snapshot.last_modified.timestamp() == INDEX["updated_at"]
+    for stem, metadata in INDEX["images"].items():
+        assert snapshot.get(stem) == metadata
+    assert "d" not in snapshot and snapshot.get("d", "missing") == "missing"
+
+    assert (snapshot.field(0, "width"), snapshot.field(0, "camera"), snapshot.field(0, "note")) == (640, "X100", {"k": [1]})
+    assert (snapshot.field(2, "width"), snapshot.field(2, "uploaded_at")) == (None, None)
+
+
+def test_snapshot_groups_near_duplicates_and_searches_tags(tmp_path):
+    snapshot = Snapshot(write(tmp_path))
+    assert [snapshot.representative(image_id) for image_id in range(3)] == [0, 0, 2]
+    assert snapshot.representative_filename("b") == "a.jpg"
+    assert snapshot.representative_filename("d") is None
+
+    assert snapshot.search_ids("beach") == [0, 1]
+    assert snapshot.search_ids("beach -sunset") == [1]
+    assert snapshot.complete("s") == [{"tag": "sunset", "count": 1}]
+
+
+def test_snapshot_rejects_other_format_versions(tmp_path):
+    path = write(tmp_path)
+    with open(path, "r+b") as f:
+        f.seek(len(snapshot_module.MAGIC))
+        f.write(struct.pack("=I", snapshot_module.VERSION - 1))
+    with pytest.raises(ValueError):
+        Snapshot(path)
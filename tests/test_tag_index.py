@@ -0,0 +1,36 @@
+import json
+
+from common.metadata_index import update_record
+from common.snapshot import Snapshot, write_snapshot
+from common.tag_index import TagIndex, compile_query
+from conftest import BUCKET, BUCKET_FOLDER
+
+IMAGES = [
+    {"filename": "a.jpg", "tags": ["new york", "night"]},
+    {"filename": "b.jpg", "tags": ["New-York"]},
+    {"filename": "c.jpg", "tags": ["york"]},
+]
+
+
+def test_multi_word_tags_are_stored_with_dashes(s3):
+    metadata, _, _ = update_record(s3, BUCKET, BUCKET_FOLDER, "a.jpg", tags=[" New  York ", "beach", ""])
+    assert metadata["tags"] == ["new-york", "beach"]
+    metadata, _, _ = update_record(s3, BUCKET, BUCKET_FOLDER, "a.jpg", add=["Times Square"], remove=["new york"])
+    assert metadata["tags"] == ["beach", "times-square"]
+    stored = json.loads(s3.get_object(Bucket=BUCKET, Key=f"{BUCKET_FOLDER}metadata/a.json")["Body"].read())
+    assert stored["tags"] == metadata["tags"]
+
+
+def test_multi_word_tags_are_searchable():
+    index = TagIndex(IMAGES)
+    assert index.search_ids("new-york") == [0, 1]
+    assert index.search_ids("new-york -night") == [1]
+    assert [entry["tag"] for entry in index.complete("new y")] == ["new-york"]
+    assert compile_query("new-york")(["new york"])
+
+
+def test_snapshot_indexes_multi_word_tags(tmp_path):
+    path = str(tmp_path / "index.snap")
+    write_snapshot(path, {"generation": 1, "images": {m["filename"][0]: m for m in IMAGES}}, "etag")
+    snapshot = Snapshot(path)
+    assert snapshot.search_ids("new-york") == [0, 1]
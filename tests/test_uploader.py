@@ -0,0 +1,45 @@
+from io import BytesIO
+
+from PIL import Image
+
+from common.metadata_index import IndexBusy
+from conftest import BUCKET, BUCKET_FOLDER
+
+
+def png():
+    buffer = BytesIO()
+    Image.new("RGB", (40, 30)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def busy_app(load_app, monkeypatch):
+    app = load_app("uploader")
+    submitted = []
+
+    def busy(metadata):
+        raise IndexBusy("too many concurrent writers")
+
+    monkeypatch.setattr(app.metadata_index, "put", busy)
+    monkeypatch.setattr(app.processing, "submit", lambda s3, bucket, folder, key, index: submitted.append(key))
+    return app, submitted
+
+
+def test_completed_upload_is_processed_while_the_index_is_busy(load_app, s3, monkeypatch):
+    app, submitted = busy_app(load_app, monkeypatch)
+    key = f"{BUCKET_FOLDER}images/a.png"
+    s3.put_object(Bucket=BUCKET, Key=key, Body=png())
+
+    response = app.app.test_client().post("/uploads/complete", json={"key": key, "tags": "beach"})
+    assert response.status_code == 200
+    assert response.json["index"] == "pending"
+    assert response.json["metadata"]["tags"] == ["beach"]
+    assert submitted == [key]
+
+
+def test_form_upload_is_processed_while_the_index_is_busy(load_app, s3, monkeypatch):
+    app, submitted = busy_app(load_app, monkeypatch)
+
+    response = app.app.test_client().post("/", data={"tags": "beach", "image": (BytesIO(png()), "b.png")},
+                                          content_type="multipart/form-data")
+    assert response.status_code == 302
+    assert submitted == [f"{BUCKET_FOLDER}images/b.png"]
@@ -1,41 +1,192 @@
 from flask import Flask, render_template, request, redirect
-import boto3
-import json
+import math
 import os
 from datetime import datetime
+from botocore.exceptions import ClientError
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
+from common.image_info import fetch_image_info, image_info
+from common.metadata_index import IndexBusy, MetadataIndex, WriteConflict, update_record
+from common.metrics import init_app as init_metrics
+from common.s3 import get_client, is_missing, object_args
+import processing
+
 load_dotenv()
 
 app = Flask(__name__)
-s3 = boto3.client('s3')
+init_metrics(app, "uploader")
+s3 = get_client()
 BUCKET = os.getenv("S3_BUCKET")
 BUCKET_FOLDER = os.getenv("BUCKET_FOLDER")
+IMAGES_FOLDER = "images/"
+metadata_index = MetadataIndex(s3, BUCKET, BUCKET_FOLDER)
+
+# browsers upload straight to S3 with presigned requests valid this long (seconds)
+UPLOAD_URL_EXPIRY = int(os.getenv("UPLOAD_URL_EXPIRY", 3600))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 5120)) * 1024 * 1024
+# larger files are uploaded in parts, several at a time
+MULTIPART_THRESHOLD = int(os.getenv("UPLOAD_MULTIPART_MB", 16)) * 1024 * 1024
+UPLOAD_PART_SIZE = max(int(os.getenv("UPLOAD_PART_MB", 8)), 5) * 1024 * 1024  # S3's minimum part size is 5 MB
+MAX_PARTS = 10000
+
+
+def parse_tags(tags):
+    return [tag.strip().lower() for tag in tags.split(",") if tag.strip()]
+
+
+def image_key(filename):
+    return f"{BUCKET_FOLDER or ''}{IMAGES_FOLDER}{filename}"
+
+
+def record_upload(key, tags, info):
+    """Write the metadata record of a finished upload and queue its processing.
+
+    Returns the record and whether its index write is still pending.
+    """
+    filename = os.path.basename(key)
+    metadata, _, _ = update_record(s3, BUCKET, BUCKET_FOLDER, filename, tags=tags, fields={
+        "filename": filename,
+        "uploaded_at": datetime.utcnow().isoformat(),
+        **info,
+    })
+    pending = False
+    try:
+        metadata_index.put(metadata)
+    except IndexBusy as e:
+        # the record is saved; processing writes it to the index again, and the reconciler repairs it
+        print(f"index update of {filename} deferred: {e}")
+        pending = True
+    processing.submit(s3, BUCKET, BUCKET_FOLDER, key, metadata_index)
+    return metadata, pending
+
 
 @app.route("/", methods=["GET", "POST"])
 def upload_image():
+    """The form upload, for browsers without JavaScript; it goes through this worker."""
     if request.method == "POST":
-        image = request.files["image"]
-        tags = request.form["tags"]
-        filename = secure_filename(image.filename)
-        tag_list = [tag.strip().lower() for tag in tags.split(",")]
-
-        # Upload image
-        s3.upload_fileobj(image, BUCKET, f"{BUCKET_FOLDER}images/{filename}")
-
-        # Upload metadata
-        metadata = {
-            "filename": filename,
-            "tags": tag_list,
-            "uploaded_at": datetime.utcnow().isoformat()
-        }
-        metadata_filename = f"{BUCKET_FOLDER}/metadata/{os.path.splitext(filename)[0]}.json"
-        s3.put_object(Body=json.dumps(metadata), Bucket=BUCKET, Key=metadata_filename)
+        tags = parse_tags(request.form["tags"])
+        for image in request.files.getlist("image"):
+            filename = secure_filename(image.filename)
+            if not filename:
+                continue
+
+            # read the capture date, size and camera from the header before it goes to S3
+            info = image_info(image.stream)
+            image.stream.seek(0)
+
+            key = image_key(filename)
+            s3.upload_fileobj(image, BUCKET, key, ExtraArgs=object_args(key))
+            try:
+                record_upload(key, tags, info)
+            except WriteConflict as e:
+                return {"error": str(e)}, 409
 
         return redirect("/")
 
     return render_template("upload.html")
 
+
+@app.route("/uploads", methods=["POST"])
+def start_upload():
+    """Presign a direct upload of ``{"filename", "size"}`` to S3.
+
+    Small files get a presigned POST (``{"key", "post": {"url", "fields"}}``).
+    Larger ones get a multipart upload, ``{"key", "upload_id", "part_size",
+    "parts": [url, ...]}``; the browser PUTs every part and reports the parts'
+    ETags to ``/uploads/complete`` (the bucket's CORS rules must expose the
+    ETag header).
+    """
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get("filename", "")))
+    size = data.get("size")
+    if not filename or not isinstance(size, int) or size <= 0:
+        return {"error": "Expected a filename and a positive size"}, 400
+    if size > MAX_UPLOAD_BYTES:
+        return {"error": f"Uploads are limited to {MAX_UPLOAD_BYTES // 2 ** 20} MB"}, 413
+
+    key = image_key(filename)
+    args = object_args(key)
+    if size <= MULTIPART_THRESHOLD:
+        fields = {"Content-Type": args["ContentType"], "Cache-Control": args["CacheControl"]}
+        post = s3.generate_presigned_post(
+            BUCKET, key,
+            Fields=fields,
+            Conditions=[{name: value} for name, value in fields.items()] + [["content-length-range", 1, size]],
+            ExpiresIn=UPLOAD_URL_EXPIRY,
+        )
+        return {"key": key, "post": post}
+
+    part_size = max(UPLOAD_PART_SIZE, math.ceil(size / MAX_PARTS))
+    upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=key, **args)["UploadId"]
+    parts = [
+        s3.generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": number},
+            ExpiresIn=UPLOAD_URL_EXPIRY,
+        )
+        for number in range(1, math.ceil(size / part_size) + 1)
+    ]
+    return {"key": key, "upload_id": upload_id, "part_size": part_size, "parts": parts}
+
+
+def uploaded_key(data):
+    """The image key of an upload request, or None unless it is one ``/uploads`` hands out."""
+    key = str(data.get("key", ""))
+    filename = key[len(image_key("")):]
+    return key if key.startswith(image_key("")) and filename and filename == secure_filename(filename) else None
+
+
+@app.route("/uploads/complete", methods=["POST"])
+def complete_upload():
+    """Finish a direct upload of ``{"key", "tags", "upload_id"?, "parts"?}`` and record its metadata.
+
+    ``parts`` lists ``{"PartNumber", "ETag"}`` of a multipart upload. The
+    image is hashed, converted and rendered in the background. The response
+    carries ``"index": "pending"`` when the index write was contended; the
+    galleries show the image once processing or the reconciler indexes it.
+    """
+    data = request.get_json(silent=True) or {}
+    key = uploaded_key(data)
+    if key is None:
+        return {"error": "Unknown upload key"}, 400
+    try:
+        if data.get("upload_id"):
+            parts = sorted(({"PartNumber": int(part["PartNumber"]), "ETag": str(part["ETag"])}
+                            for part in data.get("parts") or []), key=lambda part: part["PartNumber"])
+            s3.complete_multipart_upload(Bucket=BUCKET, Key=key, UploadId=data["upload_id"],
+                                         MultipartUpload={"Parts": parts})
+        s3.head_object(Bucket=BUCKET, Key=key)
+    except (KeyError, TypeError, ValueError):
+        return {"error": "Expected parts with a PartNumber and an ETag"}, 400
+    except ClientError as e:
+        if is_missing(e):
+            return {"error": f"{key} has not been uploaded"}, 404
+        return {"error": str(e)}, 400
+
+    # the header facts are a couple of ranged GETs; the rest happens off this request
+    try:
+        metadata, pending = record_upload(key, parse_tags(str(data.get("tags", ""))), fetch_image_info(s3, BUCKET, key))
+    except WriteConflict as e:
+        return {"error": str(e)}, 409
+    if pending:
+        return {"key": key, "metadata": metadata, "index": "pending"}
+    return {"key": key, "metadata": metadata}
+
+
+@app.route("/uploads/abort", methods=["POST"])
+def abort_upload():
+    """Drop the parts of an abandoned multipart upload ``{"key", "upload_id"}``."""
+    data = request.get_json(silent=True) or {}
+    key = uploaded_key(data)
+    if key is None or not data.get("upload_id"):
+        return {"error": "Expected an upload key and upload_id"}, 400
+    try:
+        s3.abort_multipart_upload(Bucket=BUCKET, Key=key, UploadId=data["upload_id"])
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+    return {"key": key, "status": "aborted"}
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,64 @@
+"""Move metadata records written under the uploader's old, misspelled prefix.
+
+The uploader used to write records to ``{BUCKET_FOLDER}/metadata/`` (note the
+extra slash), where the metadata index and the galleries never look::
+
+    python fix_metadata_keys.py --dry-run
+    python fix_metadata_keys.py
+
+Each record is merged into the one at the right key. Its tags are added to
+any that were set since, and its other fields win. The merged records are
+then indexed, and the misplaced copies deleted.
+"""
+import argparse
+import json
+import os
+
+from dotenv import load_dotenv
+
+from common.metadata_index import METADATA_FOLDER, MetadataIndex, metadata_stem, record_key, update_record
+from common.s3 import get_client, iter_objects
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=os.getenv("S3_BUCKET"))
+    parser.add_argument("--bucket-folder", default=os.getenv("BUCKET_FOLDER") or "")
+    parser.add_argument("--dry-run", action="store_true", help="only list the records that would move")
+    args = parser.parse_args()
+
+    s3 = get_client()
+    prefix = f"{args.bucket_folder}/{METADATA_FOLDER}"
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [
+        item["Key"]
+        for page in paginator.paginate(Bucket=args.bucket, Prefix=prefix)
+        for item in page.get("Contents", [])
+        if item["Key"].endswith(".json")
+    ]
+    print(f"{len(keys)} records under s3://{args.bucket}/{prefix}")
+
+    merged = {}
+    for key, body in iter_objects(s3, args.bucket, keys):
+        stray = json.loads(body)
+        filename = stray["filename"]
+        print(f"{key} -> {record_key(args.bucket_folder, filename)}")
+        if args.dry_run:
+            continue
+        fields = {name: value for name, value in stray.items() if name != "tags"}
+        metadata, _, _ = update_record(s3, args.bucket, args.bucket_folder, filename,
+                                       add=stray.get("tags", []), fields=fields)
+        merged[metadata_stem(filename)] = metadata
+
+    if merged:
+        MetadataIndex(s3, args.bucket, args.bucket_folder).update(merged)
+        for start in range(0, len(keys), 1000):
+            s3.delete_objects(Bucket=args.bucket,
+                              Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+        print(f"moved {len(merged)} records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Upload-time processing of new images.
+
+Once an upload completes, the image is downloaded once, off the request
+thread, and:
+
+- hashed (``common.duplicates``), with the hash stored on its record;
+- converted to ``UPLOAD_CONVERT_FORMAT`` when browsers can't show it (HEIC);
+- rendered into the web derivatives the galleries show. Near-duplicates
+  get their own too: a hash match alone is not sure enough to leave an
+  image without them.
+
+The sibling is uploaded before the derivatives, so they are never older than
+either source. If a worker dies mid-way, the reconciler finds the missing
+hash and derivatives on its next pass.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import os
+
+from PIL import Image
+
+from common.derivatives import EXTENSIONS, derivative_keys, render_derivatives
+from common.duplicates import image_hash
+from common.encoding import encode
+from common.memory import conversion_budget, image_footprint
+from common.metadata_index import metadata_stem, update_record
+from common.metrics import timed
+from common.s3 import object_args
+
+UPLOAD_PROCESS_WORKERS = int(os.getenv("UPLOAD_PROCESS_WORKERS", 2))
+# browsers can't show these, so a converted sibling is stored next to them; an empty format disables it
+CONVERT_EXTENSIONS = (".heic", ".heif")
+UPLOAD_CONVERT_FORMAT = os.getenv("UPLOAD_CONVERT_FORMAT", "PNG").upper()
+
+_executor = ThreadPoolExecutor(max_workers=UPLOAD_PROCESS_WORKERS)
+
+
+def converted_key(key, output_format=UPLOAD_CONVERT_FORMAT):
+    """Key of the browser-friendly sibling of ``key``, or None when it needs none."""
+    if not output_format or not key.lower().endswith(CONVERT_EXTENSIONS):
+        return None
+    return f"{os.path.splitext(key)[0]}.{EXTENSIONS[output_format]}"
+
+
+def convert(body, output_format=UPLOAD_CONVERT_FORMAT):
+    with Image.open(BytesIO(body)) as image:
+        rgb = image if output_format != "JPEG" or image.mode == "RGB" else image.convert("RGB")
+        buffer = BytesIO()
+        encode(rgb, buffer, output_format)
+        rgb.close()
+    return buffer.getvalue()
+
+
+@timed("process_upload")
+def process_upload(s3, bucket, bucket_folder, key, index):
+    """Hash, convert and render the derivatives of the uploaded ``key``; returns the keys written."""
+    filename = os.path.basename(key)
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    written = []
+    try:
+        with conversion_budget.reserve(image_footprint(BytesIO(body))):
+            phash = image_hash(BytesIO(body))
+            metadata = update_record(s3, bucket, bucket_folder, filename, fields={"phash": phash})[0]
+            index.update({metadata_stem(filename): metadata})
+
+            target_key = converted_key(key)
+            if target_key:
+                s3.put_object(Bucket=bucket, Key=target_key, Body=convert(body), **object_args(target_key))
+                written.append(target_key)
+            outputs = render_derivatives(body)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # not an image, truncated, or too large to decode; the reconciler skips it the same way
+        print(f"not processing {key}: {e!r}")
+        return written
+    del body
+    keys = derivative_keys(bucket_folder, key)
+    for name, data in outputs.items():
+        s3.put_object(Bucket=bucket, Key=keys[name], Body=data, **object_args(keys[name]))
+        written.append(keys[name])
+    return written
+
+
+def submit(s3, bucket, bucket_folder, key, index):
+    """Process ``key`` in the background; failures are logged and left to the reconciler."""
+    def run():
+        try:
+            return process_upload(s3, bucket, bucket_folder, key, index)
+        except Exception as e:
+            print(f"could not process upload {key}: {e}")
+            raise
+
+    return _executor.submit(run)